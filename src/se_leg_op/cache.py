@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+    """
+    Thread safe cache holding at most max_size entries. The least recently used entry is evicted when the cache is
+    full and entries expire ttl seconds after they were added.
+    """
+
+    def __init__(self, max_size, ttl, timer=time.monotonic):
+        """
+        :param max_size: Maximum number of entries
+        :type max_size: int
+        :param ttl: Lifetime in seconds of an entry
+        :type ttl: float
+        :param timer: Clock used for expiry
+        :type timer: callable
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, key):
+        with self._lock:
+            expires_at, value = self._entries[key]
+            if expires_at <= self._timer():
+                del self._entries[key]
+                raise KeyError(key)
+            self._entries.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self._timer() + self.ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        :param key: Key to remove, None removes all entries
+        :type key: str | None
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+class RedisCacheInvalidator(object):
+    """
+    Propagates cache invalidations between processes using a Redis pub/sub channel.
+
+    Invalidations can also be published from outside the application, e.g. after editing a client document:
+        PUBLISH <channel> '{"key": "<client_id>"}'
+    A message without a key invalidates all entries.
+    """
+
+    def __init__(self, connection, channel, cache):
+        """
+        :param connection: Redis connection
+        :type connection: redis.StrictRedis
+        :param channel: Pub/sub channel name
+        :type channel: str
+        :param cache: The local cache to invalidate
+        :type cache: TTLCache
+        """
+        self.connection = connection
+        self.channel = channel
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def publish(self, key=None):
+        message = {} if key is None else {'key': key}
+        try:
+            self.connection.publish(self.channel, json.dumps(message))
+        except redis.RedisError as e:
+            logger.error('Could not publish cache invalidation for %s: %s', key, e)
+
+    def start(self):
+        """
+        Listen for invalidations in a daemon thread, started once per process. Threads don't survive a fork, so a
+        forked process, like a gunicorn worker of a preloaded app, starts its own thread on its first call.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid != pid:
+                thread = threading.Thread(target=self._listen, name='cache-invalidator-{}'.format(self.channel))
+                thread.daemon = True
+                thread.start()
+                self._pid = pid
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.connection.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Invalidations published while not subscribed are lost
+                self.cache.invalidate()
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and message['type'] == 'message':
+                        self._handle(message['data'])
+            except redis.RedisError as e:
+                logger.warning('Cache invalidation subscription to %s failed: %s', self.channel, e)
+                time.sleep(1)
+
+    def _handle(self, data):
+        try:
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            key = json.loads(data).get('key')
+        except (ValueError, AttributeError):
+            logger.error('Received malformed cache invalidation %r', data)
+            return
+        self.cache.invalidate(key)
+
+
+class CachedStorage(object):
+    """
+    Read-through cache in front of a storage like OpStorageWrapper. Writes go to the storage and invalidate the
+    cached entry in all processes. Other attributes are looked up on the storage.
+    """
+
+    def __init__(self, storage, cache, invalidator=None):
+        """
+        :param storage: The storage to cache
+        :type storage: se_leg_op.storage.OpStorageWrapper
+        :param cache: Cache for the storage data
+        :type cache: TTLCache
+        :param invalidator: Propagates invalidations to other processes
+        :type invalidator: RedisCacheInvalidator | None
+        """
+        self.storage = storage
+        self.cache = cache
+        self.invalidator = invalidator
+
+    def __getattr__(self, item):
+        return getattr(self.storage, item)
+
+    def _start_invalidator(self):
+        # Cached values can only be used while invalidations are received
+        if self.invalidator is not None:
+            self.invalidator.start()
+
+    def __getitem__(self, key):
+        self._start_invalidator()
+        try:
+            value = self.cache[key]
+        except KeyError:
+            value = self.storage[key]
+            self.cache[key] = value
+        # Don't let callers modify the cached value
+        return copy.deepcopy(value)
+
+    def __contains__(self, key):
+        self._start_invalidator()
+        try:
+            self.cache[key]
+            return True
+        except KeyError:
+            return key in self.storage
+
+    def __setitem__(self, key, value):
+        self.storage[key] = value
+        self.invalidate(key)
+
+    def __delitem__(self, key):
+        del self.storage[key]
+        self.invalidate(key)
+
+    def pop(self, key, default=None):
+        value = self.storage.pop(key, default)
+        self.invalidate(key)
+        return value
+
+    def items(self):
+        return self.storage.items()
+
+    def invalidate(self, key=None):
+        """
+        :param key: Key to invalidate, None invalidates all entries
+        :type key: str | None
+        """
+        self.cache.invalidate(key)
+        if self.invalidator is not None:
+            self.invalidator.publish(key)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Logging helpers keeping diagnostics of large or sensitive payloads cheap.
+
+Pass values to the loggers as arguments, wrapped in payload() when they may be large or contain secrets:
+
+    logger.debug('Vetting data received: %s', payload(data))
+
+Nothing is formatted unless the record is emitted, and then long values are truncated and the values of
+sensitive keys are replaced.
+
+Configured from the app config, the payload settings are kept on the app and used by the payloads logged in its
+app context. Processes without an app, like the rq workers, set them as LogPayload.defaults:
+  LOG_PAYLOAD_MAX_LENGTH: maximum number of characters of a logged payload, default 1000
+  LOG_REDACTED_KEYS: keys whose values are never logged
+  LOG_SAMPLING: full dotted logger names and the fraction of their debug and info records that are emitted,
+                e.g. {'se_leg_op.service.response_sender': 0.01}. The filter is added to the named logger and, like
+                any logger filter, doesn't apply to the records of its child loggers: name the module loggers, like
+                se_leg_op.service.job_worker, not their package. The views log with the Flask app logger, which is
+                named after the app, e.g. se_leg_op.service.app.
+"""
+
+import json
+import logging
+import random
+
+from flask import current_app, has_app_context
+
+__author__ = 'lundberg'
+
+PAYLOAD_MAX_LENGTH = 1000
+REDACTED_KEYS = frozenset(['encodedData', 'encoded_front_image', 'front_image_data', 'client_secret', 'password',
+                           'access_token', 'refresh_token', 'id_token'])
+
+
+def _truncate(text, max_length):
+    if len(text) <= max_length:
+        return text
+    return '{}... ({} characters truncated)'.format(text[:max_length], len(text) - max_length)
+
+
+class PayloadSettings(object):
+    """
+    How logged payloads are truncated and redacted.
+    """
+
+    def __init__(self, max_length=PAYLOAD_MAX_LENGTH, redacted_keys=REDACTED_KEYS):
+        """
+        :param max_length: Maximum number of characters of a logged payload
+        :type max_length: int
+        :param redacted_keys: Keys whose values are never logged
+        :type redacted_keys: collections.Container[str]
+        """
+        self.max_length = max_length
+        self.redacted_keys = frozenset(redacted_keys)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: The app config
+        :type config: dict
+        :rtype: PayloadSettings
+        """
+        return cls(config.get('LOG_PAYLOAD_MAX_LENGTH', PAYLOAD_MAX_LENGTH),
+                   config.get('LOG_REDACTED_KEYS', REDACTED_KEYS))
+
+
+class LogPayload(object):
+    """
+    Formats a value for a log message only when the message is emitted.
+    """
+
+    # Used outside of an app context, or when the app has no payload settings
+    defaults = PayloadSettings()
+
+    def __init__(self, value, max_length=None, redacted_keys=None):
+        """
+        :param value: A string, bytes or a JSON like structure
+        :param max_length: Maximum number of characters, defaults to the current payload settings
+        :type max_length: int | None
+        :param redacted_keys: Keys whose values are replaced, defaults to the current payload settings
+        :type redacted_keys: collections.Container[str] | None
+        """
+        self.value = value
+        self.max_length = max_length
+        self.redacted_keys = redacted_keys
+
+    def _redact(self, value, redacted_keys, max_length):
+        if isinstance(value, dict):
+            return dict((k, '<redacted>' if k in redacted_keys else self._redact(v, redacted_keys, max_length))
+                        for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return [self._redact(v, redacted_keys, max_length) for v in value]
+        if isinstance(value, (bytes, bytearray)):
+            return '<{} bytes>'.format(len(value))
+        if isinstance(value, str):
+            return _truncate(value, max_length)
+        return value
+
+    @classmethod
+    def current_settings(cls):
+        """
+        :return: The payload settings of the current app, or the defaults
+        :rtype: PayloadSettings
+        """
+        if has_app_context():
+            return getattr(current_app, 'log_payload_settings', cls.defaults)
+        return cls.defaults
+
+    def __str__(self):
+        settings = self.current_settings()
+        max_length = self.max_length if self.max_length is not None else settings.max_length
+        redacted_keys = self.redacted_keys if self.redacted_keys is not None else settings.redacted_keys
+        if isinstance(self.value, (bytes, bytearray)):
+            return '<{} bytes>'.format(len(self.value))
+        if isinstance(self.value, str):
+            return _truncate(self.value, max_length)
+        try:
+            text = json.dumps(self._redact(self.value, redacted_keys, max_length), sort_keys=True, default=repr)
+        except (TypeError, ValueError):
+            text = repr(self.value)
+        return _truncate(text, max_length)
+
+
+def payload(value, max_length=None, redacted_keys=None):
+    """
+    :return: The value wrapped for lazy, truncated and redacted logging
+    :rtype: LogPayload
+    """
+    return LogPayload(value, max_length, redacted_keys)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through a fraction of the records up to max_level, records above max_level are always let through.
+    """
+
+    def __init__(self, rate, max_level=logging.INFO, random=random.random):
+        """
+        :param rate: Fraction of the records to let through, between 0 and 1
+        :type rate: float
+        :param max_level: Highest level of the sampled records
+        :type max_level: int
+        """
+        super(SamplingFilter, self).__init__()
+        self.rate = rate
+        self.max_level = max_level
+        self._random = random
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+        return self._random() < self.rate
+
+
+def init_logging(config):
+    """
+    Adds the sampling filters to the configured loggers.
+
+    :param config: The app config
+    :type config: dict
+    :return: The payload settings from the config
+    :rtype: PayloadSettings
+    """
+    for name, rate in config.get('LOG_SAMPLING', {}).items():
+        logger = logging.getLogger(name)
+        # Replace the filter of an earlier app in the same process
+        for log_filter in [f for f in logger.filters if isinstance(f, SamplingFilter)]:
+            logger.removeFilter(log_filter)
+        logger.addFilter(SamplingFilter(rate))
+    return PayloadSettings.from_config(config)
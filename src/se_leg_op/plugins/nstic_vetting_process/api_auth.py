@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Basic auth for the Yubico API.
+
+Admin secrets in YUBICO_API_ADMINS may be stored hashed, create the hash with
+python -m se_leg_op.plugins.nstic_vetting_process.api_auth
+"""
+
+import getpass
+import hashlib
+import hmac
+import logging
+import os
+from base64 import b64decode, b64encode
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+from ...cache import TTLCache
+from ...redis_connections import redis_connections
+
+__author__ = 'lundberg'
+
+logger = logging.getLogger(__name__)
+
+HASH_ALGORITHM = 'pbkdf2_sha256'
+HASH_ITERATIONS = 100000
+
+
+def hash_secret(secret, iterations=HASH_ITERATIONS, salt=None):
+    """
+    :param secret: The secret to hash
+    :type secret: str
+    :return: pbkdf2_sha256$<iterations>$<base64 salt>$<base64 hash>
+    :rtype: str
+    """
+    salt = salt or os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', secret.encode('utf-8'), salt, iterations)
+    return '{}${}${}${}'.format(HASH_ALGORITHM, iterations, b64encode(salt).decode('ascii'),
+                                b64encode(digest).decode('ascii'))
+
+
+def check_secret(stored_secret, secret):
+    """
+    :param stored_secret: A secret in plain text or hashed with hash_secret
+    :type stored_secret: str
+    :param secret: The secret given by the client
+    :type secret: str
+    :return: True if the secrets match
+    :rtype: bool
+    """
+    if stored_secret.startswith(HASH_ALGORITHM + '$'):
+        try:
+            _, iterations, salt, digest = stored_secret.split('$')
+            salt = b64decode(salt)
+            digest = b64decode(digest)
+            iterations = int(iterations)
+        except ValueError:
+            logger.error('Malformed hashed secret')
+            return False
+        return hmac.compare_digest(hashlib.pbkdf2_hmac('sha256', secret.encode('utf-8'), salt, iterations), digest)
+    return hmac.compare_digest(stored_secret.encode('utf-8'), secret.encode('utf-8'))
+
+
+class ApiAuthenticator(object):
+    """
+    Verifies Yubico API credentials. Verified credentials are cached for a short time as a digest, so repeated
+    requests with the same credentials don't need a client lookup or a password hash computation.
+
+    Failed attempts are counted per username in Redis and the count is reset by a successful login. If max_failures
+    is set, a username is refused for failure_window seconds after that many failed attempts. The counters are not
+    checked while Redis is unavailable, like the rate limits, the credentials are still verified.
+    """
+
+    def __init__(self, clients_db, api_clients, api_admins, cache_ttl=60, connection=None, max_failures=0,
+                 failure_window=900):
+        """
+        :param clients_db: Client registrations
+        :type clients_db: se_leg_op.storage.OpStorageWrapper
+        :param api_clients: Client ids allowed to use the API
+        :type api_clients: collections.Iterable[str]
+        :param api_admins: Admin usernames and {'secret': ...} dicts
+        :type api_admins: dict
+        :param cache_ttl: Number of seconds verified credentials are cached, 0 disables caching
+        :type cache_ttl: int
+        :param connection: Redis connection for the failure counters, None disables them
+        :type connection: redis.StrictRedis | None
+        :param max_failures: Number of failed attempts before a username is refused, 0 means never
+        :type max_failures: int
+        :param failure_window: Number of seconds failed attempts are counted
+        :type failure_window: int
+        """
+        self.clients_db = clients_db
+        self.api_clients = frozenset(api_clients)
+        self.api_admins = dict((username, admin['secret']) for username, admin in api_admins.items())
+        self.cache = TTLCache(max_size=len(self.api_clients) + len(self.api_admins) + 1, ttl=cache_ttl) \
+            if cache_ttl else None
+        self.connection = connection
+        self.max_failures = max_failures
+        self.failure_window = failure_window
+
+    @staticmethod
+    def _digest(username, password):
+        return hashlib.sha256('{}\0{}'.format(username, password).encode('utf-8')).digest()
+
+    def _failures_key(self, username):
+        return 'se_leg_op:yubico_api:auth_failures:{}'.format(username)
+
+    def authenticate(self, username, password):
+        """
+        :param username: Basic auth username
+        :type username: str
+        :param password: Basic auth password
+        :type password: str
+        :return: The authenticated principal, the client id or 'admin', or None if the credentials are wrong
+        :rtype: str | None
+        """
+        digest = self._digest(username, password)
+        if self.cache is not None:
+            try:
+                principal, cached_digest = self.cache[username]
+            except KeyError:
+                pass
+            else:
+                if hmac.compare_digest(cached_digest, digest):
+                    return principal
+
+        if self._too_many_failures(username):
+            logger.warning('Authorization failure: too many failed attempts for %s', username)
+            return None
+
+        principal = self._verify(username, password)
+        if principal is None:
+            logger.warning('Authorization failure: Wrong username or password for %s', username)
+            self._record_failure(username)
+            if self.cache is not None:
+                # The next successful login is verified again and resets the failures
+                self.cache.invalidate(username)
+            return None
+        self._reset_failures(username)
+        if self.cache is not None:
+            self.cache[username] = (principal, digest)
+        return principal
+
+    def _verify(self, username, password):
+        if username in self.api_clients:
+            try:
+                secret = self.clients_db[username]['client_secret']
+            except KeyError:
+                return None
+            return username if check_secret(secret, password) else None
+        if username in self.api_admins:
+            return 'admin' if check_secret(self.api_admins[username], password) else None
+        return None
+
+    def _too_many_failures(self, username):
+        if not self.max_failures or self.connection is None:
+            return False
+        try:
+            failures = self.connection.get(self._failures_key(username))
+        except RedisError as e:
+            # Rather let clients with the right credentials in than refuse everyone
+            logger.error('Could not check failed attempts for %s: %s', username, e)
+            return False
+        return failures is not None and int(failures) >= self.max_failures
+
+    def _record_failure(self, username):
+        if self.connection is None:
+            return
+        key = self._failures_key(username)
+        try:
+            with self.connection.pipeline(transaction=False) as pipeline:
+                pipeline.incr(key)
+                pipeline.expire(key, self.failure_window)
+                pipeline.execute()
+        except RedisError as e:
+            logger.error('Could not count failed attempt for %s: %s', username, e)
+
+    def _reset_failures(self, username):
+        if self.connection is None:
+            return
+        try:
+            self.connection.delete(self._failures_key(username))
+        except RedisError as e:
+            logger.error('Could not reset failed attempts for %s: %s', username, e)
+
+
+def get_authenticator():
+    """
+    :return: The authenticator of the current app, created on first use
+    :rtype: ApiAuthenticator
+    """
+    authenticator = current_app.extensions.get('yubico_api_authenticator')
+    if authenticator is None:
+        config = current_app.config
+        authenticator = ApiAuthenticator(current_app.provider.clients, config['YUBICO_API_CLIENTS'],
+                                         config['YUBICO_API_ADMINS'],
+                                         cache_ttl=config['YUBICO_API_AUTH_CACHE_TTL'],
+                                         connection=redis_connections.get_connection(config),
+                                         max_failures=config['YUBICO_API_AUTH_MAX_FAILURES'],
+                                         failure_window=config['YUBICO_API_AUTH_FAILURE_WINDOW'])
+        current_app.extensions['yubico_api_authenticator'] = authenticator
+    return authenticator
+
+
+if __name__ == '__main__':
+    print(hash_secret(getpass.getpass('Secret: ')))
@@ -6,14 +6,29 @@ __author__ = 'lundberg'
 ## API CONFIG
 YUBICO_API_CLIENTS = []
 YUBICO_API_ADMINS = {}
+# Number of states joined with userinfo at a time when streaming a states listing
+YUBICO_API_STATES_BATCH_SIZE = 100
+# Number of seconds verified API credentials are cached, 0 disables caching
+YUBICO_API_AUTH_CACHE_TTL = 60
+# Number of failed authentications within the failure window before a username is refused, 0 means never
+YUBICO_API_AUTH_MAX_FAILURES = 0
+YUBICO_API_AUTH_FAILURE_WINDOW = 15 * 60
 
 ## VETTING CONFIG
 
-# Mobile verify service information
+# Mobile verify service information, the wsdl is a URL or the path to a local copy
 MOBILE_VERIFY_WSDL = None
 MOBILE_VERIFY_USERNAME = None
 MOBILE_VERIFY_PASSWORD = None
 MOBILE_VERIFY_TENANT_REF = None
+# Number of license verifications made at the same time by a license verify worker
+MOBILE_VERIFY_CONCURRENCY = 4
+# Number of seconds to wait for the mobile verify service to answer
+MOBILE_VERIFY_TIMEOUT = 60
+# Path of an sqlite file caching the wsdl and the schemas it imports between worker starts, None disables the cache
+MOBILE_VERIFY_WSDL_CACHE = None
+# Number of seconds a cached wsdl is used before it is fetched again
+MOBILE_VERIFY_WSDL_CACHE_TIMEOUT = 60 * 60 * 24
 
 NSTIC_VETTING_PROCESS_AUDIT_LOG_FILE = '/var/log/op/plugins/nstic-vetting-process-audit.log'
 
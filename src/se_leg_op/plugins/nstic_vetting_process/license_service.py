@@ -1,40 +1,124 @@
 # -*- coding: utf-8 -*-
 
+import inspect
 import logging
 import json
-import base64
-import redis
-from redis import StrictRedis, sentinel
-import rq
-from se_leg_op.storage import OpStorageWrapper
+from collections import namedtuple
 
-from mitek_mobile_verify.services import MitekMobileVerifyService
-from mitek_mobile_verify.plugins import DoctorPlugin
-from mitek_mobile_verify.models.requests import PhotoVerifyRequest
-from mitek_mobile_verify.models.headers import DeviceMetaData, WebRequestMetadataHeader, MibiDataHeader
+import requests
+import rq
+from requests.adapters import HTTPAdapter
+from se_leg_op.redis_connections import redis_connections
+from se_leg_op.storage import init_blob_storage, init_storage
 
 __author__ = 'lundberg'
 
 logger = logging.getLogger(__name__)
 
+SoapClasses = namedtuple('SoapClasses', ['MitekMobileVerifyService', 'DoctorPlugin', 'PhotoVerifyRequest',
+                                         'DeviceMetaData', 'WebRequestMetadataHeader', 'MibiDataHeader',
+                                         'Transport', 'SqliteCache'])
+
+
+def load_soap_classes():
+    """
+    Import the soap stack when a LicenseService is created, so that the app loading this module as an extension
+    does not import it.
+
+    :rtype: SoapClasses
+    """
+    from mitek_mobile_verify.services import MitekMobileVerifyService
+    from mitek_mobile_verify.plugins import DoctorPlugin
+    from mitek_mobile_verify.models.requests import PhotoVerifyRequest
+    from mitek_mobile_verify.models.headers import DeviceMetaData, WebRequestMetadataHeader, MibiDataHeader
+    from zeep.cache import SqliteCache
+    from zeep.transports import Transport
+    return SoapClasses(MitekMobileVerifyService, DoctorPlugin, PhotoVerifyRequest, DeviceMetaData,
+                       WebRequestMetadataHeader, MibiDataHeader, Transport, SqliteCache)
+
+
+def accepts_transport(service_class):
+    """
+    :return: True if the service class takes a zeep transport keyword argument
+    :rtype: bool
+    """
+    try:
+        return 'transport' in inspect.signature(service_class).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def find_transport(soap_service):
+    """
+    :return: The transport of the zeep client used by the service, None if it can't be found
+    :rtype: zeep.transports.Transport | None
+    """
+    for client in [soap_service, getattr(soap_service, 'client', None)]:
+        transport = getattr(client, 'transport', None)
+        if transport is not None and hasattr(transport, 'session'):
+            return transport
+    return None
+
 
 class LicenseService(object):
 
-    def __init__(self, wsdl, username, password, tenant_reference_number):
+    def __init__(self, wsdl, username, password, tenant_reference_number, session=None, timeout=None,
+                 wsdl_cache=None, wsdl_cache_timeout=None):
+        """
+        :param session: Session keeping the connections to the soap service open, shared by all verify calls
+        :type session: requests.Session | None
+        :param timeout: Number of seconds to wait for the wsdl or a verify call
+        :type timeout: float | None
+        :param wsdl_cache: Path of an sqlite file caching the wsdl and schemas
+        :type wsdl_cache: str | None
+        :param wsdl_cache_timeout: Number of seconds the cached wsdl is used
+        :type wsdl_cache_timeout: int | None
+        """
+        self.session = session
+        self._soap = load_soap_classes()
+        kwargs = {}
+        transport_supported = accepts_transport(self._soap.MitekMobileVerifyService)
+        if transport_supported and (session is not None or wsdl_cache is not None):
+            transport_kwargs = {'session': session, 'operation_timeout': timeout}
+            if timeout is not None:
+                transport_kwargs['timeout'] = timeout
+            if wsdl_cache is not None:
+                transport_kwargs['cache'] = self._soap.SqliteCache(path=wsdl_cache, timeout=wsdl_cache_timeout)
+            kwargs['transport'] = self._soap.Transport(**transport_kwargs)
         # DoctorPlugin is needed to deserialize the response correctly
-        self.soap_service = MitekMobileVerifyService(wsdl, username, password, plugins=[DoctorPlugin()])
+        self.soap_service = self._soap.MitekMobileVerifyService(wsdl, username, password,
+                                                                plugins=[self._soap.DoctorPlugin()], **kwargs)
+        if not transport_supported:
+            self._configure_transport(session, timeout, wsdl_cache)
         self.tenant_reference_number = tenant_reference_number
         logger.info('Loaded LicenseService')
 
+    def _configure_transport(self, session, timeout, wsdl_cache):
+        """
+        Use the session and timeout with the transport the service created itself, the wsdl has already been loaded
+        """
+        if wsdl_cache is not None:
+            logger.warning('The mobile verify service does not take a transport, the wsdl cache is not used')
+        if session is None and timeout is None:
+            return
+        transport = find_transport(self.soap_service)
+        if transport is None:
+            logger.warning('No transport found on the mobile verify service, the session and timeout are not used')
+            return
+        if session is not None:
+            transport.session = session
+        if timeout is not None:
+            transport.load_timeout = timeout
+            transport.operation_timeout = timeout
+
     def create_headers(self, mibi_data=None):
-        web_req_metadata = WebRequestMetadataHeader(tenant_reference=self.tenant_reference_number)
-        device_metadata = DeviceMetaData()
-        mibi_data = MibiDataHeader(mibi_data=mibi_data)
+        web_req_metadata = self._soap.WebRequestMetadataHeader(tenant_reference=self.tenant_reference_number)
+        device_metadata = self._soap.DeviceMetaData()
+        mibi_data = self._soap.MibiDataHeader(mibi_data=mibi_data)
         return device_metadata, web_req_metadata, mibi_data
 
-    @staticmethod
-    def create_request(front_image_data, barcode_data):
-        req = PhotoVerifyRequest()
+    def create_request(self, front_image_data, barcode_data):
+        req = self._soap.PhotoVerifyRequest()
         req.back_image = req.create_image(hints=[{'PDF417': barcode_data}])
         req.front_image = req.create_image(image_data=front_image_data)
         return req
@@ -47,26 +131,35 @@ class LicenseService(object):
         logger.info('Returning response from soap service')
         return response
 
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+
+def create_session(pool_maxsize):
+    """
+    :param pool_maxsize: Maximum number of connections kept open to the soap service
+    :type pool_maxsize: int
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 
 # Hook for flask-registry extensions
 def setup_app(app):
-    app.yubico_states = OpStorageWrapper(app.config['DB_URI'], 'yubico_states')
+    app.yubico_states = init_storage(app.config, 'yubico_states')
+    app.yubico_states.ensure_indexes()
+    app.yubico_images = init_blob_storage(app.config, 'yubico_images')
+    app.yubico_images.ensure_indexes()
     app.mobile_verify_service_queue = init_mobile_verify_service_queue(app.config)
 
 
 def init_mobile_verify_service_queue(config):
-    if config.get('REDIS_SENTINEL_HOSTS') and config.get('REDIS_SENTINEL_SERVICE_NAME'):
-        _port = config['REDIS_PORT']
-        _hosts = config['REDIS_SENTINEL_HOSTS']
-        _name = config['REDIS_SENTINEL_SERVICE_NAME']
-        host_port = [(x, _port) for x in _hosts]
-        manager = sentinel.Sentinel(host_port, socket_timeout=0.1)
-        pool = sentinel.SentinelConnectionPool(_name, manager)
-    else:
-        pool = redis.ConnectionPool.from_url(config['REDIS_URI'])
-
-    connection = StrictRedis(connection_pool=pool)
-    return rq.Queue('mobile_verify_service_queue', connection=connection)
+    return rq.Queue('mobile_verify_service_queue', connection=redis_connections.get_connection(config))
 
 
 def parse_vetting_data(data):
@@ -80,7 +173,7 @@ def parse_vetting_data(data):
     vetting_data = json.loads(data)
     # The soap service wants the mibi data in a json string
     parsed_data['mibi_data'] = json.dumps(vetting_data['mibi'])
-    # The soap service wants to encode the image data so lets decode it here
-    parsed_data['front_image_data'] = base64.b64decode(vetting_data['encodedData'])
+    # The image is left base64 encoded, it is decoded when stored with BlobStorage.put_base64
+    parsed_data['encoded_front_image'] = vetting_data['encodedData']
     parsed_data['barcode_data'] = vetting_data['barcode']
     return parsed_data
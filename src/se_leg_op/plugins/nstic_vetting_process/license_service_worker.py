@@ -1,73 +1,205 @@
 # -*- coding: utf-8 -*-
+"""
+rq tasks of the nstic vetting process.
+
+Nothing is set up when the module is imported, the config, audit logging, storage and the license service are
+initialized once per process by the first job that needs them.
+"""
 
 import logging
+import logging.config
+import threading
 import time
 from flask.config import Config
 from requests.exceptions import ConnectionError
 
 from ...service.app import SE_LEG_PROVIDER_SETTINGS_ENVVAR
-from ...storage import OpStorageWrapper
-from .license_service import LicenseService
+from ...log_utils import LogPayload, init_logging, payload
+from ...storage import init_blob_storage, init_storage, mongo_clients
+from .license_service import LicenseService, create_session
 from .config import NSTIC_VETTING_PROCESS_AUDIT_LOG_FILE, NSTIC_VETTING_PROCESS_AUDIT_LOGGING
+from .config import MOBILE_VERIFY_CONCURRENCY, MOBILE_VERIFY_TIMEOUT, MOBILE_VERIFY_WSDL_CACHE_TIMEOUT
 
 __author__ = 'lundberg'
 
 logger = logging.getLogger(__name__)
 
-# Read conf
-config = Config('')
-config.from_envvar(SE_LEG_PROVIDER_SETTINGS_ENVVAR)
-wsdl = config['MOBILE_VERIFY_WSDL']
-username = config['MOBILE_VERIFY_USERNAME']
-password = config['MOBILE_VERIFY_PASSWORD']
-tenant_reference_number = config['MOBILE_VERIFY_TENANT_REF']
-
-# Set up audit logging
-audit_log_file = config.get('NSTIC_VETTING_PROCESS_AUDIT_LOG_FILE', NSTIC_VETTING_PROCESS_AUDIT_LOG_FILE)
-audit_log_config = config.get('NSTIC_VETTING_PROCESS_AUDIT_LOGGING', NSTIC_VETTING_PROCESS_AUDIT_LOGGING)
-try:
-    audit_log_config['handlers']['nstic_vetting_process_audit']['filename'] = audit_log_file
-except KeyError:
-    # The supplied logging config does not use a log file
-    pass
-logging.config.dictConfig(audit_log_config)
-audit_logger = logging.getLogger('nstic_vetting_process_audit')
-
-# Init service and db
-try:
-    license_service = LicenseService(wsdl, username, password, tenant_reference_number)
-except ConnectionError as e:
-    logger.error('Could not fetch wsdl.')
-    logger.error(e)
-    license_service = None
-users = OpStorageWrapper(config['DB_URI'], 'userinfo')
-
-
-def verify_license(auth_req, front_image_data, barcode, mibi_data):
-
-    response = license_service.verify(front_image_data, barcode, mibi_data)
-
-    logger.debug('Parsed response:')
-    logger.debug(response)
+# Number of seconds between removals of expired images
+IMAGE_PURGE_INTERVAL = 60 * 60
+
+
+class WorkerContext(object):
+    """
+    Everything the tasks need, set up from the provider config.
+    """
+
+    def __init__(self, config):
+        """
+        :param config: The provider config
+        :type config: flask.config.Config
+        """
+        self.config = config
+
+        # Set up audit logging
+        audit_log_file = config.get('NSTIC_VETTING_PROCESS_AUDIT_LOG_FILE', NSTIC_VETTING_PROCESS_AUDIT_LOG_FILE)
+        audit_log_config = config.get('NSTIC_VETTING_PROCESS_AUDIT_LOGGING', NSTIC_VETTING_PROCESS_AUDIT_LOGGING)
+        try:
+            audit_log_config['handlers']['nstic_vetting_process_audit']['filename'] = audit_log_file
+        except KeyError:
+            # The supplied logging config does not use a log file
+            pass
+        logging.config.dictConfig(audit_log_config)
+        self.audit_logger = logging.getLogger('nstic_vetting_process_audit')
+        # The jobs don't run in an app context
+        LogPayload.defaults = init_logging(config)
+
+        # Init db
+        mongo_clients.configure(config.get('MONGO_CLIENT_OPTIONS', {}))
+        self.users = init_storage(config, 'userinfo')
+        self.images = init_blob_storage(config, 'yubico_images')
+        self._images_purged_at = 0
+
+        self._license_service = None
+        self._license_service_lock = threading.Lock()
+
+    @property
+    def license_service(self):
+        """
+        The license service is created by the first job using it. If the wsdl can't be fetched the job fails and
+        the next job tries again.
+
+        :rtype: LicenseService
+        """
+        if self._license_service is None:
+            with self._license_service_lock:
+                if self._license_service is None:
+                    self._license_service = self._create_license_service()
+        return self._license_service
+
+    def _create_license_service(self):
+        config = self.config
+        try:
+            # The session is shared by all verify calls, also when they are made concurrently by the license
+            # verify worker
+            return LicenseService(config['MOBILE_VERIFY_WSDL'], config['MOBILE_VERIFY_USERNAME'],
+                                  config['MOBILE_VERIFY_PASSWORD'], config['MOBILE_VERIFY_TENANT_REF'],
+                                  session=create_session(config.get('MOBILE_VERIFY_CONCURRENCY',
+                                                                    MOBILE_VERIFY_CONCURRENCY)),
+                                  timeout=config.get('MOBILE_VERIFY_TIMEOUT', MOBILE_VERIFY_TIMEOUT),
+                                  wsdl_cache=config.get('MOBILE_VERIFY_WSDL_CACHE'),
+                                  wsdl_cache_timeout=config.get('MOBILE_VERIFY_WSDL_CACHE_TIMEOUT',
+                                                                MOBILE_VERIFY_WSDL_CACHE_TIMEOUT))
+        except ConnectionError as e:
+            logger.error('Could not fetch wsdl: %s', e)
+            raise
+
+    def purge_expired_images(self, interval=IMAGE_PURGE_INTERVAL):
+        """
+        Remove the images left behind by failed verifications, at most once per interval seconds.
+        """
+        now = time.monotonic()
+        if now - self._images_purged_at < interval:
+            return
+        self._images_purged_at = now
+        purged = self.images.purge_expired()
+        if purged:
+            logger.info('Removed %d expired images', purged)
+
+    def preload(self):
+        """
+        Create the license service now instead of in the first job.
+
+        :rtype: LicenseService | None
+        """
+        try:
+            return self.license_service
+        except ConnectionError:
+            # Already logged, the first job tries again
+            return None
+
+    def close(self):
+        if self._license_service is not None:
+            self._license_service.close()
+
+
+_context = None
+_context_lock = threading.Lock()
+
+
+def get_context():
+    """
+    :return: The worker context of the process, created from the config in SE_LEG_PROVIDER_SETTINGS on first use
+    :rtype: WorkerContext
+    """
+    global _context
+    if _context is None:
+        with _context_lock:
+            if _context is None:
+                config = Config('')
+                config.from_envvar(SE_LEG_PROVIDER_SETTINGS_ENVVAR)
+                _context = WorkerContext(config)
+    return _context
+
+
+def init_context(config):
+    """
+    Set up the worker context of the process from the given config, instead of the one in SE_LEG_PROVIDER_SETTINGS.
+
+    :param config: The provider config
+    :type config: flask.config.Config
+    :rtype: WorkerContext
+    """
+    global _context
+    with _context_lock:
+        _context = WorkerContext(config)
+    return _context
+
+
+def preload(config):
+    """
+    Worker pool preload hook, sets up the worker context from the pool's config and the license service before the
+    first job.
+    """
+    init_context(config).preload()
+
+
+def verify_license(auth_req, front_image, barcode, mibi_data):
+    """
+    :param front_image: Blob id of the front image in the yubico_images blob storage
+    :type front_image: str | bytes
+    """
+    context = get_context()
+    if isinstance(front_image, bytes):
+        # Jobs enqueued before the images were kept in the blob storage carry the image itself
+        front_image_data = front_image
+    else:
+        front_image_data = context.images[front_image]
+
+    response = context.license_service.verify(front_image_data, barcode, mibi_data)
+
+    logger.debug('Parsed response: %s', payload(response))
 
     audit_log_msg = 'License verification of state {} returned with status {} and a confidence score of {}. Transaction reference id: {}.'.format(
         auth_req['state'], response['body']['Response']['Status'],
         response['body']['Response']['ComparisonResult']['DataMatchScore'],
         response['header']['Metadata']['TransactionReferenceId'],
     )
-    audit_logger.info(audit_log_msg)
+    context.audit_logger.info(audit_log_msg)
 
     if not response['body']['Response']['Errors'] is None:
-        logger.error('Verify license failed:')
-        logger.error(response['body']['Response']['Errors'])
+        logger.error('Verify license failed: %s', payload(response['body']['Response']['Errors']))
 
     # Successful response received, save the verification response
     user_id = auth_req['user_id']
-    userinfo = users[user_id]
     data = {
         'status': response['body']['Response']['Status'],
         'extracted_data': response['body']['Response']['ExtractedData'],
         'data_match_score': response['body']['Response']['ComparisonResult']['DataMatchScore']
     }
-    userinfo['vetting_result'] = {'vetting_time': time.time(), 'data': data}
-    users[user_id] = userinfo
+    context.users.update_fields(user_id, {'vetting_result': {'vetting_time': time.time(), 'data': data}})
+
+    # The image is kept until the verification has been saved so that a failed job can be retried, images of jobs
+    # that are never retried expire
+    if not isinstance(front_image, bytes):
+        del context.images[front_image]
+    context.purge_expired_images()
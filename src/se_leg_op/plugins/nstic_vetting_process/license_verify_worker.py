@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Verify licenses concurrently in a single process, keeping the connections to the mobile verify service open
+between jobs.
+
+Usage: SE_LEG_PROVIDER_SETTINGS=/op/etc/app_config.py \
+    python -m se_leg_op.plugins.nstic_vetting_process.license_verify_worker [--burst]
+"""
+
+import argparse
+import logging
+import signal
+import sys
+
+from flask.config import Config
+
+from ...service.app import SE_LEG_PROVIDER_SETTINGS_ENVVAR
+from ...service.job_worker import ConcurrentWorker
+from . import license_service_worker
+from .config import MOBILE_VERIFY_CONCURRENCY
+from .license_service import init_mobile_verify_service_queue
+
+__author__ = 'lundberg'
+
+
+def init_license_verify_worker(config):
+    """
+    :param config: The provider config
+    :type config: flask.config.Config
+    :rtype: ConcurrentWorker
+    """
+    queue = init_mobile_verify_service_queue(config)
+    return ConcurrentWorker([queue], queue.connection,
+                            max_workers=config.get('MOBILE_VERIFY_CONCURRENCY', MOBILE_VERIFY_CONCURRENCY))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Verify licenses.')
+    parser.add_argument('--burst', action='store_true', help='exit when the queue is empty')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    config = Config('')
+    config.from_envvar(SE_LEG_PROVIDER_SETTINGS_ENVVAR)
+
+    context = license_service_worker.init_context(config)
+    context.preload()
+    worker = init_license_verify_worker(config)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    try:
+        worker.work(burst=args.burst)
+    except KeyboardInterrupt:
+        worker.stop()
+    finally:
+        context.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from flask import Blueprint, json, current_app, request, abort
+from flask import Blueprint, json, current_app, request, abort, stream_with_context
 from time import time
 from functools import wraps
+from base64 import urlsafe_b64encode, b64decode
+from binascii import Error as BinasciiError
+
+from se_leg_op.log_utils import payload
+from se_leg_op.service.rate_limit import check_rate_limit
+from ..api_auth import get_authenticator
 
 
 __author__ = 'lundberg'
@@ -15,23 +21,13 @@ def authorize(f):
     def decorated_function(*args, **kwargs):
         if request.authorization:
             username = request.authorization['username']
-            password = request.authorization['password']
-            current_app.logger.info('Trying to authorize {}'.format(username))
-            try:
-                secret = False
-                if username in current_app.config['YUBICO_API_CLIENTS']:
-                    client = current_app.provider.clients[username]
-                    secret = client['client_secret']
-                    kwargs['username'] = username
-                elif username in current_app.config['YUBICO_API_ADMINS']:
-                    admin = current_app.config['YUBICO_API_ADMINS'][username]
-                    secret = admin['secret']
-                    kwargs['username'] = 'admin'
-                if secret and secret == password:
-                    return f(*args, **kwargs)
-                current_app.logger.error('Authorization failure: Wrong password for {}'.format(username))
-            except KeyError as e:
-                current_app.logger.error('Authorization failure: KeyError {}'.format(e))
+            principal = get_authenticator().authenticate(username, request.authorization['password'])
+            if principal is not None:
+                over_limit_response = check_rate_limit(username)
+                if over_limit_response:
+                    return over_limit_response
+                kwargs['username'] = principal
+                return f(*args, **kwargs)
         abort(401)
     return decorated_function
 
@@ -45,6 +41,92 @@ def create_json_response(data, status=200):
     return response
 
 
+def encode_cursor(state_id):
+    """
+    :param state_id: Id of the last state on a page
+    :type state_id: str
+    :return: Opaque cursor
+    :rtype: str
+    """
+    return urlsafe_b64encode(state_id.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    :param cursor: Opaque cursor
+    :type cursor: str
+    :return: Id of the last state on the previous page
+    :rtype: str
+    :raise ValueError: The cursor is malformed
+    """
+    try:
+        state_id = b64decode(cursor.encode('ascii'), altchars=b'-_', validate=True).decode('utf-8')
+    except (BinasciiError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    if not state_id:
+        raise ValueError('Invalid cursor')
+    return state_id
+
+
+def parse_limit(limit):
+    """
+    :param limit: Requested page size
+    :type limit: str | None
+    :return: Page size, 0 means no limit
+    :rtype: int
+    :raise ValueError: The limit is not a positive integer
+    """
+    if limit is None:
+        return 0
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValueError('Invalid limit')
+    if limit < 1:
+        raise ValueError('Invalid limit')
+    return limit
+
+
+def stream_states(states, limit):
+    """
+    :param states: Iterator of lookup_key, state tuples sorted by lookup_key
+    :type states: collections.Iterator
+    :param limit: Page size, 0 means no limit
+    :type limit: int
+    :return: JSON chunks
+    :rtype: collections.Iterator[str]
+
+    Generates a JSON states listing without holding more than one batch of states in memory.
+    """
+    batch_size = current_app.config['YUBICO_API_STATES_BATCH_SIZE']
+    count = 0
+    last_state_id = None
+    has_more = False
+    yield '{"states": ['
+    while True:
+        batch = []
+        for key, state in states:
+            if limit and count + len(batch) == limit:
+                has_more = True
+                break
+            batch.append(state)
+            if len(batch) == batch_size:
+                break
+        if not batch:
+            break
+        add_userinfo(batch)
+        for state in batch:
+            yield (', ' if count else '') + json.dumps(state)
+            count += 1
+        last_state_id = batch[-1]['state']
+        if has_more:
+            break
+    yield ']'
+    if has_more:
+        yield ', "next": {}'.format(json.dumps(encode_cursor(last_state_id)))
+    yield '}'
+
+
 def create_db_state(state_id, data):
     """
     :param state_id: State id
@@ -66,22 +148,48 @@ def create_db_state(state_id, data):
     current_app.yubico_states[state['state']] = state
 
 
+def state_changes(data):
+    """
+    :param data: Incoming state data
+    :type data: dict
+    :return: The state fields the client is allowed to change
+    :rtype: dict
+    """
+    # Don't let the client change the original keys
+    # userinfo is not part of the state document in the db
+    read_only_keys = ['created', 'state', 'client_id', 'user_id', 'userinfo']
+    return dict((key, value) for key, value in data.items() if key not in read_only_keys)
+
+
 def update_db_state(state, data):
     """
     :param state: State from db
     :type state: dict
     :param data: Incoming state data
     :type data: dict
+    :raise ValueError: A field name is not allowed
     """
-    # Don't let the client change the original keys
-    # userinfo is not part of the state document in the db
-    for ro_key in ['created', 'state', 'client_id', 'user_id', 'userinfo']:
-        data.pop(ro_key, None)
-    # Update state
+    data = state_changes(data)
+    # Update only the changed fields of the state
     if data:
+        current_app.yubico_states.update_fields(state['state'], data)
         state.update(data)
-        # Save state
-        current_app.yubico_states[state['state']] = state
+
+
+def add_userinfo(states):
+    """
+    :param states: States from db
+    :type states: list
+
+    Adds the userinfo for each state using a single lookup in the userinfo db.
+    """
+    userinfos = current_app.users.get_many(state.get('user_id') for state in states)
+    for state in states:
+        user_id = state.get('user_id')
+        userinfo = userinfos.get(user_id)
+        if userinfo is None:
+            current_app.logger.warning('userinfo %s missing for state %s', user_id, state['state'])
+        state['userinfo'] = userinfo
 
 
 def update_db_userinfo(user_id, data):
@@ -90,60 +198,55 @@ def update_db_userinfo(user_id, data):
     :type user_id: str
     :param data: data to update userinfo with
     :type data: dict
+    :raise KeyError: There is no userinfo for the user
+    :raise ValueError: A field name is not allowed
     """
     if data:
-        userinfo = current_app.users[user_id]
-        userinfo.update(data)
-        current_app.users[user_id] = userinfo
+        current_app.users.update_fields(user_id, data)
 
 
 @yubico_api_v1_views.route('/states', methods=['GET'])
 @authorize
 def get_states(username):
-    current_app.logger.info('Client {} requested vetting states'.format(username))
-    result = {'states': []}
-    i = 0
-
-    if username == 'admin':
-        # Allow all states for admin
-        states = current_app.yubico_states.items()
-    else:
-        states = current_app.yubico_states.get_documents_by_attr('data.client_id', username, False)
-
-    for key, state in states:
-        i += 1
-        user_id = state.get('user_id')
-        try:
-            userinfo = current_app.users[user_id]
-        except KeyError:
-            current_app.logger.warning('userinfo {} missing for state {}'.format(user_id, state['state']))
-            userinfo = None
-        state['userinfo'] = userinfo
-        result['states'].append(state)
-    current_app.logger.debug('Returned {} vetting states for client {}'.format(i, username))
-    return create_json_response(result)
+    current_app.logger.info('Client %s requested vetting states', username)
+    try:
+        limit = parse_limit(request.args.get('limit'))
+        after = request.args.get('after')
+        if after is not None:
+            after = decode_cursor(after)
+    except ValueError as e:
+        return create_json_response({'status': 'Bad Request', 'error': '{}'.format(e)}, status=400)
+
+    spec = {}
+    if username != 'admin':
+        # Only allow the clients own states, admin is allowed all states
+        spec['data.client_id'] = username
+    if after is not None:
+        spec['lookup_key'] = {'$gt': after}
+    # Fetch one more state than requested to know if there is a next page
+    batch_size = current_app.config['YUBICO_API_STATES_BATCH_SIZE']
+    states = current_app.yubico_states.get_documents_by_filter(spec, fields={'data': True}, raise_on_missing=False,
+                                                               sort=[('lookup_key', 1)],
+                                                               limit=limit + 1 if limit else 0,
+                                                               batch_size=batch_size)
+    return current_app.response_class(response=stream_with_context(stream_states(states, limit)),
+                                      mimetype='application/json')
 
 
 @yubico_api_v1_views.route('/states/<string:state_id>', methods=['GET'])
 @authorize
 def get_state(username, state_id):
-    current_app.logger.info('Client {} requested vetting state {}'.format(username, state_id))
+    current_app.logger.info('Client %s requested vetting state %s', username, state_id)
     try:
         state = current_app.yubico_states[state_id]
         # Check if the client is allowed to fetch the state
         if username != 'admin' and username != state['client_id']:
             raise KeyError
     except KeyError:
-        current_app.logger.warning('Client {} tried to get unknown state {}'.format(username, state_id))
+        current_app.logger.warning('Client %s tried to get unknown state %s', username, state_id)
         return create_json_response({'status': 'Not Found', 'errors': [state_id]}, 404)
 
-    user_id = state.get('user_id')
-    try:
-        userinfo = current_app.users[user_id]
-    except KeyError:
-        current_app.logger.warning('userinfo {} missing for state {}'.format(user_id, state['state']))
-        userinfo = None
-    state['userinfo'] = userinfo
+    add_userinfo([state])
     return create_json_response(state)
 
 
@@ -153,30 +256,57 @@ def update_states(username):
     data = request.get_json()
     if not data:
         return create_json_response({'status': 'Bad Request', 'error': 'No data'}, status=400)
-    current_app.logger.debug('data: {}'.format(data))
-
-    if username == 'admin':
-        # Allow all states for admin
-        states = dict(current_app.yubico_states.items())
-    else:
-        states = dict(current_app.yubico_states.get_documents_by_attr('data.client_id', username, False))
+    current_app.logger.debug('data: %s', payload(data))
 
-    errors = []
     try:
-        for item in data['states']:
-            # Only let the client modify it's own states
-            if item['state'] not in states:
-                errors.append(item['state'])
-                continue
-            state = states[item['state']]
-            update_db_userinfo(state['user_id'], item.get('userinfo', dict()))
-            update_db_state(state, item)
-        current_app.logger.info('Client {} updated states'.format(username))
+        items = data['states']
+        state_ids = [item['state'] for item in items]
     except KeyError as e:
-        current_app.logger.error('{}'.format(e))
+        current_app.logger.error('Missing key in states update: %s', e)
         return create_json_response({'status': 'Bad Request', 'error': '{}'.format(e)}, status=400)
+
+    # Only fetch the states to update
+    spec = {'lookup_key': {'$in': state_ids}}
+    if username != 'admin':
+        # Only let the client modify it's own states, admin is allowed all states
+        spec['data.client_id'] = username
+    states = dict(current_app.yubico_states.get_documents_by_filter(spec, fields={'data': True},
+                                                                    raise_on_missing=False))
+    # Only the users whose userinfo is updated need to exist
+    user_ids = [states[item['state']].get('user_id') for item in items
+                if item.get('userinfo') and item['state'] in states]
+    existing_user_ids = current_app.users.existing_keys(user_id for user_id in user_ids if user_id)
+
+    errors = []
+    updates = []
+    for item in items:
+        state = states.get(item['state'])
+        userinfo = item.get('userinfo') or {}
+        if state is None or (userinfo and state.get('user_id') not in existing_user_ids):
+            errors.append(item['state'])
+            continue
+        updates.append((item['state'], state.get('user_id'), userinfo, state_changes(item)))
+
+    # Update userinfo first and leave the state as it is if that fails, like when updating a single state
+    userinfo_updates = [(user_id, userinfo) for state_id, user_id, userinfo, changes in updates if userinfo]
+    failed_user_ids = set()
+    for position, error in current_app.users.bulk_update_fields(userinfo_updates).items():
+        user_id = userinfo_updates[position][0]
+        current_app.logger.error('Failed to update userinfo %s: %s', user_id, error)
+        failed_user_ids.add(user_id)
+    state_updates = []
+    for state_id, user_id, userinfo, changes in updates:
+        if user_id in failed_user_ids:
+            errors.append(state_id)
+        elif changes:
+            state_updates.append((state_id, changes))
+    for position, error in current_app.yubico_states.bulk_update_fields(state_updates).items():
+        state_id = state_updates[position][0]
+        current_app.logger.error('Failed to update state %s: %s', state_id, error)
+        errors.append(state_id)
+    current_app.logger.info('Client %s updated %d of %d states', username, len(items) - len(errors), len(items))
     if errors:
-        current_app.logger.warning('Client {} tried to update unknown states {}'.format(username, errors))
+        current_app.logger.warning('Client %s could not update states %s', username, payload(errors))
         return create_json_response({'status': 'Unprocessable Entity', 'errors': errors}, 422)
     return create_json_response({'status': 'Accepted'}, 202)
 
@@ -189,16 +319,19 @@ def update_state(username, state_id):
         state = current_app.yubico_states[state_id]
         # Check if the client is allowed to update the state
         if username != 'admin' and username != state['client_id']:
-            current_app.logger.warning('Client {} tried to update unknown state {}'.format(username, state_id))
+            current_app.logger.warning('Client %s tried to update unknown state %s', username, state_id)
             return create_json_response({'status': 'Not Found', 'errors': [state_id]}, 404)
     except KeyError:
         # Create new state
         create_db_state(state_id, data)
         return create_json_response({'status': 'Created'}, 201)
     # Update state and userinfo
-    update_db_userinfo(state['user_id'], data.get('userinfo', dict()))
-    update_db_state(state, data)
-    current_app.logger.info('Client {} updated vetting state {}'.format(username, state_id))
+    try:
+        update_db_userinfo(state['user_id'], data.get('userinfo', dict()))
+        update_db_state(state, data)
+    except ValueError as e:
+        return create_json_response({'status': 'Bad Request', 'error': '{}'.format(e)}, status=400)
+    current_app.logger.info('Client %s updated vetting state %s', username, state_id)
     return create_json_response({'status': 'Accepted'}, 202)
 
 
@@ -211,7 +344,7 @@ def delete_state(username, state_id):
         if username != 'admin' and username != state['client_id']:
             raise KeyError
     except KeyError:
-        current_app.logger.warning('Client {} tried to delete unknown state {}'.format(username, state_id))
+        current_app.logger.warning('Client %s tried to delete unknown state %s', username, state_id)
         return create_json_response({'status': 'Not Found', 'errors': [state_id]}, 404)
     del current_app.users[state['user_id']]
     del current_app.yubico_states[state_id]
@@ -8,12 +8,15 @@ from oic.oic.message import AuthorizationRequest
 from urllib import parse as urllib_parse
 from time import time
 
+from se_leg_op.log_utils import payload
 from se_leg_op.service.vetting_process_tools import parse_qrdata, InvalidQrDataError
 from ..license_service import parse_vetting_data
-from ..license_service_worker import verify_license
 
 __author__ = 'lundberg'
 
+# Referenced by name, importing the worker module loads the soap service
+VERIFY_LICENSE_TASK = 'se_leg_op.plugins.nstic_vetting_process.license_service_worker.verify_license'
+
 yubico_vetting_process_views = Blueprint('yubico_vetting_process', __name__, url_prefix='/yubico')
 
 
@@ -33,26 +36,26 @@ def vetting_result():
     if not auth_req_data:
         # XXX: Short circuit vetting process for special nonce during development
         if qrdata['nonce'] in current_app.config.get('TEST_NONCE', []):
-            current_app.logger.debug('Found test nonce {}'.format(qrdata['nonce']))
+            current_app.logger.debug('Found test nonce %s', qrdata['nonce'])
             return development_license_check(data)
         # XXX: End remove later
-        current_app.logger.debug('Received unknown nonce \'{}\''.format(qrdata['nonce']))
+        current_app.logger.debug('Received unknown nonce \'%s\'', qrdata['nonce'])
         return make_response('Unknown nonce', 400)
 
     auth_req = AuthorizationRequest(**auth_req_data)
     user_id = auth_req['user_id']
 
     try:
-        current_app.logger.debug('Vetting data received: {}'.format(data))
         # Check vetting data received
         parsed_data = parse_vetting_data(data)
-        current_app.logger.debug('Vetting data parsed: {!r}'.format(parsed_data))
+        current_app.logger.debug('Vetting data parsed: %s', payload(parsed_data))
+        # Only a reference to the image is put on the queue
+        front_image_id = current_app.yubico_images.put_base64(parsed_data['encoded_front_image'])
     except ValueError as e:
-        current_app.logger.error('Received malformed vetting data \'{}\''.format(data))
-        current_app.logger.error(e)
+        current_app.logger.error('Received malformed vetting data \'%s\': %s', payload(data), e)
         return make_response('Malformed vetting data', 400)
     except KeyError as e:
-        current_app.logger.error('Missing vetting data: \'{}\''.format(e))
+        current_app.logger.error('Missing vetting data: \'%s\'', e)
         return make_response('Missing vetting data: {}'.format(e), 400)
 
     # Save information needed for the next vetting step that uses the api
@@ -71,7 +74,7 @@ def vetting_result():
     current_app.yubico_states[auth_req['state']] = yubico_state
 
     # Add soap license check to queue
-    current_app.mobile_verify_service_queue.enqueue(verify_license, auth_req.to_dict(), parsed_data['front_image_data'],
+    current_app.mobile_verify_service_queue.enqueue(VERIFY_LICENSE_TASK, auth_req.to_dict(), front_image_id,
                                                     parsed_data['barcode_data'], parsed_data['mibi_data'])
 
     return make_response('OK', 200)
@@ -80,16 +83,14 @@ def vetting_result():
 # XXX: Remove after development
 def development_license_check(data):
     # TODO: What do we want to do here?
-    current_app.logger.debug('Test data received: {}'.format(data))
     try:
         parsed_data = parse_vetting_data(data)
-        current_app.logger.debug('Test data json parsed: {!r}'.format(parsed_data))
+        current_app.logger.debug('Test data json parsed: %s', payload(parsed_data))
     except ValueError as e:
-        current_app.logger.error('Received malformed json:')
-        current_app.logger.error(e)
+        current_app.logger.error('Received malformed json \'%s\': %s', payload(data), e)
         return make_response('Malformed json data', 400)
     except KeyError as e:
-        current_app.logger.error('Missing vetting data: \'{}\''.format(e))
+        current_app.logger.error('Missing vetting data: \'%s\'', e)
         return make_response('Missing vetting data: {}'.format(e), 400)
     return make_response('OK', 200)
 # XXX: End remove
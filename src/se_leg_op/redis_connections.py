@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+from redis import ConnectionPool, StrictRedis
+from redis._compat import nativestr
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.sentinel import Sentinel, SentinelConnectionPool
+
+logger = logging.getLogger(__name__)
+
+
+class HealthCheckPoolMixin(object):
+    """
+    Pings connections that have been idle in the pool for more than health_check_interval seconds before handing
+    them out, so that connections closed by the server or a failover are replaced before a command fails on them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.health_check_interval = kwargs.pop('health_check_interval', 0)
+        self.health_check_failures = 0
+        super(HealthCheckPoolMixin, self).__init__(*args, **kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        connection = super(HealthCheckPoolMixin, self).get_connection(command_name, *keys, **options)
+        released_at = getattr(connection, 'released_at', None)
+        if (self.health_check_interval and connection._sock is not None and released_at is not None and
+                time.monotonic() - released_at > self.health_check_interval):
+            try:
+                connection.send_command('PING')
+                if nativestr(connection.read_response()) != 'PONG':
+                    raise ConnectionError('Unexpected response to PING')
+            except (ConnectionError, TimeoutError):
+                # The connection reconnects on the next command
+                self.health_check_failures += 1
+                connection.disconnect()
+        return connection
+
+    def release(self, connection):
+        connection.released_at = time.monotonic()
+        super(HealthCheckPoolMixin, self).release(connection)
+
+    def stats(self):
+        """
+        :return: Number of connections created, available and in use
+        :rtype: dict
+        """
+        return {
+            'max_connections': self.max_connections,
+            'created_connections': self._created_connections,
+            'available_connections': len(self._available_connections),
+            'in_use_connections': len(self._in_use_connections),
+            'health_check_failures': self.health_check_failures,
+        }
+
+
+class HealthCheckConnectionPool(HealthCheckPoolMixin, ConnectionPool):
+    pass
+
+
+class HealthCheckSentinelConnectionPool(HealthCheckPoolMixin, SentinelConnectionPool):
+    pass
+
+
+class RedisConnectionRegistry(object):
+    """
+    Process wide registry of Redis connections, shared by all queues, caches and rate limiters so that every process
+    only holds a single connection pool per Redis deployment.
+
+    Configured from the app config:
+      REDIS_URI, or REDIS_SENTINEL_HOSTS, REDIS_SENTINEL_SERVICE_NAME and REDIS_PORT
+      REDIS_MAX_CONNECTIONS: maximum number of connections in the pool
+      REDIS_SOCKET_TIMEOUT, REDIS_SOCKET_CONNECT_TIMEOUT: seconds, default no timeout
+      REDIS_SENTINEL_SOCKET_TIMEOUT: seconds, timeout of the requests to the sentinels, default 0.1
+      REDIS_HEALTH_CHECK_INTERVAL: seconds a connection may be idle before it is checked, default 30, 0 disables
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    @staticmethod
+    def _pool_options(config):
+        return {
+            'max_connections': config.get('REDIS_MAX_CONNECTIONS'),
+            'socket_timeout': config.get('REDIS_SOCKET_TIMEOUT'),
+            'socket_connect_timeout': config.get('REDIS_SOCKET_CONNECT_TIMEOUT'),
+            'health_check_interval': config.get('REDIS_HEALTH_CHECK_INTERVAL', 30),
+        }
+
+    def get_connection(self, config):
+        """
+        :param config: The app config
+        :type config: dict
+        :return: The shared connection for the configured Redis deployment
+        :rtype: redis.StrictRedis
+        """
+        if config.get('REDIS_SENTINEL_HOSTS') and config.get('REDIS_SENTINEL_SERVICE_NAME'):
+            key = (tuple(config['REDIS_SENTINEL_HOSTS']), config['REDIS_PORT'], config['REDIS_SENTINEL_SERVICE_NAME'])
+        else:
+            key = config['REDIS_URI']
+        with self._lock:
+            if key not in self._connections:
+                self._connections[key] = StrictRedis(connection_pool=self._create_pool(config))
+            return self._connections[key]
+
+    def _create_pool(self, config):
+        options = self._pool_options(config)
+        if config.get('REDIS_SENTINEL_HOSTS') and config.get('REDIS_SENTINEL_SERVICE_NAME'):
+            _port = config['REDIS_PORT']
+            host_port = [(x, _port) for x in config['REDIS_SENTINEL_HOSTS']]
+            manager = Sentinel(host_port, socket_timeout=config.get('REDIS_SENTINEL_SOCKET_TIMEOUT', 0.1))
+            return HealthCheckSentinelConnectionPool(config['REDIS_SENTINEL_SERVICE_NAME'], manager, **options)
+        return HealthCheckConnectionPool.from_url(config['REDIS_URI'], **options)
+
+    def stats(self):
+        """
+        :return: Pool statistics per connection pool
+        :rtype: dict
+        """
+        with self._lock:
+            return dict((repr(connection.connection_pool), connection.connection_pool.stats())
+                        for connection in self._connections.values())
+
+
+redis_connections = RedisConnectionRegistry()
@@ -1,19 +1,22 @@
-import redis
-import redis.sentinel
 import rq
 from flask.app import Flask
 from flask.helpers import url_for
-from jwkest.jwk import RSAKey, import_rsa_key
 from pyop.authz_state import AuthorizationState
 from pyop.exceptions import InvalidAuthenticationRequest
 from pyop.provider import Provider
 from pyop.subject_identifier import HashBasedSubjectIdentifierFactory
 from pyop.userinfo import Userinfo
-from redis.client import StrictRedis
 from flask_registry import BlueprintAutoDiscoveryRegistry, ConfigurationRegistry, ExtensionRegistry
 from flask_registry import PackageRegistry, Registry
 
-from ..storage import OpStorageWrapper
+from ..cache import CachedStorage, RedisCacheInvalidator, TTLCache
+from ..log_utils import init_logging
+from ..redis_connections import redis_connections
+from ..storage import init_storage, mongo_clients
+from .cached_responses import CachedJSONResponse
+from .rate_limit import RateLimiter
+from .signing_keys import SigningKeyManager
+from .startup_profile import StartupProfile
 
 SE_LEG_PROVIDER_SETTINGS_ENVVAR = 'SE_LEG_PROVIDER_SETTINGS'
 
@@ -26,14 +29,30 @@ def _request_contains_nonce(authentication_request):
 
 def init_authorization_state(app):
     sub_hash_salt = app.config['PROVIDER_SUBJECT_IDENTIFIER_HASH_SALT']
-    authz_code_db = OpStorageWrapper(app.config['DB_URI'], 'authz_codes')
-    access_token_db = OpStorageWrapper(app.config['DB_URI'], 'access_tokens')
-    refresh_token_db = OpStorageWrapper(app.config['DB_URI'], 'refresh_tokens')
-    sub_db = OpStorageWrapper(app.config['DB_URI'], 'subject_identifiers')
+    authz_code_db = init_storage(app.config, 'authz_codes')
+    access_token_db = init_storage(app.config, 'access_tokens')
+    refresh_token_db = init_storage(app.config, 'refresh_tokens')
+    sub_db = init_storage(app.config, 'subject_identifiers')
     return AuthorizationState(HashBasedSubjectIdentifierFactory(sub_hash_salt), authz_code_db, access_token_db,
                               refresh_token_db, sub_db, refresh_token_lifetime=60 * 60 * 24 * 365)
 
 
+def init_clients_db(app):
+    """
+    Client registrations are read on every authentication, token and Yubico API request but rarely change, keep them
+    in a local cache that is invalidated in all processes on changes.
+    """
+    clients_db = init_storage(app.config, 'clients')
+    ttl = app.config.get('CLIENTS_CACHE_TTL', 60)
+    if not ttl:
+        return clients_db
+    cache = TTLCache(app.config.get('CLIENTS_CACHE_MAX_SIZE', 1000), ttl)
+    channel = app.config.get('CLIENTS_CACHE_INVALIDATION_CHANNEL', 'se_leg_op:clients:invalidate')
+    # The invalidation listener is started on first use, after any fork of the app
+    invalidator = RedisCacheInvalidator(redis_connections.get_connection(app.config), channel, cache)
+    return CachedStorage(clients_db, cache, invalidator)
+
+
 def init_oidc_provider(app):
     with app.app_context():
         issuer = url_for('oidc_provider.index')[:-1]
@@ -57,55 +76,86 @@ def init_oidc_provider(app):
         'claims_parameter_supported': True
     }
 
-    clients_db = OpStorageWrapper(app.config['DB_URI'], 'clients')
+    clients_db = init_clients_db(app)
     userinfo_db = Userinfo(app.users)
-    with open(app.config['PROVIDER_SIGNING_KEY']['PATH']) as f:
-        key = f.read()
-    signing_key = RSAKey(key=import_rsa_key(key), kid=app.config['PROVIDER_SIGNING_KEY']['KID'], alg='RS256')
-    provider = Provider(signing_key, configuration_information, init_authorization_state(app), clients_db, userinfo_db)
+    # New keys are only used for signing once relying parties have had time to fetch them from the JWKS
+    app.signing_keys = SigningKeyManager(app.config['PROVIDER_SIGNING_KEY'],
+                                         publish_delay=app.config.get('PROVIDER_METADATA_MAX_AGE', 600))
+    provider = Provider(app.signing_keys.signing_key, configuration_information, init_authorization_state(app),
+                        clients_db, userinfo_db)
 
     provider.authentication_request_validators.append(_request_contains_nonce)
 
     return provider
 
 
-def init_authn_response_queue(config):
-    if config.get('REDIS_SENTINEL_HOSTS') and config.get('REDIS_SENTINEL_SERVICE_NAME'):
-        _port = config['REDIS_PORT']
-        _hosts = config['REDIS_SENTINEL_HOSTS']
-        _name = config['REDIS_SENTINEL_SERVICE_NAME']
-        host_port = [(x, _port) for x in _hosts]
-        manager = redis.sentinel.Sentinel(host_port, socket_timeout=0.1)
-        pool = redis.sentinel.SentinelConnectionPool(_name, manager)
-    else:
-        pool = redis.ConnectionPool.from_url(config['REDIS_URI'])
+def init_db_indexes(app):
+    """
+    Ensure the indexes of all collections used by the provider.
+    """
+    authz_state = app.provider.authz_state
+    for db in [app.authn_requests, app.users, app.provider.clients, authz_state.authorization_codes,
+               authz_state.access_tokens, authz_state.refresh_tokens, authz_state.subject_identifiers]:
+        db.ensure_indexes()
+
+
+def signing_keys_changed(app):
+    app.provider.signing_key = app.signing_keys.signing_key
+    app.jwks_response.refresh()
 
-    connection = StrictRedis(connection_pool=pool)
-    return rq.Queue('authn_responses', connection=connection)
+
+def init_authn_response_queue(config):
+    return rq.Queue('authn_responses', connection=redis_connections.get_connection(config))
 
 
 def oidc_provider_init_app(name=None, config=None):
     name = name or __name__
+    profile = StartupProfile()
     app = Flask(name)
-    app.config.from_envvar(SE_LEG_PROVIDER_SETTINGS_ENVVAR)
-    if config:
-        app.config.update(config)
-
-    # Initialize registry for plugin handling
+    with profile.phase('config'):
+        app.config.from_envvar(SE_LEG_PROVIDER_SETTINGS_ENVVAR)
+        if config:
+            app.config.update(config)
+        app.log_payload_settings = init_logging(app.config)
+        mongo_clients.configure(app.config.get('MONGO_CLIENT_OPTIONS', {}))
+
+    # Initialize registry for plugin handling, only the plugins in PACKAGES and EXTENSIONS are imported
     r = Registry(app=app)
-    r['packages'] = PackageRegistry(app)
-    r['extensions'] = ExtensionRegistry(app)
-    r['config'] = ConfigurationRegistry(app)
-    r['blueprints'] = BlueprintAutoDiscoveryRegistry(app=app)
-
-    app.authn_requests = OpStorageWrapper(app.config['DB_URI'], 'authn_requests')
-    app.users = OpStorageWrapper(app.config['DB_URI'], 'userinfo')
-    app.authn_response_queue = init_authn_response_queue(app.config)
+    with profile.phase('plugin packages'):
+        r['packages'] = PackageRegistry(app)
+    with profile.phase('plugin extensions'):
+        r['extensions'] = ExtensionRegistry(app)
+    with profile.phase('plugin config'):
+        r['config'] = ConfigurationRegistry(app)
+    with profile.phase('plugin blueprints'):
+        r['blueprints'] = BlueprintAutoDiscoveryRegistry(app=app)
+
+    with profile.phase('storage'):
+        app.authn_requests = init_storage(app.config, 'authn_requests')
+        app.users = init_storage(app.config, 'userinfo')
+    with profile.phase('redis'):
+        app.authn_response_queue = init_authn_response_queue(app.config)
+        app.rate_limiter = RateLimiter(redis_connections.get_connection(app.config))
 
     from .views.oidc_provider import oidc_provider_views
     app.register_blueprint(oidc_provider_views)
 
     # Initialize the oidc_provider after views to be able to set correct urls
-    app.provider = init_oidc_provider(app)
-
+    with profile.phase('provider'):
+        app.provider = init_oidc_provider(app)
+    with profile.phase('db indexes'):
+        init_db_indexes(app)
+
+    # Relying parties poll these documents, serialize them once
+    max_age = app.config.get('PROVIDER_METADATA_MAX_AGE', 600)
+    app.provider_configuration_response = CachedJSONResponse(
+        lambda: app.provider.provider_configuration.to_dict(), max_age)
+    app.jwks_response = CachedJSONResponse(lambda: app.signing_keys.jwks, max_age)
+
+    # Pick up rotated signing keys without restarting
+    app.signing_keys.listeners.append(lambda signing_keys: signing_keys_changed(app))
+    app.before_request(app.signing_keys.maybe_reload)
+
+    profile.report(name)
+    app.startup_profile = profile.to_dict()
     return app
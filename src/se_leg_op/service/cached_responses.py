@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+
+from flask import current_app
+
+
+class CachedJSONResponse(object):
+    """
+    A JSON document serialized once, served with a strong ETag and Cache-Control max-age. Call refresh when the
+    source document has changed.
+    """
+
+    def __init__(self, source, max_age):
+        """
+        :param source: Returns the document to serialize
+        :type source: callable
+        :param max_age: Number of seconds clients may cache the document
+        :type max_age: int
+        """
+        self._source = source
+        self.max_age = max_age
+        self._state = None
+        self.refresh()
+
+    @property
+    def etag(self):
+        return self._state[1]
+
+    def refresh(self):
+        """
+        Serialize the source document again.
+        """
+        body = json.dumps(self._source(), sort_keys=True).encode('utf-8')
+        # Replace body and etag with a single assignment so concurrent requests never see a mix of old and new
+        self._state = (body, hashlib.sha256(body).hexdigest())
+
+    def make_response(self, request):
+        """
+        :param request: The incoming request
+        :type request: flask.Request
+        :return: The document, or 304 Not Modified if the client has the current version
+        :rtype: flask.Response
+        """
+        body, etag = self._state
+        if etag in request.if_none_match:
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        return response
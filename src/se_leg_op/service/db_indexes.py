@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Report missing, unknown and unused indexes for the collections of the provider and its plugins.
+
+Usage: SE_LEG_PROVIDER_SETTINGS=/op/etc/app_config.py python -m se_leg_op.service.db_indexes [--ensure]
+"""
+
+import argparse
+import sys
+
+from flask.config import Config
+
+from .app import SE_LEG_PROVIDER_SETTINGS_ENVVAR
+from ..storage import init_storage, mongo_clients
+
+# The collections whose indexes init_db_indexes in app.py ensures
+PROVIDER_COLLECTIONS = ['authn_requests', 'userinfo', 'clients', 'authz_codes', 'access_tokens', 'refresh_tokens',
+                        'subject_identifiers']
+
+# The collections of each plugin, included when the plugin is in PACKAGES
+PLUGIN_COLLECTIONS = {
+    'se_leg_op.plugins.nstic_vetting_process': ['yubico_states'],
+}
+
+
+def known_collections(config):
+    """
+    :param config: The provider config
+    :type config: flask.config.Config
+    :return: Names of the collections used by the provider and the configured plugins
+    :rtype: list[str]
+    """
+    collections = list(PROVIDER_COLLECTIONS)
+    for package in config.get('PACKAGES', []):
+        collections.extend(PLUGIN_COLLECTIONS.get(package, []))
+    return collections
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Report missing, unknown and unused indexes.')
+    parser.add_argument('--ensure', action='store_true', help='create missing indexes before reporting')
+    args = parser.parse_args(args)
+
+    config = Config('')
+    config.from_envvar(SE_LEG_PROVIDER_SETTINGS_ENVVAR)
+
+    mongo_clients.configure(config.get('MONGO_CLIENT_OPTIONS', {}))
+    ok = True
+    for collection in known_collections(config):
+        storage = init_storage(config, collection)
+        if args.ensure:
+            storage.ensure_indexes()
+        report = storage.index_report()
+        if report['unused'] is None:
+            print('{}: index usage statistics not available, requires MongoDB 3.2'.format(collection))
+        for status in ['missing', 'unknown', 'unused']:
+            for name in report[status] or []:
+                print('{}: {} index {}'.format(collection, status, name))
+        if report['missing']:
+            ok = False
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Per relying party circuit breaker and delivery metrics, shared by all delivery workers through Redis.
+
+Usage: SE_LEG_PROVIDER_SETTINGS=/op/etc/app_config.py python -m se_leg_op.service.delivery_health
+prints the delivery success rate, cumulative latency histogram and circuit state per host.
+"""
+
+import logging
+import sys
+import time
+
+from flask.config import Config
+from rq.utils import as_text
+
+from ..redis_connections import redis_connections
+from .app import SE_LEG_PROVIDER_SETTINGS_ENVVAR
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class CircuitBreaker(object):
+    """
+    Stops deliveries to a host after failure_threshold consecutive failures. After open_seconds a single delivery
+    is let through, a success closes the circuit and a failure opens it again.
+    """
+
+    def __init__(self, connection, failure_threshold=5, open_seconds=30, timer=time.time):
+        """
+        :param connection: Redis connection
+        :type connection: redis.StrictRedis
+        :param failure_threshold: Number of consecutive failures opening the circuit
+        :type failure_threshold: int
+        :param open_seconds: Number of seconds the circuit stays open before a delivery is tried again
+        :type open_seconds: int
+        """
+        self.connection = connection
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._timer = timer
+
+    def _key(self, host):
+        return 'se_leg_op:delivery:circuit:{}'.format(host)
+
+    def _probe_key(self, host):
+        return 'se_leg_op:delivery:circuit:{}:probe'.format(host)
+
+    def _opened_at(self, host):
+        opened_at = self.connection.hget(self._key(host), 'opened_at')
+        return float(opened_at) if opened_at is not None else None
+
+    def state(self, host):
+        """
+        :return: closed, open or half-open
+        :rtype: str
+        """
+        opened_at = self._opened_at(host)
+        if opened_at is None:
+            return 'closed'
+        if self._timer() < opened_at + self.open_seconds:
+            return 'open'
+        return 'half-open'
+
+    def allow(self, host):
+        """
+        :return: If a delivery to the host may be made, and if it is the probe of a half-open circuit. Only the
+                 delivery that took the probe may release it.
+        :rtype: (bool, bool)
+        """
+        state = self.state(host)
+        if state == 'closed':
+            return True, False
+        if state == 'open':
+            return False, False
+        # Only one worker gets to probe a half-open circuit
+        probe = bool(self.connection.set(self._probe_key(host), 1, nx=True, ex=self.open_seconds))
+        return probe, probe
+
+    def retry_after(self, host):
+        """
+        :return: Number of seconds until the circuit is half-open
+        :rtype: float
+        """
+        opened_at = self._opened_at(host)
+        if opened_at is None:
+            return 0
+        return max(opened_at + self.open_seconds - self._timer(), 0)
+
+    def record_success(self, host):
+        self.connection.delete(self._key(host), self._probe_key(host))
+
+    def release_probe(self, host):
+        """
+        Let another delivery probe a half-open circuit, after a delivery that neither closed nor opened it.
+        """
+        self.connection.delete(self._probe_key(host))
+
+    def record_failure(self, host):
+        key = self._key(host)
+        with self.connection.pipeline() as pipeline:
+            pipeline.hincrby(key, 'failures', 1)
+            # Forget failures that are not consecutive
+            pipeline.expire(key, self.open_seconds * 10)
+            failures = pipeline.execute()[0]
+        if failures >= self.failure_threshold:
+            if self._opened_at(host) is None:
+                logger.warning('Circuit opened for %s after %s failures', host, failures)
+            with self.connection.pipeline() as pipeline:
+                pipeline.hset(key, 'opened_at', self._timer())
+                pipeline.delete(self._probe_key(host))
+                pipeline.execute()
+
+
+class DeliveryMetrics(object):
+    """
+    Counts successful and failed deliveries and the delivery latency per host. The latency histogram is cumulative,
+    like a Prometheus histogram: le_<x> counts the deliveries that took at most x seconds and le_inf all deliveries.
+    """
+
+    hosts_key = 'se_leg_op:delivery:hosts'
+
+    def __init__(self, connection, buckets=LATENCY_BUCKETS):
+        """
+        :param connection: Redis connection
+        :type connection: redis.StrictRedis
+        :param buckets: Upper bounds in seconds of the latency histogram buckets
+        :type buckets: tuple[float]
+        """
+        self.connection = connection
+        self.buckets = buckets
+
+    def _key(self, host):
+        return 'se_leg_op:delivery:stats:{}'.format(host)
+
+    def _buckets(self, duration):
+        return ['le_{}'.format(bucket) for bucket in self.buckets if duration <= bucket] + ['le_inf']
+
+    def record(self, host, success, duration):
+        """
+        :param host: Host the response was delivered to
+        :type host: str
+        :param success: True if the delivery succeeded
+        :type success: bool
+        :param duration: Number of seconds the delivery took
+        :type duration: float
+        """
+        key = self._key(host)
+        with self.connection.pipeline(transaction=False) as pipeline:
+            pipeline.sadd(self.hosts_key, host)
+            pipeline.hincrby(key, 'success' if success else 'failure', 1)
+            for bucket in self._buckets(duration):
+                pipeline.hincrby(key, bucket, 1)
+            pipeline.hincrbyfloat(key, 'duration_sum', duration)
+            pipeline.execute()
+
+    def stats(self):
+        """
+        :return: Success rate, mean latency and cumulative latency histogram per host
+        :rtype: dict
+        """
+        stats = {}
+        for host in sorted(as_text(host) for host in self.connection.smembers(self.hosts_key)):
+            counters = {as_text(k): as_text(v) for k, v in self.connection.hgetall(self._key(host)).items()}
+            success = int(counters.get('success', 0))
+            total = success + int(counters.get('failure', 0))
+            histogram = []
+            for bucket in self.buckets + ('inf',):
+                histogram.append((bucket, int(counters.get('le_{}'.format(bucket), 0))))
+            stats[host] = {
+                'success': success,
+                'total': total,
+                'success_rate': success / total if total else None,
+                'mean_duration': float(counters.get('duration_sum', 0)) / total if total else None,
+                'histogram': histogram,
+            }
+        return stats
+
+    def reset(self):
+        hosts = [as_text(host) for host in self.connection.smembers(self.hosts_key)]
+        self.connection.delete(self.hosts_key, *[self._key(host) for host in hosts])
+
+
+def main(args=None):
+    config = Config('')
+    config.from_envvar(SE_LEG_PROVIDER_SETTINGS_ENVVAR)
+    connection = redis_connections.get_connection(config)
+    breaker = CircuitBreaker(connection, open_seconds=config.get('DELIVERY_CIRCUIT_OPEN_SECONDS', 30))
+    for host, host_stats in sorted(DeliveryMetrics(connection).stats().items()):
+        histogram = ' '.join('le_{}={}'.format(bucket, count) for bucket, count in host_stats['histogram'])
+        print('{} circuit={} success={}/{} mean={:.3f}s {}'.format(host, breaker.state(host), host_stats['success'],
+                                                                  host_stats['total'],
+                                                                  host_stats['mean_duration'] or 0, histogram))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Retry failed authentication response deliveries and manage the dead letter queue.
+
+Usage: SE_LEG_PROVIDER_SETTINGS=/op/etc/app_config.py python -m se_leg_op.service.delivery_scheduler <command>
+
+Commands:
+  run                    move due retries back to the delivery queue
+  list                   list the dead letters
+  replay [--all] [ids]   enqueue dead letters for delivery again
+  purge [--all] [ids]    delete dead letters
+
+Deliveries are retried by the delivery worker, or by plain rq workers using the exception handler of this module:
+  rq worker --exception-handler se_leg_op.service.delivery_scheduler.handle_exception authn_responses
+together with the run command.
+"""
+
+import argparse
+import logging
+import random
+import sys
+import time
+
+from flask.config import Config
+from requests.exceptions import RequestException
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.utils import as_text
+
+from .app import SE_LEG_PROVIDER_SETTINGS_ENVVAR, init_authn_response_queue
+from .response_sender import DeliveryError
+
+logger = logging.getLogger(__name__)
+
+
+def is_retryable(exc_type, exc_value):
+    if isinstance(exc_value, DeliveryError):
+        return exc_value.retryable
+    return issubclass(exc_type, RequestException)
+
+
+class DeliveryScheduler(object):
+    """
+    Retries failed jobs with exponential backoff and moves them to a dead letter queue when the retry budget is used
+    up, or the error can't be fixed by retrying.
+
+    Jobs waiting for a retry are kept in a Redis sorted set scored by the time they are due. The number of attempts
+    and the last error are kept in the job meta.
+    """
+
+    def __init__(self, queue, max_attempts=8, base_delay=2, max_delay=600, random=random.random, timer=time.time):
+        """
+        :param queue: The delivery queue
+        :type queue: rq.Queue
+        :param max_attempts: Number of attempts before a job is moved to the dead letter queue
+        :type max_attempts: int
+        :param base_delay: Number of seconds to wait before the first retry
+        :type base_delay: float
+        :param max_delay: Maximum number of seconds to wait between retries
+        :type max_delay: float
+        """
+        self.queue = queue
+        self.connection = queue.connection
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._random = random
+        self._timer = timer
+        self.scheduled_key = 'se_leg_op:delivery:{}:scheduled'.format(queue.name)
+        self.dead_letters_key = 'se_leg_op:delivery:{}:dead_letters'.format(queue.name)
+
+    def backoff(self, attempts):
+        """
+        :param attempts: Number of failed attempts
+        :type attempts: int
+        :return: Number of seconds to wait before the next attempt, randomized between half and the full delay so that
+         jobs failing at the same time are spread out
+        :rtype: float
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay / 2 + self._random() * delay / 2
+
+    def handle_exception(self, job, exc_type, exc_value, traceback):
+        """
+        Exception handler for rq workers.
+        """
+        attempts = job.meta.get('attempts', 0) + 1
+        job.meta['attempts'] = attempts
+        job.meta['last_error'] = '{}: {}'.format(exc_type.__name__, exc_value)
+        if is_retryable(exc_type, exc_value) and attempts < self.max_attempts:
+            self.schedule(job, self.backoff(attempts))
+        else:
+            self.dead_letter(job)
+        return False
+
+    def schedule(self, job, delay):
+        logger.info('Retrying job %s in %.1f seconds', job.id, delay)
+        with self.connection._pipeline() as pipeline:
+            job.set_status(JobStatus.DEFERRED, pipeline=pipeline)
+            job.save(pipeline=pipeline)
+            pipeline.zadd(self.scheduled_key, self._timer() + delay, job.id)
+            pipeline.execute()
+
+    def dead_letter(self, job):
+        logger.warning('Giving up job %s after %s attempts: %s', job.id, job.meta['attempts'], job.meta['last_error'])
+        with self.connection._pipeline() as pipeline:
+            job.set_status(JobStatus.FAILED, pipeline=pipeline)
+            job.save(pipeline=pipeline)
+            pipeline.rpush(self.dead_letters_key, job.id)
+            pipeline.execute()
+
+    def enqueue_due(self):
+        """
+        Move the jobs due for a retry back to the queue.
+
+        :return: Number of enqueued jobs
+        :rtype: int
+        """
+        count = 0
+        for job_id in self.connection.zrangebyscore(self.scheduled_key, 0, self._timer()):
+            # Only the scheduler removing the job from the set enqueues it
+            if not self.connection.zrem(self.scheduled_key, job_id):
+                continue
+            try:
+                job = Job.fetch(as_text(job_id), connection=self.connection)
+            except NoSuchJobError:
+                continue
+            self.queue.enqueue_job(job)
+            count += 1
+        return count
+
+    def dead_letter_ids(self):
+        return [as_text(job_id) for job_id in self.connection.lrange(self.dead_letters_key, 0, -1)]
+
+    def dead_letters(self):
+        """
+        :rtype: list[rq.job.Job]
+        """
+        jobs = []
+        for job_id in self.dead_letter_ids():
+            try:
+                jobs.append(Job.fetch(job_id, connection=self.connection))
+            except NoSuchJobError:
+                self.connection.lrem(self.dead_letters_key, 0, job_id)
+        return jobs
+
+    def replay(self, job_id):
+        """
+        Enqueue a dead letter with a new retry budget.
+
+        :return: False if the job is not in the dead letter queue
+        :rtype: bool
+        """
+        if not self.connection.lrem(self.dead_letters_key, 0, job_id):
+            return False
+        try:
+            job = Job.fetch(job_id, connection=self.connection)
+        except NoSuchJobError:
+            return False
+        job.meta.pop('attempts', None)
+        self.queue.enqueue_job(job)
+        return True
+
+    def purge(self, job_id):
+        """
+        :return: False if the job is not in the dead letter queue
+        :rtype: bool
+        """
+        if not self.connection.lrem(self.dead_letters_key, 0, job_id):
+            return False
+        Job(job_id, connection=self.connection).delete()
+        return True
+
+
+def init_delivery_scheduler(config, queue):
+    """
+    :param config: The provider config
+    :type config: flask.config.Config
+    :param queue: The delivery queue
+    :type queue: rq.Queue
+    :rtype: DeliveryScheduler
+    """
+    return DeliveryScheduler(queue, max_attempts=config.get('DELIVERY_MAX_ATTEMPTS', 8),
+                             base_delay=config.get('DELIVERY_RETRY_BASE_DELAY', 2),
+                             max_delay=config.get('DELIVERY_RETRY_MAX_DELAY', 600))
+
+
+def load_config():
+    config = Config('')
+    config.from_envvar(SE_LEG_PROVIDER_SETTINGS_ENVVAR)
+    return config
+
+
+_scheduler = None
+
+
+def handle_exception(job, exc_type, exc_value, traceback):
+    """
+    Exception handler for plain rq workers, the scheduler is created from the provider config on first use.
+    """
+    global _scheduler
+    if _scheduler is None:
+        config = load_config()
+        _scheduler = init_delivery_scheduler(config, init_authn_response_queue(config))
+    return _scheduler.handle_exception(job, exc_type, exc_value, traceback)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Retry deliveries and manage the dead letter queue.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    subparsers.add_parser('run', help='move due retries back to the delivery queue')
+    subparsers.add_parser('list', help='list the dead letters')
+    for command in ['replay', 'purge']:
+        subparser = subparsers.add_parser(command, help='{} dead letters'.format(command))
+        subparser.add_argument('--all', action='store_true', help='all dead letters')
+        subparser.add_argument('job_ids', nargs='*')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    config = load_config()
+    scheduler = init_delivery_scheduler(config, init_authn_response_queue(config))
+
+    if args.command == 'run':
+        try:
+            while True:
+                scheduler.enqueue_due()
+                time.sleep(1)
+        except KeyboardInterrupt:
+            return 0
+    if args.command == 'list':
+        for job in scheduler.dead_letters():
+            print('{} {} attempts={} {}'.format(job.id, job.enqueued_at, job.meta.get('attempts'),
+                                                job.meta.get('last_error')))
+        return 0
+
+    job_ids = scheduler.dead_letter_ids() if args.all else args.job_ids
+    action = scheduler.replay if args.command == 'replay' else scheduler.purge
+    ok = True
+    for job_id in job_ids:
+        if not action(job_id):
+            print('{}: not a dead letter'.format(job_id))
+            ok = False
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
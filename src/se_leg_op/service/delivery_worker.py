@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Deliver authentication responses concurrently, keeping connections to the relying parties open between jobs.
+
+Usage: SE_LEG_PROVIDER_SETTINGS=/op/etc/app_config.py python -m se_leg_op.service.delivery_worker [--burst]
+"""
+
+import argparse
+import logging
+import random
+import signal
+import sys
+import time
+
+from flask.config import Config
+
+from . import response_sender
+from .app import SE_LEG_PROVIDER_SETTINGS_ENVVAR, init_authn_response_queue
+from .delivery_health import CircuitBreaker, DeliveryMetrics
+from .delivery_scheduler import init_delivery_scheduler, is_retryable
+from .job_worker import ConcurrentWorker
+
+
+class DeliveryWorker(ConcurrentWorker):
+    """
+    Concurrent worker retrying failed deliveries with the delivery scheduler.
+
+    Deliveries to a host with an open circuit are deferred without making a request, so that jobs for an unhealthy
+    relying party don't hold up the others.
+
+    Jobs from other queues, like the license verifications, can be run by the same worker. They are run as plain
+    jobs, at most queue_concurrency[queue name] at a time.
+    """
+
+    def __init__(self, queue, scheduler, breaker, metrics, queues=None, queue_concurrency=None, sessions=None,
+                 timeout=response_sender.DEFAULT_TIMEOUT, **kwargs):
+        """
+        :param queue: The authn response queue
+        :type queue: rq.Queue
+        :param queues: All queues to take jobs from, in priority order, defaults to the authn response queue
+        :type queues: list[rq.Queue] | None
+        :param queue_concurrency: Maximum number of running jobs per queue name, for the other queues
+        :type queue_concurrency: dict | None
+        :param sessions: Sessions to deliver the responses with, defaults to the response_sender sessions
+        :type sessions: se_leg_op.service.response_sender.SessionPool | None
+        :param timeout: Default number of seconds to wait for a relying party
+        :type timeout: float
+        """
+        super(DeliveryWorker, self).__init__(queues or [queue], queue.connection,
+                                             concurrency_key=self.job_concurrency_key, **kwargs)
+        self.queue = queue
+        self.queue_concurrency = queue_concurrency or {}
+        self.scheduler = scheduler
+        self.breaker = breaker
+        self.metrics = metrics
+        self.sessions = sessions or response_sender.sessions
+        self.timeout = timeout
+        self.exception_handlers.append(self.retry_delivery)
+        self.exception_handlers.append(self.record_failure)
+
+    def is_delivery(self, job):
+        return job.origin == self.queue.name
+
+    def job_concurrency_key(self, job):
+        if self.is_delivery(job):
+            return response_sender.response_host(job)
+        return ('queue', job.origin)
+
+    def key_limit(self, key):
+        if isinstance(key, tuple):
+            return self.queue_concurrency.get(key[1])
+        return self.max_per_key
+
+    def before_dequeue(self):
+        self.scheduler.enqueue_due()
+
+    def perform_job(self, job):
+        if not self.is_delivery(job):
+            return super(DeliveryWorker, self).perform_job(job)
+        host = response_sender.response_host(job)
+        allowed, probe = self.breaker.allow(host)
+        if not allowed:
+            # Spread the deferred jobs so they don't all hit the host when the circuit closes
+            delay = max(self.breaker.retry_after(host), 1) + random.random() * self.breaker.open_seconds
+            self.scheduler.schedule(job, delay)
+            return False
+        start = time.monotonic()
+        success = super(DeliveryWorker, self).perform_job(job)
+        self.metrics.record(host, success, time.monotonic() - start)
+        if success:
+            self.breaker.record_success(host)
+        elif probe:
+            # A failed probe that didn't open the circuit again, like a non-retryable error, must not keep the slot
+            self.breaker.release_probe(host)
+        return success
+
+    def execute_job(self, job):
+        if not self.is_delivery(job):
+            return super(DeliveryWorker, self).execute_job(job)
+        # The sessions can't be part of the job kwargs, they are saved with the job when it is retried
+        kwargs = dict(job.kwargs)
+        kwargs.setdefault('timeout', self.timeout)
+        return response_sender.send_response(self.sessions, *job.args, **kwargs)
+
+    def retry_delivery(self, job, *exc_info):
+        if not self.is_delivery(job):
+            return True
+        return self.scheduler.handle_exception(job, *exc_info)
+
+    def record_failure(self, job, exc_type, exc_value, traceback):
+        if self.is_delivery(job) and is_retryable(exc_type, exc_value):
+            self.breaker.record_failure(response_sender.response_host(job))
+        return True
+
+
+def init_delivery_worker(config, **kwargs):
+    """
+    :param config: The provider config
+    :type config: flask.config.Config
+    :param kwargs: Additional DeliveryWorker options, like queues and queue_concurrency
+    :rtype: DeliveryWorker
+    """
+    max_per_host = config.get('DELIVERY_MAX_PER_HOST', 4)
+    queue = init_authn_response_queue(config)
+    breaker = CircuitBreaker(queue.connection,
+                             failure_threshold=config.get('DELIVERY_CIRCUIT_FAILURE_THRESHOLD', 5),
+                             open_seconds=config.get('DELIVERY_CIRCUIT_OPEN_SECONDS', 30))
+    return DeliveryWorker(queue, init_delivery_scheduler(config, queue), breaker, DeliveryMetrics(queue.connection),
+                          max_workers=config.get('DELIVERY_WORKER_THREADS', 20),
+                          batch_size=config.get('DELIVERY_BATCH_SIZE'),
+                          max_per_key=max_per_host, sessions=response_sender.SessionPool(pool_maxsize=max_per_host),
+                          timeout=config.get('DELIVERY_TIMEOUT', response_sender.DEFAULT_TIMEOUT), **kwargs)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Deliver authentication responses.')
+    parser.add_argument('--burst', action='store_true', help='exit when the queue is empty')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    config = Config('')
+    config.from_envvar(SE_LEG_PROVIDER_SETTINGS_ENVVAR)
+
+    worker = init_delivery_worker(config)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    try:
+        worker.work(burst=args.burst)
+    except KeyboardInterrupt:
+        worker.stop()
+    finally:
+        worker.sessions.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from rq.defaults import DEFAULT_RESULT_TTL
+from rq.exceptions import DequeueTimeout
+from rq.job import JobStatus
+from rq.queue import Queue, get_failed_queue
+from rq.registry import FinishedJobRegistry, StartedJobRegistry
+from rq.utils import utcnow
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrentWorker(object):
+    """
+    Runs rq jobs concurrently in a thread pool instead of forking a process per job.
+
+    Jobs are dequeued in batches from the queues, in the order given. If concurrency_key is set, it is called with a
+    job and at most max_per_key jobs with the same key run at the same time, the others wait in a local backlog
+    without holding a thread.
+
+    The rq job timeout is not enforced as it relies on signals, jobs have to time out by themselves.
+    """
+
+    def __init__(self, queues, connection, max_workers=10, batch_size=None, concurrency_key=None, max_per_key=None,
+                 default_result_ttl=DEFAULT_RESULT_TTL):
+        """
+        :param queues: Queues to take jobs from, in priority order
+        :type queues: list[rq.Queue]
+        :param connection: Redis connection
+        :type connection: redis.StrictRedis
+        :param max_workers: Number of threads running jobs
+        :type max_workers: int
+        :param batch_size: Maximum number of jobs taken from the queues but not finished, defaults to 2 * max_workers
+        :type batch_size: int | None
+        :param concurrency_key: Returns the concurrency key of a job
+        :type concurrency_key: callable | None
+        :param max_per_key: Maximum number of running jobs with the same concurrency key
+        :type max_per_key: int | None
+        :param default_result_ttl: Number of seconds job results are kept
+        :type default_result_ttl: int
+        """
+        self.queues = queues
+        self.connection = connection
+        self.max_workers = max_workers
+        self.batch_size = batch_size or 2 * max_workers
+        self.concurrency_key = concurrency_key
+        self.max_per_key = max_per_key
+        self.default_result_ttl = default_result_ttl
+        self.exception_handlers = [self.move_to_failed_queue]
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self._taken = 0
+        self._running_per_key = {}
+        self._backlog_per_key = {}
+        self._stopped = False
+
+    def stop(self):
+        """
+        Stop taking new jobs, jobs already taken are finished.
+        """
+        self._stopped = True
+
+    def work(self, burst=False, poll_timeout=1):
+        """
+        :param burst: Return when the queues are empty
+        :type burst: bool
+        :param poll_timeout: Number of seconds to block waiting for a job when the queues are empty
+        :type poll_timeout: int
+        """
+        logger.info('Worker started for queues %s', ', '.join(queue.name for queue in self.queues))
+        try:
+            while not self._stopped:
+                self.before_dequeue()
+                with self._lock:
+                    while self._taken >= self.batch_size:
+                        self._done.wait()
+                job = self.dequeue(block=self._taken == 0 and not burst, timeout=poll_timeout)
+                if job is None:
+                    if burst and self._taken == 0:
+                        break
+                    continue
+                self.submit(job)
+        finally:
+            self.wait_for_jobs()
+            logger.info('Worker stopped')
+
+    def before_dequeue(self):
+        """
+        Hook called in the work loop before each dequeue.
+        """
+        pass
+
+    def dequeue(self, block, timeout):
+        if block:
+            try:
+                result = Queue.dequeue_any(self.queues, timeout, connection=self.connection)
+            except DequeueTimeout:
+                return None
+            if result is None:
+                return None
+            return result[0]
+        for queue in self.queues:
+            job = queue.dequeue()
+            if job is not None:
+                return job
+        if self._taken:
+            # Let running jobs make progress before polling the queues again
+            with self._lock:
+                self._done.wait(0.1)
+        return None
+
+    def key_limit(self, key):
+        """
+        :param key: A concurrency key
+        :return: Maximum number of running jobs with the key, None for no limit
+        :rtype: int | None
+        """
+        return self.max_per_key
+
+    def wait_for_jobs(self):
+        with self._lock:
+            while self._taken:
+                self._done.wait()
+
+    def submit(self, job):
+        key = self.concurrency_key(job) if self.concurrency_key else None
+        limit = self.key_limit(key) if key is not None else None
+        with self._lock:
+            self._taken += 1
+            if limit and self._running_per_key.get(key, 0) >= limit:
+                self._backlog_per_key.setdefault(key, deque()).append(job)
+                return
+            self._running_per_key[key] = self._running_per_key.get(key, 0) + 1
+        self._executor.submit(self._run, job, key)
+
+    def _run(self, job, key):
+        try:
+            self.perform_job(job)
+        except Exception:
+            logger.exception('Unexpected error when running job %s', job.id)
+        with self._lock:
+            self._taken -= 1
+            backlog = self._backlog_per_key.get(key)
+            next_job = backlog.popleft() if backlog else None
+            if backlog is not None and not backlog:
+                del self._backlog_per_key[key]
+            if next_job is None:
+                self._running_per_key[key] -= 1
+                if not self._running_per_key[key]:
+                    del self._running_per_key[key]
+            self._done.notify_all()
+        if next_job is not None:
+            self._executor.submit(self._run, next_job, key)
+
+    def perform_job(self, job):
+        """
+        :param job: The job to run
+        :type job: rq.job.Job
+        :return: True if the job succeeded
+        :rtype: bool
+        """
+        started_job_registry = StartedJobRegistry(job.origin, self.connection)
+        with self.connection._pipeline() as pipeline:
+            started_job_registry.add(job, (job.timeout or Queue.DEFAULT_TIMEOUT) + 60, pipeline=pipeline)
+            job.set_status(JobStatus.STARTED, pipeline=pipeline)
+            pipeline.execute()
+
+        try:
+            rv = self.execute_job(job)
+        except Exception:
+            exc_info = sys.exc_info()
+            with self.connection._pipeline() as pipeline:
+                job.set_status(JobStatus.FAILED, pipeline=pipeline)
+                started_job_registry.remove(job, pipeline=pipeline)
+                pipeline.execute()
+            self.handle_exception(job, *exc_info)
+            return False
+
+        with self.connection._pipeline() as pipeline:
+            job._result = rv
+            result_ttl = job.get_result_ttl(self.default_result_ttl)
+            if result_ttl != 0:
+                job.ended_at = utcnow()
+                job._status = JobStatus.FINISHED
+                job.save(pipeline=pipeline)
+                FinishedJobRegistry(job.origin, self.connection).add(job, result_ttl, pipeline)
+            job.cleanup(result_ttl, pipeline=pipeline)
+            started_job_registry.remove(job, pipeline=pipeline)
+            pipeline.execute()
+        logger.debug('Job %s OK', job.id)
+        return True
+
+    def execute_job(self, job):
+        """
+        :param job: The job to run
+        :type job: rq.job.Job
+        :return: The job result
+        """
+        return job.perform()
+
+    def handle_exception(self, job, *exc_info):
+        """
+        Call the exception handlers, last added first, until one returns False. Handlers have the same signature as
+        rq exception handlers.
+        """
+        logger.error('Job %s failed', job.id, exc_info=exc_info)
+        for handler in reversed(self.exception_handlers):
+            fallthrough = handler(job, *exc_info)
+            if fallthrough is not None and not fallthrough:
+                break
+
+    def move_to_failed_queue(self, job, *exc_info):
+        get_failed_queue(self.connection).quarantine(job, exc_info=exc_info)
+        return False
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import time
+
+from flask import current_app, request
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# Refills the bucket for the time passed since the last call and takes cost tokens if there are enough.
+# Returns whether the tokens were taken and else the number of seconds until there are enough tokens.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {allowed, tostring(retry_after)}
+"""
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limiter keeping the buckets in Redis, so that the limits hold across all processes.
+    """
+
+    def __init__(self, connection, timer=time.time):
+        """
+        :param connection: Redis connection
+        :type connection: redis.StrictRedis
+        """
+        self.connection = connection
+        self._timer = timer
+        self._script = connection.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def consume(self, key, rate, burst, cost=1):
+        """
+        :param key: Bucket name, like endpoint and client id
+        :type key: str
+        :param rate: Number of tokens added per second
+        :type rate: float
+        :param burst: Maximum number of tokens in the bucket
+        :type burst: int
+        :param cost: Number of tokens to take
+        :type cost: int
+        :return: Whether the tokens were taken, and else the number of seconds until there are enough tokens
+        :rtype: (bool, float)
+        """
+        allowed, retry_after = self._script(keys=['se_leg_op:rate_limit:{}'.format(key)],
+                                            args=[rate, burst, self._timer(), cost])
+        return bool(allowed), float(retry_after)
+
+
+def get_rate_limit(endpoint, client_id):
+    """
+    The limit for an endpoint is configured with RATE_LIMITS in the app config, keyed by flask endpoint name:
+    RATE_LIMITS = {'oidc_provider.authentication_endpoint': {'rate': 10, 'burst': 20}}, where rate is requests
+    per second. A client registration can override the limits of endpoints in RATE_LIMITS with the same structure
+    in a rate_limits field.
+
+    :return: The rate and burst for the client at the endpoint, None if the endpoint is not limited
+    :rtype: dict | None
+    """
+    limit = current_app.config.get('RATE_LIMITS', {}).get(endpoint)
+    if limit is None or client_id is None:
+        return limit
+    try:
+        client = current_app.provider.clients[client_id]
+    except KeyError:
+        return limit
+    return client.get('rate_limits', {}).get(endpoint, limit)
+
+
+def check_rate_limit(client_id):
+    """
+    Take a token from the bucket of the client at the current endpoint.
+
+    :param client_id: Client id or API username of the caller, the remote address is used if None
+    :type client_id: str | None
+    :return: A 429 response if the client is over its limit, else None
+    :rtype: flask.Response | None
+    """
+    limit = get_rate_limit(request.endpoint, client_id)
+    if limit is None:
+        return None
+    key = '{}:{}'.format(request.endpoint, client_id or request.remote_addr)
+    try:
+        allowed, retry_after = current_app.rate_limiter.consume(key, limit['rate'], limit['burst'])
+    except RedisError as e:
+        # Rather serve requests without limits than not at all
+        logger.error('Could not check rate limit: %s', e)
+        return None
+    if allowed:
+        return None
+    logger.warning('Rate limit exceeded for %s', key)
+    response = current_app.response_class('Too Many Requests', status=429)
+    response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+    return response
@@ -1,17 +1,92 @@
 import logging
+import threading
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_TIMEOUT = 10
 
-def deliver_response_task(response_url, **kwargs):
-    # type: (str) -> None
+
+class DeliveryError(Exception):
+    """
+    The relying party did not accept the response.
+    """
+
+    def __init__(self, message, retryable):
+        super(DeliveryError, self).__init__(message)
+        self.retryable = retryable
+
+
+class SessionPool(object):
+    """
+    Keeps one requests.Session per host so that responses to the same relying party reuse keep-alive connections.
+    """
+
+    def __init__(self, pool_maxsize=10):
+        """
+        :param pool_maxsize: Number of connections kept open per host
+        :type pool_maxsize: int
+        """
+        self.pool_maxsize = pool_maxsize
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """
+        :param url: Url to make a request to
+        :type url: str
+        :rtype: requests.Session
+        """
+        parsed = urlsplit(url)
+        host = (parsed.scheme, parsed.netloc)
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                    session.mount('{}://'.format(parsed.scheme), adapter)
+                    self._sessions[host] = session
+        return session
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+sessions = SessionPool()
+
+
+def response_host(job):
+    """
+    :param job: A deliver_response_task job
+    :type job: rq.job.Job
+    :return: The host the response is delivered to
+    :rtype: str
+    """
+    return urlsplit(job.args[0]).netloc
+
+
+def send_response(session_pool, response_url, timeout=DEFAULT_TIMEOUT, **kwargs):
     """
     Make a synchronous request to the specified url.
+
+    :param session_pool: Sessions to make the request with
+    :type session_pool: SessionPool
+    :param response_url: Url the response is delivered to
+    :type response_url: str
+    :param timeout: Number of seconds to wait for the client
+    :type timeout: float
+    :raise DeliveryError: if the client responds with another status than 200, retryable for server errors and 429
     """
     try:
-        resp = requests.get(response_url, **kwargs)
+        resp = session_pool.get(response_url).get(response_url, timeout=timeout, **kwargs)
     except requests.exceptions.RequestException as e:
         logger.debug('could not deliver response to client', exc_info=True)
         raise
@@ -19,3 +94,17 @@ def deliver_response_task(response_url, **kwargs):
     if resp.status_code != 200:
         logger.debug('client responded with unexpected http status \'%s\' on response to redirect_uri \'%s\'',
                      resp.status_code, resp.request.url)
+        raise DeliveryError('client responded with http status {}'.format(resp.status_code),
+                            retryable=resp.status_code >= 500 or resp.status_code == 429)
+
+
+def deliver_response_task(response_url, **kwargs):
+    # type: (str) -> None
+    """
+    Make a synchronous request to the specified url, with the default sessions.
+
+    The delivery worker runs these jobs with its own sessions and timeout, see send_response.
+
+    :raise DeliveryError: if the client responds with another status than 200, retryable for server errors and 429
+    """
+    send_response(sessions, response_url, **kwargs)
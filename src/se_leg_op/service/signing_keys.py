@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+import time
+
+from jwkest.jwk import RSAKey, import_rsa_key
+
+logger = logging.getLogger(__name__)
+
+
+class SigningKeyManager(object):
+    """
+    Loads the provider signing key and keeps it up to date with the key files on disk.
+
+    The keys are read either from a single file, PROVIDER_SIGNING_KEY = {'PATH': ..., 'KID': ...}, or from a
+    directory of PEM files, PROVIDER_SIGNING_KEY = {'DIRECTORY': ...}. In directory mode the kid of a key is its file
+    name without the .pem extension and all keys are published in the JWKS, so that tokens signed before a rotation can
+    still be verified. Remove a key file to retire the key.
+
+    A new key is published in the JWKS as soon as it is loaded, but only used for signing once relying parties have
+    had time to fetch the new JWKS: the most recently modified key whose file is older than the publish delay plus the
+    reload interval signs, or the oldest key if no key is that old.
+
+    The key files are checked for changes at most every RELOAD_INTERVAL seconds (default 60, 0 disables reloading)
+    when maybe_reload is called.
+    """
+
+    def __init__(self, config, publish_delay=0, timer=time.monotonic, clock=time.time):
+        """
+        :param config: PROVIDER_SIGNING_KEY from the app config
+        :type config: dict
+        :param publish_delay: Number of seconds relying parties may cache the JWKS
+        :type publish_delay: float
+        :param timer: Clock used for the reload interval
+        :type timer: callable
+        :param clock: Clock used for the age of the key files
+        :type clock: callable
+        """
+        self.path = config.get('PATH')
+        self.kid = config.get('KID')
+        self.directory = config.get('DIRECTORY')
+        if not (self.path or self.directory):
+            raise ValueError('PROVIDER_SIGNING_KEY needs a PATH or a DIRECTORY')
+        self.reload_interval = config.get('RELOAD_INTERVAL', 60)
+        self.publish_delay = publish_delay
+        self.listeners = []
+        self._timer = timer
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._last_check = timer()
+        self._snapshot = self._key_files_snapshot()
+        self._keys = self._load_keys()
+        self._signing_key = self._choose_signing_key(self._keys)
+
+    @property
+    def signing_key(self):
+        """
+        :rtype: jwkest.jwk.RSAKey
+        """
+        return self._signing_key
+
+    @property
+    def keys(self):
+        """
+        :return: The signing key followed by the other keys, most recently modified first
+        :rtype: list[jwkest.jwk.RSAKey]
+        """
+        return [self._signing_key] + [key for mtime, key in self._keys if key is not self._signing_key]
+
+    @property
+    def jwks(self):
+        return {'keys': [key.serialize() for key in self.keys]}
+
+    def _key_files(self):
+        if self.path:
+            return [(self.kid, self.path)]
+        key_files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pem'):
+                key_files.append((name[:-len('.pem')], os.path.join(self.directory, name)))
+        return key_files
+
+    def _key_files_snapshot(self):
+        snapshot = []
+        for kid, path in self._key_files():
+            stat = os.stat(path)
+            snapshot.append((stat.st_mtime, kid, stat.st_size))
+        return sorted(snapshot)
+
+    def _load_keys(self):
+        keys = []
+        # Most recently modified key first
+        for mtime, kid, size in reversed(self._snapshot):
+            path = self.path or os.path.join(self.directory, kid + '.pem')
+            with open(path) as f:
+                keys.append((mtime, RSAKey(key=import_rsa_key(f.read()), kid=kid, alg='RS256')))
+        if not keys:
+            raise ValueError('No signing keys found in {}'.format(self.directory))
+        return tuple(keys)
+
+    def _choose_signing_key(self, keys):
+        if self.path:
+            # A replaced key file leaves no other key to sign with
+            return keys[0][1]
+        # The key is published in the JWKS at most one reload interval after its file was written
+        published_before = self._clock() - self.publish_delay - self.reload_interval
+        for mtime, key in keys:
+            if mtime <= published_before:
+                return key
+        return keys[-1][1]
+
+    def maybe_reload(self):
+        """
+        Reload the keys if the reload interval has passed and the key files have changed. The keys in use are kept if
+        the new keys can't be loaded.
+        """
+        if not self.reload_interval or self._timer() - self._last_check < self.reload_interval:
+            return
+        # Only one thread needs to check, the others continue with the current keys
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._last_check = self._timer()
+            snapshot = self._key_files_snapshot()
+            keys = self._keys
+            reloaded = snapshot != self._snapshot
+            if reloaded:
+                previous_snapshot, self._snapshot = self._snapshot, snapshot
+                try:
+                    keys = self._load_keys()
+                except (OSError, ValueError) as e:
+                    # A key file might be half written, try again on the next check
+                    logger.error('Could not reload signing keys: %s', e)
+                    self._snapshot = previous_snapshot
+                    return
+                logger.info('Reloaded signing keys, publishing kids %s', ', '.join(key.kid for mtime, key in keys))
+            # A new key is used for signing once it has been published for long enough
+            signing_key = self._choose_signing_key(keys)
+            if signing_key.kid != self._signing_key.kid:
+                logger.info('Signing with kid %s', signing_key.kid)
+            elif not reloaded:
+                return
+            self._keys, self._signing_key = keys, signing_key
+        except OSError as e:
+            logger.error('Could not check signing keys: %s', e)
+            return
+        finally:
+            self._lock.release()
+        for listener in self.listeners:
+            listener(self)
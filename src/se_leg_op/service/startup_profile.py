@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class StartupProfile(object):
+    """
+    Records the time spent in each phase of starting the app.
+    """
+
+    def __init__(self, timer=time.monotonic):
+        self._timer = timer
+        self._started = timer()
+        self.phases = OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        :param name: Name of the phase
+        :type name: str
+        """
+        start = self._timer()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + self._timer() - start
+
+    @property
+    def total(self):
+        """
+        :return: Number of seconds since the profile was created
+        :rtype: float
+        """
+        return self._timer() - self._started
+
+    def to_dict(self):
+        """
+        :return: Seconds spent per phase, in the order the phases started, and in total
+        :rtype: dict
+        """
+        return {'phases': OrderedDict(self.phases), 'total': self.total}
+
+    def report(self, name):
+        """
+        :param name: Name of the app
+        :type name: str
+        """
+        phases = ', '.join('{} {:.1f}ms'.format(phase, seconds * 1000) for phase, seconds in self.phases.items())
+        logger.info('Started %s in %.1fms: %s', name, self.total * 1000, phases)
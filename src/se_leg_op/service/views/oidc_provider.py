@@ -8,6 +8,7 @@ from pyop.access_token import AccessToken, BearerTokenError
 from pyop.exceptions import InvalidAuthenticationRequest, InvalidAccessToken, InvalidClientAuthentication, OAuthError
 from pyop.util import should_fragment_encode
 
+from ..rate_limit import check_rate_limit
 from ..response_sender import deliver_response_task
 from ..vetting_process_tools import create_authentication_response
 
@@ -25,6 +26,10 @@ def authentication_endpoint():
     try:
         auth_req = current_app.provider.parse_authentication_request(flask.request.get_data().decode('utf-8'),
                                                                      flask.request.headers)
+        # Limit requests of the validated client before anything is stored or enqueued
+        over_limit_response = check_rate_limit(auth_req['client_id'])
+        if over_limit_response:
+            return over_limit_response
         current_app.authn_requests[auth_req['nonce']] = auth_req.to_dict()
 
         # Check client vetting method
@@ -42,6 +47,10 @@ def authentication_endpoint():
 
     except InvalidAuthenticationRequest as e:
         current_app.logger.debug('received invalid authn request', exc_info=True)
+        # The client is not known to be valid, limit invalid requests by remote address
+        over_limit_response = check_rate_limit(None)
+        if over_limit_response:
+            return over_limit_response
         error_url = e.to_error_url()
         if error_url:
             current_app.authn_response_queue.enqueue(deliver_response_task, error_url)
@@ -55,12 +64,12 @@ def authentication_endpoint():
 
 @oidc_provider_views.route('/.well-known/openid-configuration')
 def provider_configuration():
-    return jsonify(current_app.provider.provider_configuration.to_dict())
+    return current_app.provider_configuration_response.make_response(flask.request)
 
 
 @oidc_provider_views.route('/jwks')
 def jwks_uri():
-    return jsonify(current_app.provider.jwks)
+    return current_app.jwks_response.make_response(flask.request)
 
 
 @oidc_provider_views.route('/token', methods=['POST'])
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Run all rq jobs of the provider in a pool of long lived worker processes, each running jobs in threads with warm
+Mongo, Redis and HTTP connection pools, instead of forking a process per job.
+
+Usage: SE_LEG_PROVIDER_SETTINGS=/op/etc/app_config.py python -m se_leg_op.service.worker_pool [--burst]
+
+Configured from the app config:
+  WORKER_QUEUES: names of the queues to take jobs from, in priority order, default
+                 ['authn_responses', 'mobile_verify_service_queue'], the license verifications of the
+                 nstic_vetting_process plugin
+  WORKER_QUEUE_CONCURRENCY: maximum number of running jobs per queue name, for queues other than authn_responses,
+                            e.g. {'mobile_verify_service_queue': 4}
+  WORKER_PROCESSES: number of worker processes, default 1
+  WORKER_IMPORTS: modules imported before the worker processes are forked so that they share them, e.g.
+                  ['mitek_mobile_verify.services', 'zeep']
+  WORKER_PRELOAD: import paths of functions called with the config in each worker process before it takes any jobs,
+                  e.g. ['se_leg_op.plugins.nstic_vetting_process.license_service_worker:preload'] sets up the
+                  license service and its connections from the config
+  DELIVERY_WORKER_THREADS and the other delivery worker settings apply to each process.
+
+The jobs don't use the Flask app, it is not created in the worker processes.
+"""
+
+import argparse
+import logging
+import os
+import signal
+import sys
+import time
+from importlib import import_module
+
+import rq
+from flask.config import Config
+from werkzeug.utils import import_string
+
+from ..redis_connections import redis_connections
+from .app import SE_LEG_PROVIDER_SETTINGS_ENVVAR
+from .delivery_worker import init_delivery_worker
+
+logger = logging.getLogger(__name__)
+
+WORKER_QUEUES = ['authn_responses', 'mobile_verify_service_queue']
+
+
+class WorkerPool(object):
+    """
+    Keeps a number of forked processes running target. A process exiting with an error is replaced. Processes that
+    fail soon after they were started are replaced with a growing delay, so that a failing setup doesn't turn into
+    a fork loop.
+    """
+
+    def __init__(self, target, processes, restart_delay=1, max_restart_delay=60, min_uptime=10, sleep=time.sleep,
+                 timer=time.monotonic):
+        """
+        :param target: Called in each process, returns the exit status
+        :type target: callable
+        :param processes: Number of processes
+        :type processes: int
+        :param restart_delay: Number of seconds to wait before replacing a failed process
+        :type restart_delay: float
+        :param max_restart_delay: Maximum number of seconds to wait before replacing a failed process
+        :type max_restart_delay: float
+        :param min_uptime: Number of seconds a process has to run for its failure not to increase the restart delay
+        :type min_uptime: float
+        """
+        self.target = target
+        self.processes = processes
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.min_uptime = min_uptime
+        self.children = {}
+        self._sleep = sleep
+        self._timer = timer
+        self._quick_failures = 0
+        self._stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            # Don't run the pool's handlers, they would signal the siblings
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            status = 1
+            try:
+                status = self.target() or 0
+            except Exception:
+                logger.exception('Worker process failed')
+            finally:
+                os._exit(status)
+        self.children[pid] = self._timer()
+        return pid
+
+    def next_restart_delay(self, uptime):
+        """
+        :param uptime: Number of seconds the failed process ran
+        :type uptime: float
+        :return: Number of seconds to wait before replacing the process
+        :rtype: float
+        """
+        if uptime < self.min_uptime:
+            self._quick_failures += 1
+        else:
+            self._quick_failures = 0
+        return min(self.restart_delay * 2 ** max(self._quick_failures - 1, 0), self.max_restart_delay)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for i in range(self.processes):
+            self.spawn()
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except InterruptedError:
+                continue
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if status and not self._stopping:
+                uptime = self._timer() - started if started is not None else 0
+                delay = self.next_restart_delay(uptime)
+                logger.warning('Worker process %s exited with status %s after %.1fs, replacing it in %.1fs', pid,
+                               status, uptime, delay)
+                self._sleep(delay)
+                if not self._stopping:
+                    self.spawn()
+
+    def stop(self, signum=None, frame=None):
+        self._stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+def init_worker(config):
+    """
+    :param config: The provider config
+    :type config: flask.config.Config
+    :return: A worker for all queues in WORKER_QUEUES
+    :rtype: se_leg_op.service.delivery_worker.DeliveryWorker
+    """
+    connection = redis_connections.get_connection(config)
+    queues = [rq.Queue(name, connection=connection) for name in config.get('WORKER_QUEUES', WORKER_QUEUES)]
+    return init_delivery_worker(config, queues=queues,
+                                queue_concurrency=config.get('WORKER_QUEUE_CONCURRENCY', {}))
+
+
+def run_worker(config, preload, burst=False):
+    """
+    Runs in each worker process, all connections are created here and not inherited from the parent.
+    """
+    for func in preload:
+        func(config)
+    worker = init_worker(config)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: worker.stop())
+    try:
+        worker.work(burst=burst)
+    finally:
+        worker.sessions.close()
+    return 0
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run the provider rq jobs.')
+    parser.add_argument('--burst', action='store_true', help='exit when the queues are empty')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    config = Config('')
+    config.from_envvar(SE_LEG_PROVIDER_SETTINGS_ENVVAR)
+
+    # Imported once before forking, the worker processes share the loaded modules
+    for module in config.get('WORKER_IMPORTS', []):
+        import_module(module)
+    preload = [import_string(path) for path in config.get('WORKER_PRELOAD', [])]
+    processes = config.get('WORKER_PROCESSES', 1)
+    if processes == 1:
+        return run_worker(config, preload, burst=args.burst)
+    WorkerPool(lambda: run_worker(config, preload, burst=args.burst), processes).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
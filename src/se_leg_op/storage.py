@@ -1,15 +1,392 @@
-from pyop.storage import MongoWrapper
+import binascii
+import json
+import threading
+from base64 import b64decode
+from datetime import datetime, timedelta
+from time import time
+
+import gridfs
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING, IndexModel, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, OperationFailure
+from pyop.storage import MongoDB, MongoWrapper
+
+from .redis_connections import redis_connections
+
+# Index specifications are dicts with the index keys, as a field name or a list of (field, direction) pairs,
+# in 'keys' and any other pymongo.IndexModel options
+LOOKUP_KEY_INDEX = {'keys': 'lookup_key', 'unique': True}
+
+# Indexes needed by each collection in addition to the lookup_key index
+COLLECTION_INDEXES = {
+    'yubico_states': [
+        # Listing and paginating the states of a client
+        {'keys': [('data.client_id', ASCENDING), ('lookup_key', ASCENDING)]},
+    ],
+}
+
+# Lifetime in seconds of the documents in each collection, documents in collections not listed here never expire.
+# Override per collection with DB_COLLECTION_TTL in the app config. yubico_states have no default lifetime: the API
+# clients list them until they delete them, which also deletes the userinfo, and an expired state would leave its
+# userinfo behind.
+COLLECTION_TTL = {
+    'authn_requests': 60 * 60 * 24,
+    'authz_codes': 60 * 60,
+}
+
+
+# Lifetime in seconds of the blobs in each blob storage bucket. Blobs are normally deleted when they have been used,
+# this removes the ones left behind by failed jobs. Override per bucket with DB_BLOB_TTL in the app config.
+BLOB_TTL = {
+    'yubico_images': 60 * 60 * 24 * 7,
+}
+
+# Prefix of the GridFS collections, keeps them apart from the document collections
+BLOB_COLLECTION_PREFIX = 'blobs.'
+
+
+# Storage backend of each collection, mongodb (default) or redis. Override per collection with DB_COLLECTION_BACKEND
+# in the app config.
+COLLECTION_BACKEND = {}
+
+# The collections that may be stored in Redis: the short lived documents of the provider, which are only looked up by
+# key. RedisStorageWrapper doesn't support the queries and bulk updates used on the other collections.
+REDIS_COLLECTIONS = frozenset(['authn_requests', 'authz_codes', 'access_tokens', 'refresh_tokens'])
 
 
 class DocumentDoesNotExist(Exception):
     pass
 
 
+class VersionConflict(Exception):
+    """
+    The document was changed by someone else since it was read.
+    """
+    pass
+
+
+def _field_paths(names):
+    """
+    :param names: Field names in the document data
+    :type names: collections.Iterable[str]
+    :return: Dotted paths to the fields in the document
+    :rtype: list[str]
+    :raise ValueError: A field name is not allowed in a partial update
+    """
+    paths = []
+    for name in names:
+        if not name or '.' in name or name.startswith('$'):
+            raise ValueError('Invalid field name {!r}'.format(name))
+        paths.append('data.{}'.format(name))
+    return paths
+
+
+class CommandStatsListener(monitoring.CommandListener):
+    """
+    Collects command statistics for a MongoClient: the number of commands in flight, the highest number seen, and the
+    number and mean duration of completed commands.
+
+    These are not connection pool statistics. A command in flight holds a pooled connection, but the time spent
+    waiting for or checking out a connection is not included, pymongo 3.2 has no connection pool events to measure it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.succeeded_count = 0
+        self.failed_count = 0
+        self.total_duration_micros = 0
+
+    def started(self, event):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def succeeded(self, event):
+        with self._lock:
+            self.in_flight -= 1
+            self.succeeded_count += 1
+            self.total_duration_micros += event.duration_micros
+
+    def failed(self, event):
+        with self._lock:
+            self.in_flight -= 1
+            self.failed_count += 1
+            self.total_duration_micros += event.duration_micros
+
+    def to_dict(self):
+        with self._lock:
+            completed = self.succeeded_count + self.failed_count
+            return {
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'succeeded': self.succeeded_count,
+                'failed': self.failed_count,
+                'mean_duration_ms': self.total_duration_micros / completed / 1000 if completed else 0,
+            }
+
+
+class MongoClientRegistry(object):
+    """
+    Process wide registry of MongoDB connections, one per db URI, shared by all storage wrappers so that every
+    process only holds a single connection pool per MongoDB deployment.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dbs = {}
+        self._stats = {}
+        self.client_options = {}
+
+    def configure(self, client_options):
+        """
+        :param client_options: pymongo.MongoClient options like maxPoolSize, waitQueueTimeoutMS, connectTimeoutMS
+                               and socketTimeoutMS. Only used for connections created after this call.
+        :type client_options: dict
+        """
+        self.client_options = dict(client_options)
+
+    def get_db(self, db_uri):
+        """
+        :param db_uri: MongoDB URI
+        :type db_uri: str
+        :return: The shared connection for the URI
+        :rtype: pyop.storage.MongoDB
+        """
+        with self._lock:
+            if db_uri not in self._dbs:
+                stats = CommandStatsListener()
+                self._dbs[db_uri] = MongoDB(db_uri, db_name='seleg_op', event_listeners=[stats],
+                                            **self.client_options)
+                self._stats[db_uri] = stats
+            return self._dbs[db_uri]
+
+    def stats(self):
+        """
+        :return: Command statistics per sanitized db URI
+        :rtype: dict
+        """
+        with self._lock:
+            return dict((self._dbs[db_uri].sanitized_uri, stats.to_dict()) for db_uri, stats in self._stats.items())
+
+
+mongo_clients = MongoClientRegistry()
+
+
 class OpStorageWrapper(MongoWrapper):
-    def __init__(self, db_uri, collection):
-        super().__init__(db_uri, 'seleg_op', collection)
+    def __init__(self, db_uri, collection, indexes=None, ttl=None):
+        """
+        :param db_uri: MongoDB URI
+        :type db_uri: str
+        :param collection: Collection name
+        :type collection: str
+        :param indexes: Index specifications, defaults to the ones in COLLECTION_INDEXES for the collection
+        :type indexes: list[dict] | None
+        :param ttl: Lifetime in seconds of written documents, None means the documents never expire
+        :type ttl: int | None
+        """
+        # MongoWrapper.__init__ creates the lookup_key index every time a wrapper is instantiated,
+        # indexes are instead created once by ensure_indexes
+        self._db_uri = db_uri
+        self._coll_name = collection
+        self._db = mongo_clients.get_db(db_uri)
+        self._coll = self._db.get_collection(collection)
+        if indexes is None:
+            indexes = COLLECTION_INDEXES.get(collection, [])
+        self._indexes = [LOOKUP_KEY_INDEX] + list(indexes)
+        self._ttl = ttl
+        if ttl is not None:
+            # MongoDB removes documents when the time in expires_at has passed
+            self._indexes.append({'keys': 'expires_at', 'expireAfterSeconds': 0})
+
+    def __setitem__(self, key, value):
+        doc = {
+            'data': value,
+            'modified_ts': time()
+        }
+        if self._ttl is not None:
+            doc['expires_at'] = datetime.utcnow() + timedelta(seconds=self._ttl)
+        # Replaces the data but keeps counting versions, see update_fields
+        self._coll.update_one({'lookup_key': key}, {'$set': doc, '$inc': {'version': 1}}, upsert=True)
+
+    def get_versioned(self, key):
+        """
+        :param key: Lookup key
+        :type key: str
+        :return: The document data and version, for use with update_fields
+        :rtype: (dict, int)
+        :raise KeyError: There is no document with the lookup key
+        """
+        doc = self._coll.find_one({'lookup_key': key}, projection={'data': True, 'version': True})
+        if doc is None:
+            raise KeyError(key)
+        return doc['data'], doc.get('version', 0)
+
+    def pop(self, key, default=None):
+        """
+        Remove the document and return its data in a single atomic operation, only one of several concurrent callers
+        gets the data.
+
+        :param key: Lookup key
+        :type key: str
+        :param default: Returned if there is no document with the lookup key
+        :return: The document data or default
+        """
+        doc = self._coll.find_one_and_delete({'lookup_key': key}, projection={'data': True})
+        if doc is None:
+            return default
+        return doc['data']
+
+    def take(self, key):
+        """
+        Like pop but raises KeyError if there is no document with the lookup key.
+        """
+        doc = self._coll.find_one_and_delete({'lookup_key': key}, projection={'data': True})
+        if doc is None:
+            raise KeyError(key)
+        return doc['data']
+
+    def update_fields(self, key, fields=None, unset=None, version=None):
+        """
+        Set and remove fields in the document data in a single atomic operation, leaving the other fields as they
+        are. Every write increments the document version.
+
+        :param key: Lookup key
+        :type key: str
+        :param fields: Field names and new values
+        :type fields: dict | None
+        :param unset: Names of fields to remove
+        :type unset: collections.Iterable[str] | None
+        :param version: Only update the document if it still has this version, see get_versioned
+        :type version: int | None
+        :raise KeyError: There is no document with the lookup key
+        :raise VersionConflict: The document does not have the expected version
+        :raise ValueError: A field name contains a dot or starts with $
+        """
+        spec = {'lookup_key': key}
+        if version is not None:
+            # Documents written before versioning was added have no version
+            spec['version'] = version if version else {'$in': [0, None]}
+        result = self._coll.update_one(spec, self._update_document(fields, unset))
+        if not result.matched_count:
+            if version is not None and key in self:
+                raise VersionConflict(key)
+            raise KeyError(key)
+
+    @staticmethod
+    def _update_document(fields=None, unset=None):
+        fields = fields or {}
+        update = {
+            '$set': dict(zip(_field_paths(fields), fields.values()), modified_ts=time()),
+            '$inc': {'version': 1},
+        }
+        if unset:
+            update['$unset'] = dict((path, '') for path in _field_paths(unset))
+        return update
+
+    def bulk_update_fields(self, updates):
+        """
+        Set fields in the data of many documents using a single unordered bulk write. Documents that don't exist are
+        not created.
+
+        :param updates: Lookup key and fields to set for each document
+        :type updates: list[(str, dict)]
+        :return: Error messages for the updates that failed, by position in updates
+        :rtype: dict
+        """
+        errors = {}
+        requests = []
+        positions = []
+        for position, (key, fields) in enumerate(updates):
+            try:
+                requests.append(UpdateOne({'lookup_key': key}, self._update_document(fields)))
+            except ValueError as e:
+                errors[position] = str(e)
+                continue
+            positions.append(position)
+        if not requests:
+            return errors
+        try:
+            self._coll.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                errors[positions[error['index']]] = error['errmsg']
+        return errors
+
+    def existing_keys(self, keys):
+        """
+        :param keys: Lookup keys
+        :type keys: collections.Iterable[str]
+        :return: The lookup keys that have a document
+        :rtype: set[str]
+        """
+        keys = list(set(keys))
+        if not keys:
+            return set()
+        docs = self._coll.find({'lookup_key': {'$in': keys}}, projection={'lookup_key': True, '_id': False})
+        return set(doc['lookup_key'] for doc in docs)
 
-    def get_documents_by_attr(self, attr, value, raise_on_missing=True):
+    @property
+    def index_models(self):
+        """
+        :return: The indexes this collection should have
+        :rtype: list[pymongo.IndexModel]
+        """
+        models = []
+        for spec in self._indexes:
+            options = dict(spec)
+            keys = options.pop('keys')
+            models.append(IndexModel(keys, **options))
+        return models
+
+    def ensure_indexes(self):
+        """
+        Create the indexes this collection should have. Indexes that already exist are left as they are.
+        """
+        self._coll.create_indexes(self.index_models)
+
+    def index_report(self):
+        """
+        Compare the indexes in the db with the index specifications. Index usage statistics requires MongoDB 3.2.
+
+        :return: Names of missing indexes, indexes not in the specifications and indexes never used since the
+                 MongoDB server started, unused is None if the server has no index usage statistics
+        :rtype: dict
+        """
+        expected = [model.document['name'] for model in self.index_models]
+        existing = [name for name in self._coll.index_information() if name != '_id_']
+        try:
+            unused = [stats['name'] for stats in self._coll.aggregate([{'$indexStats': {}}])
+                      if stats['name'] != '_id_' and stats['accesses']['ops'] == 0]
+        except OperationFailure:
+            # $indexStats is not supported before MongoDB 3.2
+            unused = None
+        return {
+            'missing': [name for name in expected if name not in existing],
+            'unknown': [name for name in existing if name not in expected],
+            'unused': unused,
+        }
+
+    def get_many(self, keys):
+        """
+        Return the data for all the given lookup keys using a single query.
+
+        Keys without a matching document are left out of the result.
+
+        :param keys: Lookup keys
+        :type keys: collections.Iterable[str]
+        :return: A dict of lookup_key to data
+        :rtype: dict
+        """
+        keys = list(set(keys))
+        if not keys:
+            return {}
+        docs = self._coll.find({'lookup_key': {'$in': keys}})
+        return dict((doc['lookup_key'], doc['data']) for doc in docs)
+
+    def get_documents_by_attr(self, attr, value, raise_on_missing=True, fields=None, **kwargs):
         """
         Return the document in the MongoDB matching field=value
 
@@ -19,17 +396,18 @@ class OpStorageWrapper(MongoWrapper):
         :type value: str
         :param raise_on_missing:  If True, raise exception if no matching document can be found.
         :type raise_on_missing: bool
+        :param fields: the fields to return in the search result
+        :type fields: dict
+        :param kwargs: sort, limit, skip and batch_size, see get_documents_by_filter
         :return: A tuple of lookup_key, data
         :rtype: tuple
         :raise DocumentDoesNotExist: No document matching the search criteria
         """
-        docs = self._coll.find({attr: value})
-        if docs.count() == 0 and raise_on_missing:
-            raise DocumentDoesNotExist("No document matching %s='%s'" % (attr, value))
-        for doc in docs:
-            yield (doc['lookup_key'], doc['data'])
+        docs = self._find({attr: value}, fields, **kwargs)
+        return self._iter_documents(docs, raise_on_missing, "No document matching %s='%s'" % (attr, value))
 
-    def get_documents_by_filter(self, spec, fields=None, raise_on_missing=True):
+    def get_documents_by_filter(self, spec, fields=None, raise_on_missing=True, sort=None, limit=0, skip=0,
+                                batch_size=0):
         """
         Locate a documents in the db using a custom search filter.
 
@@ -39,15 +417,399 @@ class OpStorageWrapper(MongoWrapper):
         :type fields: dict
         :param raise_on_missing:  If True, raise exception if no matching document can be found.
         :type raise_on_missing: bool
+        :param sort: A list of (key, direction) pairs to sort the result by
+        :type sort: list | None
+        :param limit: The maximum number of documents to return, 0 means no limit
+        :type limit: int
+        :param skip: The number of documents to skip
+        :type skip: int
+        :param batch_size: The number of documents fetched from the db per round trip, 0 means the server default
+        :type batch_size: int
         :return: A document dict
         :rtype: cursor | []
         :raise DocumentDoesNotExist: No document matching the search criteria
         """
-        if fields is None:
-            docs = self._coll.find(spec)
-        else:
-            docs = self._coll.find(spec, fields)
-        if docs.count() == 0 and raise_on_missing:
-            raise DocumentDoesNotExist('No document matching {!s}'.format(spec))
+        docs = self._find(spec, fields, sort=sort, limit=limit, skip=skip, batch_size=batch_size)
+        return self._iter_documents(docs, raise_on_missing, 'No document matching {!s}'.format(spec))
+
+    def _find(self, spec, fields=None, sort=None, limit=0, skip=0, batch_size=0):
+        if fields is not None and any(fields.values()):
+            # Inclusion projection, lookup_key is always needed
+            fields = dict(fields, lookup_key=True)
+        docs = self._coll.find(spec, fields, sort=sort, limit=limit, skip=skip)
+        if batch_size:
+            docs = docs.batch_size(batch_size)
+        return docs
+
+    @staticmethod
+    def _iter_documents(docs, raise_on_missing, error_message):
+        """
+        Yield lookup_key, data tuples from a cursor using a single query. The first document is fetched when the
+        first tuple is requested and DocumentDoesNotExist is raised then if raise_on_missing is set and the cursor is
+        empty.
+        """
+        first = next(docs, None)
+        if first is None:
+            if raise_on_missing:
+                raise DocumentDoesNotExist(error_message)
+            return
+        yield (first['lookup_key'], first.get('data', {}))
         for doc in docs:
+            yield (doc['lookup_key'], doc.get('data', {}))
+
+
+class RedisStorageWrapper(object):
+    """
+    Storage with the same interface as OpStorageWrapper keeping each document as a JSON string in a Redis key.
+
+    Meant for short lived documents that are written once and read by lookup key, like authorization codes.
+    Documents expire natively after ttl seconds. Lookups by other fields than the lookup key scan the whole
+    collection.
+    """
+
+    def __init__(self, connection, collection, ttl=None, scan_count=1000):
+        """
+        :param connection: Redis connection
+        :type connection: redis.StrictRedis
+        :param collection: Collection name
+        :type collection: str
+        :param ttl: Lifetime in seconds of written documents, None means the documents never expire
+        :type ttl: int | None
+        :param scan_count: Number of keys fetched per round trip when scanning the collection
+        :type scan_count: int
+        """
+        self._connection = connection
+        self._coll_name = collection
+        self._ttl = ttl
+        self._scan_count = scan_count
+        self._prefix = 'se_leg_op:storage:{}:'.format(collection)
+
+    def _key(self, lookup_key):
+        return self._prefix + lookup_key
+
+    @staticmethod
+    def _load(value):
+        return json.loads(value.decode('utf-8'))
+
+    def __setitem__(self, key, value):
+        doc = {
+            'lookup_key': key,
+            'data': value,
+            'modified_ts': time()
+        }
+        self._connection.set(self._key(key), json.dumps(doc), ex=self._ttl)
+
+    def __getitem__(self, key):
+        value = self._connection.get(self._key(key))
+        if value is None:
+            raise KeyError(key)
+        return self._load(value)['data']
+
+    def __delitem__(self, key):
+        self._connection.delete(self._key(key))
+
+    def __contains__(self, key):
+        return bool(self._connection.exists(self._key(key)))
+
+    def pop(self, key, default=None):
+        with self._connection.pipeline() as pipeline:
+            # Read and delete in one transaction so that only one caller gets the document
+            pipeline.get(self._key(key))
+            pipeline.delete(self._key(key))
+            value = pipeline.execute()[0]
+        if value is None:
+            return default
+        return self._load(value)['data']
+
+    def take(self, key):
+        """
+        See OpStorageWrapper.take.
+        """
+        missing = object()
+        data = self.pop(key, missing)
+        if data is missing:
+            raise KeyError(key)
+        return data
+
+    def get_versioned(self, key):
+        """
+        See OpStorageWrapper.get_versioned.
+        """
+        value = self._connection.get(self._key(key))
+        if value is None:
+            raise KeyError(key)
+        doc = self._load(value)
+        return doc['data'], doc.get('version', 0)
+
+    def update_fields(self, key, fields=None, unset=None, version=None):
+        """
+        See OpStorageWrapper.update_fields. Writing the whole document with __setitem__ starts over at version 0.
+        """
+        fields = fields or {}
+        unset = list(unset or [])
+        # Validate the field names the same way as the MongoDB backend
+        _field_paths(list(fields) + unset)
+        redis_key = self._key(key)
+
+        def update(pipeline):
+            value = pipeline.get(redis_key)
+            if value is None:
+                raise KeyError(key)
+            ttl = pipeline.pttl(redis_key)
+            doc = self._load(value)
+            if version is not None and doc.get('version', 0) != version:
+                raise VersionConflict(key)
+            doc['data'].update(fields)
+            for name in unset:
+                doc['data'].pop(name, None)
+            doc['modified_ts'] = time()
+            doc['version'] = doc.get('version', 0) + 1
+            pipeline.multi()
+            # Keep the original expiry
+            pipeline.set(redis_key, json.dumps(doc), px=ttl if ttl and ttl > 0 else None)
+
+        # Retried if the document is changed by someone else before the update is written
+        self._connection.transaction(update, redis_key)
+
+    def bulk_update_fields(self, updates):
+        """
+        See OpStorageWrapper.bulk_update_fields.
+        """
+        errors = {}
+        for position, (key, fields) in enumerate(updates):
+            try:
+                self.update_fields(key, fields)
+            except KeyError as e:
+                errors[position] = 'No document {}'.format(e)
+            except ValueError as e:
+                errors[position] = str(e)
+        return errors
+
+    def existing_keys(self, keys):
+        """
+        See OpStorageWrapper.existing_keys.
+        """
+        keys = list(set(keys))
+        with self._connection.pipeline(transaction=False) as pipeline:
+            for key in keys:
+                pipeline.exists(self._key(key))
+            return set(key for key, exists in zip(keys, pipeline.execute()) if exists)
+
+    def items(self):
+        for doc in self._iter_all():
             yield (doc['lookup_key'], doc['data'])
+
+    def _iter_all(self):
+        keys = []
+        for key in self._connection.scan_iter(match=self._prefix + '*', count=self._scan_count):
+            keys.append(key)
+            if len(keys) == self._scan_count:
+                yield from self._mget(keys)
+                keys = []
+        if keys:
+            yield from self._mget(keys)
+
+    def _mget(self, keys):
+        for value in self._connection.mget(keys):
+            # The document may have expired since the key was scanned
+            if value is not None:
+                yield self._load(value)
+
+    def get_many(self, keys):
+        """
+        Return the data for all the given lookup keys using a single round trip.
+
+        Keys without a matching document are left out of the result.
+
+        :param keys: Lookup keys
+        :type keys: collections.Iterable[str]
+        :return: A dict of lookup_key to data
+        :rtype: dict
+        """
+        keys = list(set(keys))
+        if not keys:
+            return {}
+        return dict((doc['lookup_key'], doc['data']) for doc in self._mget([self._key(key) for key in keys]))
+
+    def get_documents_by_attr(self, attr, value, raise_on_missing=True, fields=None, **kwargs):
+        """
+        Return the documents matching field=value, attr is a dotted path like data.client_id. Scans the collection.
+
+        :param attr: The name of a field
+        :type attr: str
+        :param value: The field value
+        :type value: str
+        :param raise_on_missing:  If True, raise exception if no matching document can be found.
+        :type raise_on_missing: bool
+        :param fields: Ignored, the whole document is returned
+        :type fields: dict
+        :param kwargs: limit and skip, see OpStorageWrapper.get_documents_by_filter
+        :return: A tuple of lookup_key, data
+        :rtype: tuple
+        :raise DocumentDoesNotExist: No document matching the search criteria
+        """
+        skip = kwargs.get('skip', 0)
+        limit = kwargs.get('limit', 0)
+        docs = []
+        for doc in self._iter_all():
+            if self._get_path(doc, attr) == value:
+                docs.append(doc)
+                if limit and len(docs) == skip + limit:
+                    break
+        docs = iter(docs[skip:])
+        return OpStorageWrapper._iter_documents(docs, raise_on_missing,
+                                                "No document matching %s='%s'" % (attr, value))
+
+    @staticmethod
+    def _get_path(doc, path):
+        for part in path.split('.'):
+            if not isinstance(doc, dict) or part not in doc:
+                return None
+            doc = doc[part]
+        return doc
+
+    def ensure_indexes(self):
+        """
+        Redis keys need no indexes.
+        """
+        pass
+
+    def index_report(self):
+        return {'missing': [], 'unknown': [], 'unused': []}
+
+
+class BlobStorage(object):
+    """
+    Large binary data, like images, stored in GridFS so that only a reference to it has to be passed around.
+    """
+
+    def __init__(self, db_uri, collection, ttl=None, decode_chunk_size=256 * 1024):
+        """
+        :param db_uri: MongoDB URI
+        :type db_uri: str
+        :param collection: GridFS bucket name
+        :type collection: str
+        :param ttl: Number of seconds after which purge_expired removes a blob, None means never
+        :type ttl: int | None
+        :param decode_chunk_size: Number of base64 characters decoded at a time by put_base64
+        :type decode_chunk_size: int
+        """
+        db = mongo_clients.get_db(db_uri).get_database()
+        self._fs = gridfs.GridFS(db, collection)
+        self._files = db.get_collection('{}.files'.format(collection))
+        self._ttl = ttl
+        # A multiple of 4 so that chunks without whitespace decode on their own
+        self.decode_chunk_size = decode_chunk_size - decode_chunk_size % 4
+
+    def ensure_indexes(self):
+        # Finding expired blobs
+        self._files.create_index('uploadDate')
+
+    def purge_expired(self):
+        """
+        Remove the blobs older than the ttl.
+
+        :return: Number of removed blobs
+        :rtype: int
+        """
+        if self._ttl is None:
+            return 0
+        expired = datetime.utcnow() - timedelta(seconds=self._ttl)
+        count = 0
+        for grid_out in self._fs.find({'uploadDate': {'$lt': expired}}):
+            self._fs.delete(grid_out._id)
+            count += 1
+        return count
+
+    def put(self, data):
+        """
+        :param data: The data, or a file-like object to read it from
+        :type data: bytes | io.RawIOBase
+        :return: Blob id
+        :rtype: str
+        """
+        return str(self._fs.put(data))
+
+    def put_base64(self, encoded):
+        """
+        Decodes and stores base64 encoded data a chunk at a time, the decoded data is never held in memory in full.
+
+        :param encoded: Base64 encoded data, line breaks and other whitespace are ignored
+        :type encoded: str
+        :return: Blob id
+        :rtype: str
+        :raise ValueError: The data is not valid base64
+        """
+        grid_in = self._fs.new_file()
+        try:
+            pending = ''
+            for start in range(0, len(encoded), self.decode_chunk_size):
+                # Whitespace is dropped, characters after the last full 4 character quantum are carried over
+                chunk = pending + ''.join(encoded[start:start + self.decode_chunk_size].split())
+                end = len(chunk) - len(chunk) % 4
+                grid_in.write(b64decode(chunk[:end], validate=True))
+                pending = chunk[end:]
+            if pending:
+                raise binascii.Error('Incorrect padding')
+        except Exception:
+            grid_in.abort()
+            raise
+        grid_in.close()
+        return str(grid_in._id)
+
+    def _object_id(self, blob_id):
+        try:
+            return ObjectId(blob_id)
+        except (InvalidId, TypeError):
+            raise KeyError(blob_id)
+
+    def __getitem__(self, blob_id):
+        try:
+            return self._fs.get(self._object_id(blob_id)).read()
+        except gridfs.NoFile:
+            raise KeyError(blob_id)
+
+    def __delitem__(self, blob_id):
+        self._fs.delete(self._object_id(blob_id))
+
+    def __contains__(self, blob_id):
+        try:
+            return self._fs.exists(self._object_id(blob_id))
+        except KeyError:
+            return False
+
+
+def init_blob_storage(config, collection):
+    """
+    :param config: App config
+    :type config: dict
+    :param collection: GridFS bucket name
+    :type collection: str
+    :rtype: BlobStorage
+    """
+    blob_ttl = dict(BLOB_TTL, **config.get('DB_BLOB_TTL', {}))
+    return BlobStorage(config['DB_URI'], BLOB_COLLECTION_PREFIX + collection, ttl=blob_ttl.get(collection))
+
+
+def init_storage(config, collection):
+    """
+    :param config: App config
+    :type config: dict
+    :param collection: Collection name
+    :type collection: str
+    :return: Storage for the collection configured from the app config
+    :rtype: OpStorageWrapper | RedisStorageWrapper
+    :raise ValueError: The backend is unknown or can't store the collection
+    """
+    collection_ttl = dict(COLLECTION_TTL, **config.get('DB_COLLECTION_TTL', {}))
+    collection_backend = dict(COLLECTION_BACKEND, **config.get('DB_COLLECTION_BACKEND', {}))
+    backend = collection_backend.get(collection, 'mongodb')
+    if backend == 'redis':
+        if collection not in REDIS_COLLECTIONS:
+            raise ValueError('Collection {} can not be stored in redis, only {}'.format(
+                collection, ', '.join(sorted(REDIS_COLLECTIONS))))
+        return RedisStorageWrapper(redis_connections.get_connection(config), collection,
+                                   ttl=collection_ttl.get(collection))
+    if backend != 'mongodb':
+        raise ValueError('Unknown storage backend {} for collection {}'.format(backend, collection))
+    return OpStorageWrapper(config['DB_URI'], collection, ttl=collection_ttl.get(collection))
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import MagicMock
+
+import pytest
+from redis.exceptions import ConnectionError
+
+from se_leg_op.plugins.nstic_vetting_process.api_auth import ApiAuthenticator, check_secret, hash_secret
+
+TEST_CLIENT_ID = 'client1'
+TEST_CLIENT_SECRET = 'client_secret'
+
+
+class CountingClientDB(dict):
+    def __init__(self, *args, **kwargs):
+        super(CountingClientDB, self).__init__(*args, **kwargs)
+        self.lookups = 0
+
+    def __getitem__(self, key):
+        self.lookups += 1
+        return super(CountingClientDB, self).__getitem__(key)
+
+
+@pytest.fixture
+def clients_db():
+    return CountingClientDB({TEST_CLIENT_ID: {'client_secret': TEST_CLIENT_SECRET}})
+
+
+def authenticator(clients_db, **kwargs):
+    return ApiAuthenticator(clients_db, [TEST_CLIENT_ID], {'admin1': {'secret': hash_secret('admin_secret')}},
+                            **kwargs)
+
+
+class TestSecrets(object):
+    def test_plain_secret(self):
+        assert check_secret('secret', 'secret')
+        assert not check_secret('secret', 'Secret')
+
+    def test_hashed_secret(self):
+        hashed = hash_secret('secret', iterations=1000)
+        assert hashed.startswith('pbkdf2_sha256$1000$')
+        assert check_secret(hashed, 'secret')
+        assert not check_secret(hashed, 'other')
+
+    def test_malformed_hashed_secret(self):
+        assert not check_secret('pbkdf2_sha256$notanumber$c2FsdA==$aGFzaA==', 'secret')
+
+
+class TestApiAuthenticator(object):
+    def test_client(self, clients_db):
+        auth = authenticator(clients_db)
+        assert auth.authenticate(TEST_CLIENT_ID, TEST_CLIENT_SECRET) == TEST_CLIENT_ID
+        assert auth.authenticate(TEST_CLIENT_ID, 'wrong') is None
+
+    def test_admin(self, clients_db):
+        auth = authenticator(clients_db)
+        assert auth.authenticate('admin1', 'admin_secret') == 'admin'
+        assert auth.authenticate('admin1', 'wrong') is None
+
+    def test_unknown_username(self, clients_db):
+        assert authenticator(clients_db).authenticate('unknown', TEST_CLIENT_SECRET) is None
+        assert clients_db.lookups == 0
+
+    def test_client_not_registered(self):
+        assert authenticator(CountingClientDB()).authenticate(TEST_CLIENT_ID, TEST_CLIENT_SECRET) is None
+
+    def test_verified_credentials_are_cached(self, clients_db):
+        auth = authenticator(clients_db)
+        for i in range(3):
+            assert auth.authenticate(TEST_CLIENT_ID, TEST_CLIENT_SECRET) == TEST_CLIENT_ID
+        assert clients_db.lookups == 1
+        # A wrong password is not accepted because of the cached credentials
+        assert auth.authenticate(TEST_CLIENT_ID, 'wrong') is None
+
+    def test_cache_disabled(self, clients_db):
+        auth = authenticator(clients_db, cache_ttl=0)
+        for i in range(3):
+            assert auth.authenticate(TEST_CLIENT_ID, TEST_CLIENT_SECRET) == TEST_CLIENT_ID
+        assert clients_db.lookups == 3
+
+    def test_failures_are_counted(self, clients_db):
+        connection = MagicMock()
+        pipeline = connection.pipeline.return_value.__enter__.return_value
+        auth = authenticator(clients_db, connection=connection, failure_window=60)
+        auth.authenticate(TEST_CLIENT_ID, 'wrong')
+        pipeline.incr.assert_called_once_with('se_leg_op:yubico_api:auth_failures:client1')
+        pipeline.expire.assert_called_once_with('se_leg_op:yubico_api:auth_failures:client1', 60)
+
+    def test_too_many_failures(self, clients_db):
+        connection = MagicMock()
+        connection.get.return_value = b'5'
+        auth = authenticator(clients_db, connection=connection, max_failures=5)
+        assert auth.authenticate(TEST_CLIENT_ID, TEST_CLIENT_SECRET) is None
+        assert clients_db.lookups == 0
+
+        connection.get.return_value = b'4'
+        assert auth.authenticate(TEST_CLIENT_ID, TEST_CLIENT_SECRET) == TEST_CLIENT_ID
+
+    def test_successful_login_resets_failures(self, clients_db):
+        connection = MagicMock()
+        connection.get.return_value = b'3'
+        auth = authenticator(clients_db, connection=connection, max_failures=5)
+        assert auth.authenticate(TEST_CLIENT_ID, TEST_CLIENT_SECRET) == TEST_CLIENT_ID
+        connection.delete.assert_called_once_with('se_leg_op:yubico_api:auth_failures:client1')
+
+        # A failure drops the cached credentials so that the next login resets the failures again
+        auth.authenticate(TEST_CLIENT_ID, 'wrong')
+        assert auth.authenticate(TEST_CLIENT_ID, TEST_CLIENT_SECRET) == TEST_CLIENT_ID
+        assert connection.delete.call_count == 2
+
+    def test_redis_error(self, clients_db):
+        connection = MagicMock()
+        connection.get.side_effect = ConnectionError()
+        connection.pipeline.side_effect = ConnectionError()
+        connection.delete.side_effect = ConnectionError()
+        auth = authenticator(clients_db, connection=connection, max_failures=5)
+        # The credentials are still verified
+        assert auth.authenticate(TEST_CLIENT_ID, 'wrong') is None
+        assert auth.authenticate(TEST_CLIENT_ID, TEST_CLIENT_SECRET) == TEST_CLIENT_ID
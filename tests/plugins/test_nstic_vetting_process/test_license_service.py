@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+from unittest import mock
+
+from requests.exceptions import ConnectionError
+
+from se_leg_op.plugins.nstic_vetting_process.license_service import LicenseService, SoapClasses, create_session
+from se_leg_op.plugins.nstic_vetting_process import license_service_worker
+from se_leg_op.plugins.nstic_vetting_process.license_service_worker import WorkerContext
+
+
+LOAD_SOAP_CLASSES = 'se_leg_op.plugins.nstic_vetting_process.license_service.load_soap_classes'
+
+
+def mock_soap_classes():
+    return SoapClasses(*[mock.MagicMock() for field in SoapClasses._fields])
+
+
+def test_create_session():
+    session = create_session(8)
+    adapter = session.get_adapter('https://mobile-verify.example.com/')
+    assert adapter._pool_maxsize == 8
+    assert session.get_adapter('http://mobile-verify.example.com/') is adapter
+
+
+@mock.patch(LOAD_SOAP_CLASSES, return_value=mock_soap_classes())
+def test_license_service_without_session(load_soap_classes):
+    service = LicenseService('https://localhost/wsdl', 'soap_user', 'secret', 'tenant_ref')
+    assert 'transport' not in load_soap_classes.return_value.MitekMobileVerifyService.call_args[1]
+    # Closing without a session is a no-op
+    service.close()
+
+
+class StubTransport(object):
+    def __init__(self):
+        self.session = None
+        self.load_timeout = None
+        self.operation_timeout = None
+
+
+class StubClient(object):
+    def __init__(self):
+        self.transport = StubTransport()
+
+
+class StubService(object):
+    """
+    Has the signature the service is called with, without a transport keyword, and wraps a zeep client.
+    """
+
+    def __init__(self, wsdl, username, password, plugins=None):
+        self.client = StubClient()
+
+
+class StubTransportService(object):
+    def __init__(self, wsdl, username, password, plugins=None, transport=None):
+        self.transport = transport
+
+
+def test_license_service_without_transport_keyword():
+    soap_classes = mock_soap_classes()._replace(MitekMobileVerifyService=StubService)
+    session = create_session(4)
+    with mock.patch(LOAD_SOAP_CLASSES, return_value=soap_classes):
+        service = LicenseService('https://localhost/wsdl', 'soap_user', 'secret', 'tenant_ref', session=session,
+                                 timeout=30, wsdl_cache='/tmp/wsdl_cache.db')
+    transport = service.soap_service.client.transport
+    assert transport.session is session
+    assert transport.load_timeout == 30
+    assert transport.operation_timeout == 30
+    assert not soap_classes.Transport.called
+
+
+def test_license_service_with_transport_keyword():
+    soap_classes = mock_soap_classes()._replace(MitekMobileVerifyService=StubTransportService)
+    session = create_session(4)
+    with mock.patch(LOAD_SOAP_CLASSES, return_value=soap_classes):
+        service = LicenseService('https://localhost/wsdl', 'soap_user', 'secret', 'tenant_ref', session=session,
+                                 timeout=30)
+    assert service.soap_service.transport is soap_classes.Transport.return_value
+    assert soap_classes.Transport.call_args[1] == {'session': session, 'operation_timeout': 30, 'timeout': 30}
+
+
+WORKER_CONFIG = {
+    'MOBILE_VERIFY_WSDL': 'https://localhost/wsdl',
+    'MOBILE_VERIFY_USERNAME': 'soap_user',
+    'MOBILE_VERIFY_PASSWORD': 'secret',
+    'MOBILE_VERIFY_TENANT_REF': 'tenant_ref',
+    'NSTIC_VETTING_PROCESS_AUDIT_LOG_FILE': '/dev/null',
+    'DB_URI': 'mongodb://localhost:27017',
+}
+
+
+@mock.patch(LOAD_SOAP_CLASSES, return_value=mock_soap_classes())
+def test_worker_context_creates_license_service_on_first_use(load_soap_classes):
+    soap_service = load_soap_classes.return_value.MitekMobileVerifyService
+    context = WorkerContext(WORKER_CONFIG)
+    assert not soap_service.called
+    assert context.license_service is context.license_service
+    assert soap_service.call_count == 1
+
+
+@mock.patch(LOAD_SOAP_CLASSES, return_value=mock_soap_classes())
+def test_worker_context_retries_wsdl_fetch(load_soap_classes):
+    soap_service = load_soap_classes.return_value.MitekMobileVerifyService
+    soap_service.side_effect = [ConnectionError(), mock.Mock()]
+    context = WorkerContext(WORKER_CONFIG)
+    assert context.preload() is None
+    assert context.license_service is not None
+    assert soap_service.call_count == 2
+
+
+@mock.patch.object(license_service_worker, '_context', None)
+@mock.patch.object(license_service_worker, 'WorkerContext')
+def test_preload_uses_pool_config(worker_context):
+    license_service_worker.preload(WORKER_CONFIG)
+    worker_context.assert_called_once_with(WORKER_CONFIG)
+    assert worker_context.return_value.preload.called
+    assert license_service_worker.get_context() is worker_context.return_value
@@ -1,4 +1,5 @@
 
+import base64
 import pytest
 import responses
 import datetime
@@ -10,6 +11,7 @@ from unittest import mock
 from urllib import parse
 from rq import SimpleWorker
 
+from se_leg_op.plugins.nstic_vetting_process.license_service import load_soap_classes
 from se_leg_op.storage import OpStorageWrapper
 from tests.conftest import inject_app as main_inject_app
 
@@ -251,9 +253,11 @@ def vetting_data():
 
 @pytest.yield_fixture
 def mock_soap_client():
-    patcher = mock.patch('se_leg_op.plugins.nstic_vetting_process.license_service.MitekMobileVerifyService',
-                         new=mock.Mock)
-    soap_client = patcher.start()
+    soap_classes = load_soap_classes()._replace(MitekMobileVerifyService=mock.Mock)
+    patcher = mock.patch('se_leg_op.plugins.nstic_vetting_process.license_service.load_soap_classes',
+                         return_value=soap_classes)
+    patcher.start()
+    soap_client = soap_classes.MitekMobileVerifyService
     soap_client.verify = mock.Mock(return_value=SUCCESSFUL_SOAP_RESPONSE)
     yield soap_client
     patcher.stop()
@@ -295,11 +299,16 @@ class TestVettingResultEndpoint(object):
         assert nonce not in self.app.authn_requests
         # check yubico state
         assert state in self.app.yubico_states
+        # only a reference to the image is queued
+        front_image_id = self.app.mobile_verify_service_queue.jobs[0].args[1]
+        assert self.app.yubico_images[front_image_id] == base64.b64decode(VETTING_DATA['encodedData'])
         # Force processing if message queue
         self.force_send_all_queued_messages()
         # verify the posted data ends up in the userinfo document
         # Just check keys as the datetimes are different due to mongodb
         assert self.app.users[TEST_USER_ID]['vetting_result']['data'].keys() == SUCCESSFUL_VETTING_RESULT.keys()
+        # the image is removed after the verification
+        assert front_image_id not in self.app.yubico_images
 
     @responses.activate
     def test_vetting_endpoint_existing_yubico_state(self, authn_request_args, vetting_data):
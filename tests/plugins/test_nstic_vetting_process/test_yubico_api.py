@@ -142,6 +142,33 @@ class TestYubicoApi(object):
         json_resp = self.get_json(resp)
         assert len(json_resp['states']) == 6
 
+    def test_get_states_endpoint_paginated(self, basic_auth_header):
+        resp = self.app.test_client().get(API_ENDPOINT + '?limit=3', headers=basic_auth_header)
+        assert resp.status_code == 200
+        json_resp = self.get_json(resp)
+        assert len(json_resp['states']) == 3
+        assert 'next' in json_resp
+        first_page = [state['state'] for state in json_resp['states']]
+        assert first_page == sorted(first_page)
+
+        resp = self.app.test_client().get(API_ENDPOINT + '?limit=3&after={}'.format(json_resp['next']),
+                                          headers=basic_auth_header)
+        assert resp.status_code == 200
+        json_resp = self.get_json(resp)
+        assert len(json_resp['states']) == 1
+        assert 'next' not in json_resp
+        assert json_resp['states'][0]['state'] > first_page[-1]
+        assert 'vetting_result' in json_resp['states'][0]['userinfo']
+
+    @pytest.mark.parametrize('query', [
+        '?limit=0',
+        '?limit=foo',
+        '?after=%',
+    ])
+    def test_get_states_endpoint_bad_pagination(self, basic_auth_header, query):
+        resp = self.app.test_client().get(API_ENDPOINT + query, headers=basic_auth_header)
+        assert resp.status_code == 400
+
     def test_update_states_endpoint(self, basic_auth_header):
         data = {'states': []}
         for state in states():
@@ -238,6 +265,39 @@ class TestYubicoApi(object):
             assert 'userinfo' in state
             assert 'vetting_result' in state['userinfo']
 
+    def test_update_states_endpoint_missing_userinfo(self, basic_auth_header):
+        data = {'states': []}
+        for state in states():
+            if state['client_id'] == TEST_CLIENT_ID:
+                state['userinfo'] = userinfo()
+                state['test_update'] = True
+                data['states'].append(state)
+        missing_userinfo_state = data['states'][0]
+        del self.app.users[missing_userinfo_state['user_id']]
+        resp = self.app.test_client().post(API_ENDPOINT, headers=basic_auth_header, content_type='application/json',
+                                           data=json.dumps(data))
+        assert resp.status_code == 422
+        assert self.get_json(resp)['errors'] == [missing_userinfo_state['state']]
+
+        # The other states are updated
+        for state in data['states'][1:]:
+            assert self.app.yubico_states[state['state']]['test_update']
+        assert 'test_update' not in self.app.yubico_states[missing_userinfo_state['state']]
+
+    def test_update_states_endpoint_state_only_missing_userinfo(self, basic_auth_header):
+        data = {'states': []}
+        for state in states():
+            if state['client_id'] == TEST_CLIENT_ID:
+                state['test_update'] = True
+                data['states'].append(state)
+        missing_userinfo_state = data['states'][0]
+        del self.app.users[missing_userinfo_state['user_id']]
+        resp = self.app.test_client().post(API_ENDPOINT, headers=basic_auth_header, content_type='application/json',
+                                           data=json.dumps(data))
+        assert resp.status_code == 202
+        for state in data['states']:
+            assert self.app.yubico_states[state['state']]['test_update']
+
     def test_get_state_endpoint(self, basic_auth_header):
         state_id = states()[0]['state']
         endpoint = API_ENDPOINT + '/{}'.format(state_id)
@@ -336,6 +396,16 @@ class TestYubicoApi(object):
         assert 'userinfo' in json_resp
         assert 'vetting_result' in json_resp['userinfo']
 
+    @pytest.mark.parametrize('field', ['$where', 'vetting_result.data'])
+    def test_update_state_endpoint_invalid_field(self, basic_auth_header, field):
+        data = states()[0]
+        data['userinfo'] = {field: True}
+        endpoint = API_ENDPOINT + '/{}'.format(data['state'])
+        resp = self.app.test_client().post(endpoint, headers=basic_auth_header, content_type='application/json',
+                                           data=json.dumps(data))
+        assert resp.status_code == 400
+        assert self.get_json(resp)['status'] == 'Bad Request'
+
     @pytest.mark.parametrize('state_id', [
         '9bdc12b7949e-5e5c-4bc5-a377-95ed786b'
     ])
@@ -138,3 +138,9 @@ class TestApp(object):
         userinfo = self.make_userinfo_request(refresh_resp['access_token'])
         assert token_resp['id_token']['sub'] == userinfo['sub']
         assert userinfo['identity'] == TEST_USER_ID
+
+    def test_startup_profile(self):
+        phases = self.app.startup_profile['phases']
+        assert list(phases) == ['config', 'plugin packages', 'plugin extensions', 'plugin config', 'plugin blueprints',
+                                'storage', 'redis', 'provider', 'db indexes']
+        assert self.app.startup_profile['total'] >= sum(phases.values())
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+from se_leg_op.service.db_indexes import PROVIDER_COLLECTIONS, known_collections
+
+
+def test_known_collections():
+    assert known_collections({}) == PROVIDER_COLLECTIONS
+    config = {'PACKAGES': ['se_leg_op.plugins.se_leg_vetting_process', 'se_leg_op.plugins.nstic_vetting_process']}
+    assert known_collections(config) == PROVIDER_COLLECTIONS + ['yubico_states']
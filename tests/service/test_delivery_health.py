@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import redis
+
+from se_leg_op.service.delivery_health import CircuitBreaker, DeliveryMetrics
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def connection(redis_instance):
+    connection = redis.StrictRedis.from_url(redis_instance.get_uri())
+    connection.flushdb()
+    return connection
+
+
+class TestCircuitBreaker(object):
+    def test_opens_after_consecutive_failures(self, connection):
+        timer = FakeTimer()
+        breaker = CircuitBreaker(connection, failure_threshold=3, open_seconds=30, timer=timer)
+        for i in range(2):
+            breaker.record_failure('rp.example.com')
+        assert breaker.allow('rp.example.com') == (True, False)
+        breaker.record_failure('rp.example.com')
+        assert breaker.state('rp.example.com') == 'open'
+        assert breaker.allow('rp.example.com') == (False, False)
+        assert breaker.retry_after('rp.example.com') == 30
+        # Other hosts are not affected
+        assert breaker.allow('other.example.com') == (True, False)
+
+    def test_success_resets_failures(self, connection):
+        breaker = CircuitBreaker(connection, failure_threshold=2)
+        breaker.record_failure('rp.example.com')
+        breaker.record_success('rp.example.com')
+        breaker.record_failure('rp.example.com')
+        assert breaker.state('rp.example.com') == 'closed'
+
+    def test_half_open_allows_one_probe(self, connection):
+        timer = FakeTimer()
+        breaker = CircuitBreaker(connection, failure_threshold=1, open_seconds=30, timer=timer)
+        breaker.record_failure('rp.example.com')
+        timer.now += 30
+        assert breaker.state('rp.example.com') == 'half-open'
+        assert breaker.allow('rp.example.com') == (True, True)
+        assert breaker.allow('rp.example.com') == (False, False)
+
+        # A failed probe opens the circuit again
+        breaker.record_failure('rp.example.com')
+        assert breaker.state('rp.example.com') == 'open'
+        timer.now += 30
+        assert breaker.allow('rp.example.com') == (True, True)
+        breaker.record_success('rp.example.com')
+        assert breaker.state('rp.example.com') == 'closed'
+
+    def test_released_probe(self, connection):
+        timer = FakeTimer()
+        breaker = CircuitBreaker(connection, failure_threshold=1, open_seconds=30, timer=timer)
+        breaker.record_failure('rp.example.com')
+        timer.now += 30
+        assert breaker.allow('rp.example.com') == (True, True)
+        breaker.release_probe('rp.example.com')
+        assert breaker.state('rp.example.com') == 'half-open'
+        assert breaker.allow('rp.example.com') == (True, True)
+
+
+class TestDeliveryMetrics(object):
+    def test_stats(self, connection):
+        metrics = DeliveryMetrics(connection, buckets=(0.1, 1))
+        metrics.record('rp.example.com', True, 0.05)
+        metrics.record('rp.example.com', True, 0.5)
+        metrics.record('rp.example.com', False, 5)
+        metrics.record('other.example.com', True, 0.5)
+
+        stats = metrics.stats()
+        assert set(stats) == {'rp.example.com', 'other.example.com'}
+        assert stats['rp.example.com']['success'] == 2
+        assert stats['rp.example.com']['total'] == 3
+        assert stats['rp.example.com']['success_rate'] == pytest.approx(2 / 3)
+        assert stats['rp.example.com']['mean_duration'] == pytest.approx(5.55 / 3)
+        assert stats['rp.example.com']['histogram'] == [(0.1, 1), (1, 2), ('inf', 3)]
+
+        metrics.reset()
+        assert metrics.stats() == {}
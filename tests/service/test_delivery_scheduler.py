@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import sys
+from unittest import mock
+
+import pytest
+import redis
+import rq
+from requests.exceptions import ConnectionError
+
+from se_leg_op.service import delivery_scheduler
+from se_leg_op.service.delivery_scheduler import DeliveryScheduler
+from se_leg_op.service.response_sender import DeliveryError
+
+
+def failing_task(error):
+    raise error
+
+
+def exc_info_of(error):
+    try:
+        raise error
+    except Exception:
+        return sys.exc_info()
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+class TestBackoff(object):
+    def test_backoff_is_exponential_and_capped(self):
+        scheduler = DeliveryScheduler(rq.Queue('test', connection=redis.StrictRedis()), base_delay=2, max_delay=60,
+                                      random=lambda: 1.0)
+        assert [scheduler.backoff(attempts) for attempts in range(1, 7)] == [2, 4, 8, 16, 32, 60]
+
+    def test_backoff_jitter(self):
+        scheduler = DeliveryScheduler(rq.Queue('test', connection=redis.StrictRedis()), base_delay=2,
+                                      random=lambda: 0.0)
+        assert scheduler.backoff(3) == 4
+
+
+@mock.patch.object(delivery_scheduler, '_scheduler', None)
+def test_module_exception_handler(tmpdir, monkeypatch):
+    config_file = tmpdir.join('app_config.py')
+    config_file.write("REDIS_URI = 'redis://localhost:6379/0'\nDELIVERY_MAX_ATTEMPTS = 5\n")
+    monkeypatch.setenv('SE_LEG_PROVIDER_SETTINGS', str(config_file))
+    job = mock.Mock()
+    with mock.patch.object(DeliveryScheduler, 'handle_exception', autospec=True, return_value=False) as handle:
+        exc_info = exc_info_of(ConnectionError())
+        assert delivery_scheduler.handle_exception(job, *exc_info) is False
+        delivery_scheduler.handle_exception(job, *exc_info)
+    scheduler = handle.call_args[0][0]
+    assert scheduler.queue.name == 'authn_responses'
+    assert scheduler.max_attempts == 5
+    # The scheduler is created once
+    assert handle.call_args_list[0][0][0] is scheduler
+
+
+class TestDeliveryScheduler(object):
+    @pytest.fixture(autouse=True)
+    def setup(self, redis_instance):
+        self.connection = redis.StrictRedis.from_url(redis_instance.get_uri())
+        self.connection.flushdb()
+        self.queue = rq.Queue('authn_responses', connection=self.connection)
+        self.timer = FakeTimer()
+        self.scheduler = DeliveryScheduler(self.queue, max_attempts=3, base_delay=10, random=lambda: 1.0,
+                                           timer=self.timer)
+
+    def fail(self, error):
+        job = self.queue.dequeue()
+        self.scheduler.handle_exception(job, *exc_info_of(error))
+
+    def test_retryable_error_is_scheduled(self):
+        job = self.queue.enqueue(failing_task, ConnectionError())
+        self.fail(ConnectionError())
+        assert self.queue.count == 0
+
+        self.timer.now += 9
+        assert self.scheduler.enqueue_due() == 0
+        self.timer.now += 1
+        assert self.scheduler.enqueue_due() == 1
+        assert self.queue.job_ids == [job.id]
+        assert self.queue.fetch_job(job.id).meta['attempts'] == 1
+
+    def test_retry_budget(self):
+        job = self.queue.enqueue(failing_task, ConnectionError())
+        for i in range(3):
+            self.fail(DeliveryError('server error', retryable=True))
+            self.timer.now += 100
+            self.scheduler.enqueue_due()
+        assert self.queue.count == 0
+        assert self.scheduler.dead_letter_ids() == [job.id]
+        assert self.scheduler.dead_letters()[0].meta['attempts'] == 3
+
+    def test_non_retryable_error_is_dead_lettered(self):
+        job = self.queue.enqueue(failing_task, ConnectionError())
+        self.fail(DeliveryError('not found', retryable=False))
+        assert self.scheduler.dead_letter_ids() == [job.id]
+
+    def test_replay(self):
+        job = self.queue.enqueue(failing_task, ConnectionError())
+        self.fail(DeliveryError('not found', retryable=False))
+        assert self.scheduler.replay(job.id)
+        assert self.scheduler.dead_letter_ids() == []
+        assert self.queue.job_ids == [job.id]
+        assert 'attempts' not in self.queue.fetch_job(job.id).meta
+        assert not self.scheduler.replay(job.id)
+
+    def test_purge(self):
+        job = self.queue.enqueue(failing_task, ConnectionError())
+        self.fail(DeliveryError('not found', retryable=False))
+        assert self.scheduler.purge(job.id)
+        assert self.scheduler.dead_letter_ids() == []
+        assert self.queue.fetch_job(job.id) is None
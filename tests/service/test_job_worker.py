@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import deque
+from unittest.mock import MagicMock
+
+from redis import StrictRedis
+from rq import Queue
+
+from se_leg_op.service.job_worker import ConcurrentWorker
+from se_leg_op.service.response_sender import SessionPool
+
+
+class FakeJob(object):
+    def __init__(self, id, key):
+        self.id = id
+        self.key = key
+
+
+class RecordingWorker(ConcurrentWorker):
+    def __init__(self, jobs, **kwargs):
+        super(RecordingWorker, self).__init__([], None, concurrency_key=lambda job: job.key, **kwargs)
+        self.jobs = deque(jobs)
+        self.performed = []
+        self.running = {}
+        self.max_running = {}
+        self.record_lock = threading.Lock()
+
+    def dequeue(self, block, timeout):
+        if self.jobs:
+            return self.jobs.popleft()
+        return None
+
+    def perform_job(self, job):
+        with self.record_lock:
+            self.running[job.key] = self.running.get(job.key, 0) + 1
+            self.max_running[job.key] = max(self.max_running.get(job.key, 0), self.running[job.key])
+        time.sleep(0.01)
+        with self.record_lock:
+            self.running[job.key] -= 1
+            self.performed.append(job.id)
+        return True
+
+
+class TestConcurrentWorker(object):
+    def test_all_jobs_are_performed(self):
+        jobs = [FakeJob(i, i % 3) for i in range(30)]
+        worker = RecordingWorker(jobs, max_workers=5)
+        worker.work(burst=True)
+        assert sorted(worker.performed) == list(range(30))
+
+    def test_concurrency_per_key(self):
+        jobs = [FakeJob(i, 'a') for i in range(10)] + [FakeJob(i, 'b') for i in range(10, 12)]
+        worker = RecordingWorker(jobs, max_workers=8, max_per_key=2)
+        worker.work(burst=True)
+        assert sorted(worker.performed) == list(range(12))
+        assert worker.max_running['a'] <= 2
+        assert worker.max_running['b'] <= 2
+
+    def test_exception_handlers(self):
+        worker = RecordingWorker([], max_workers=1)
+        handled = []
+        worker.exception_handlers = [lambda job, *exc_info: handled.append(('first', job.id)),
+                                     lambda job, *exc_info: handled.append(('second', job.id)) and False]
+        worker.handle_exception(FakeJob(1, 'a'), ValueError, ValueError(), None)
+        # Handlers returning None fall through to the next handler
+        assert handled == [('second', 1), ('first', 1)]
+
+    def test_idle_worker_keeps_polling(self):
+        connection = StrictRedis()
+        # An empty queue, the blocking pop times out
+        connection.blpop = MagicMock(return_value=None)
+        connection.lpop = MagicMock(return_value=None)
+        worker = ConcurrentWorker([Queue('test', connection=connection)], connection, max_workers=1)
+        polls = []
+
+        def before_dequeue():
+            polls.append(1)
+            if len(polls) == 3:
+                worker.stop()
+        worker.before_dequeue = before_dequeue
+        worker.work(burst=False, poll_timeout=1)
+        assert len(polls) == 3
+        assert connection.blpop.call_count == 3
+
+
+class TestSessionPool(object):
+    def test_one_session_per_host(self):
+        pool = SessionPool()
+        session = pool.get('https://client.example.com/redirect_uri?code=1')
+        assert pool.get('https://client.example.com/other') is session
+        assert pool.get('https://other.example.com/redirect_uri') is not session
+        assert pool.get('http://client.example.com/redirect_uri') is not session
+        pool.close()
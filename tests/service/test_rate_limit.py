@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import MagicMock
+
+import pytest
+import redis
+from flask import Flask
+from redis.exceptions import ConnectionError
+
+from se_leg_op.service.rate_limit import RateLimiter, check_rate_limit
+
+ENDPOINT = 'test_endpoint'
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def connection(redis_instance):
+    connection = redis.StrictRedis.from_url(redis_instance.get_uri())
+    connection.flushdb()
+    return connection
+
+
+class TestRateLimiter(object):
+    def test_burst_then_limited(self, connection):
+        limiter = RateLimiter(connection, timer=FakeTimer())
+        for i in range(3):
+            assert limiter.consume('client1', rate=1, burst=3) == (True, 0)
+        allowed, retry_after = limiter.consume('client1', rate=1, burst=3)
+        assert not allowed
+        assert retry_after == pytest.approx(1)
+        # Other clients have their own bucket
+        assert limiter.consume('client2', rate=1, burst=3)[0]
+
+    def test_tokens_are_refilled(self, connection):
+        timer = FakeTimer()
+        limiter = RateLimiter(connection, timer=timer)
+        for i in range(2):
+            limiter.consume('client1', rate=2, burst=2)
+        assert not limiter.consume('client1', rate=2, burst=2)[0]
+        timer.now += 0.5
+        assert limiter.consume('client1', rate=2, burst=2)[0]
+        assert not limiter.consume('client1', rate=2, burst=2)[0]
+        # Never more than burst tokens
+        timer.now += 100
+        for i in range(2):
+            assert limiter.consume('client1', rate=2, burst=2)[0]
+        assert not limiter.consume('client1', rate=2, burst=2)[0]
+
+    def test_bucket_expires(self, connection):
+        RateLimiter(connection).consume('client1', rate=1, burst=10)
+        assert 0 < connection.pttl('se_leg_op:rate_limit:client1') <= 11000
+
+
+class TestCheckRateLimit(object):
+    @pytest.fixture
+    def app(self):
+        app = Flask('se_leg_op')
+        app.config['RATE_LIMITS'] = {ENDPOINT: {'rate': 1, 'burst': 5}}
+        app.provider = MagicMock()
+        app.provider.clients = {'client1': {}, 'client2': {'rate_limits': {ENDPOINT: {'rate': 10, 'burst': 50}}}}
+        app.rate_limiter = MagicMock()
+        app.rate_limiter.consume.return_value = (True, 0)
+        app.add_url_rule('/test', ENDPOINT, lambda: 'OK')
+        app.add_url_rule('/unlimited', 'unlimited', lambda: 'OK')
+        return app
+
+    def test_allowed(self, app):
+        with app.test_request_context('/test'):
+            assert check_rate_limit('client1') is None
+        app.rate_limiter.consume.assert_called_once_with('test_endpoint:client1', 1, 5)
+
+    def test_over_limit(self, app):
+        app.rate_limiter.consume.return_value = (False, 1.2)
+        with app.test_request_context('/test'):
+            response = check_rate_limit('client1')
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '2'
+
+    def test_client_override(self, app):
+        with app.test_request_context('/test'):
+            check_rate_limit('client2')
+        app.rate_limiter.consume.assert_called_once_with('test_endpoint:client2', 10, 50)
+
+    def test_unknown_client_uses_remote_address(self, app):
+        with app.test_request_context('/test', environ_base={'REMOTE_ADDR': '192.0.2.1'}):
+            check_rate_limit(None)
+        app.rate_limiter.consume.assert_called_once_with('test_endpoint:192.0.2.1', 1, 5)
+
+    def test_endpoint_not_limited(self, app):
+        with app.test_request_context('/unlimited'):
+            assert check_rate_limit('client1') is None
+        assert not app.rate_limiter.consume.called
+
+    def test_redis_error_allows_request(self, app):
+        app.rate_limiter.consume.side_effect = ConnectionError()
+        with app.test_request_context('/test'):
+            assert check_rate_limit('client1') is None
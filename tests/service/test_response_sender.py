@@ -7,7 +7,7 @@ import rq
 from oic.oic.message import AuthorizationResponse
 from redis.client import StrictRedis
 
-from se_leg_op.service.response_sender import deliver_response_task
+from se_leg_op.service.response_sender import DeliveryError, deliver_response_task
 
 
 @pytest.fixture
@@ -28,3 +28,12 @@ class TestDeliverResponse(object):
         assert parsed_url[:3] == urlparse(redirect_uri)[:3]
         parsed_resp = AuthorizationResponse().from_urlencoded(parsed_url.query)
         assert parsed_resp == authentication_response
+
+    @responses.activate
+    @pytest.mark.parametrize('status, retryable', [(500, True), (503, True), (429, True), (400, False), (404, False)])
+    def test_unexpected_status_raises(self, status, retryable):
+        redirect_uri = 'https://client.example.com/redirect_uri'
+        responses.add(responses.GET, redirect_uri, status=status)
+        with pytest.raises(DeliveryError) as exc_info:
+            deliver_response_task(redirect_uri)
+        assert exc_info.value.retryable == retryable
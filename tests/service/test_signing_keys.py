@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+
+import pytest
+
+from se_leg_op.service.signing_keys import SigningKeyManager
+
+PRIVATE_KEY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'private.pem')
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def add_key(directory, kid, mtime):
+    path = os.path.join(str(directory), kid + '.pem')
+    shutil.copy(PRIVATE_KEY, path)
+    os.utime(path, (mtime, mtime))
+
+
+class TestSigningKeyManager(object):
+    def test_single_key(self):
+        manager = SigningKeyManager({'PATH': PRIVATE_KEY, 'KID': 'test_kid'})
+        assert manager.signing_key.kid == 'test_kid'
+        assert manager.signing_key.alg == 'RS256'
+        assert [key['kid'] for key in manager.jwks['keys']] == ['test_kid']
+
+    def test_key_directory(self, tmpdir):
+        add_key(tmpdir, 'key1', 1000)
+        add_key(tmpdir, 'key2', 2000)
+        manager = SigningKeyManager({'DIRECTORY': str(tmpdir)})
+        assert manager.signing_key.kid == 'key2'
+        assert [key['kid'] for key in manager.jwks['keys']] == ['key2', 'key1']
+        # No private key parts in the JWKS
+        assert 'd' not in manager.jwks['keys'][0]
+
+    def test_rotation(self, tmpdir):
+        timer = FakeTimer()
+        add_key(tmpdir, 'key1', 1000)
+        manager = SigningKeyManager({'DIRECTORY': str(tmpdir), 'RELOAD_INTERVAL': 10}, timer=timer)
+        rotated = []
+        manager.listeners.append(lambda m: rotated.append(m.signing_key.kid))
+
+        add_key(tmpdir, 'key2', 2000)
+        manager.maybe_reload()
+        # Reload interval has not passed
+        assert manager.signing_key.kid == 'key1'
+
+        timer.now = 10
+        manager.maybe_reload()
+        assert manager.signing_key.kid == 'key2'
+        assert [key.kid for key in manager.keys] == ['key2', 'key1']
+        assert rotated == ['key2']
+
+        # Nothing changed
+        timer.now = 20
+        manager.maybe_reload()
+        assert rotated == ['key2']
+
+    def test_new_key_published_before_signing(self, tmpdir):
+        timer = FakeTimer()
+        clock = FakeTimer()
+        clock.now = 10000
+        add_key(tmpdir, 'key1', 1000)
+        manager = SigningKeyManager({'DIRECTORY': str(tmpdir), 'RELOAD_INTERVAL': 10}, publish_delay=600,
+                                    timer=timer, clock=clock)
+        changes = []
+        manager.listeners.append(lambda m: changes.append((m.signing_key.kid, [key['kid'] for key in m.jwks['keys']])))
+
+        add_key(tmpdir, 'key2', clock.now)
+        timer.now = 10
+        manager.maybe_reload()
+        # Published, but not used for signing yet
+        assert changes == [('key1', ['key1', 'key2'])]
+
+        clock.now += 600
+        timer.now = 20
+        manager.maybe_reload()
+        assert len(changes) == 1
+
+        clock.now += 10
+        timer.now = 30
+        manager.maybe_reload()
+        assert changes[-1] == ('key2', ['key2', 'key1'])
+
+    def test_only_new_keys(self, tmpdir):
+        clock = FakeTimer()
+        clock.now = 10000
+        add_key(tmpdir, 'key1', 9990)
+        add_key(tmpdir, 'key2', 9995)
+        manager = SigningKeyManager({'DIRECTORY': str(tmpdir)}, publish_delay=600, clock=clock)
+        # The oldest key signs until a key has been published for long enough
+        assert manager.signing_key.kid == 'key1'
+
+    def test_broken_key_is_ignored(self, tmpdir):
+        timer = FakeTimer()
+        add_key(tmpdir, 'key1', 1000)
+        manager = SigningKeyManager({'DIRECTORY': str(tmpdir), 'RELOAD_INTERVAL': 10}, timer=timer)
+
+        tmpdir.join('key2.pem').write('not a key')
+        timer.now = 10
+        manager.maybe_reload()
+        assert manager.signing_key.kid == 'key1'
+
+    def test_missing_config(self):
+        with pytest.raises(ValueError):
+            SigningKeyManager({})
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from se_leg_op.service.startup_profile import StartupProfile
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_phases():
+    timer = FakeTimer()
+    profile = StartupProfile(timer=timer)
+    with profile.phase('config'):
+        timer.now += 1
+    with profile.phase('plugins'):
+        timer.now += 2
+    with profile.phase('config'):
+        timer.now += 0.5
+    timer.now += 0.25
+    result = profile.to_dict()
+    assert list(result['phases'].items()) == [('config', 1.5), ('plugins', 2)]
+    assert result['total'] == 3.75
+
+
+def test_phase_recorded_on_error():
+    timer = FakeTimer()
+    profile = StartupProfile(timer=timer)
+    try:
+        with profile.phase('storage'):
+            timer.now += 1
+            raise ValueError()
+    except ValueError:
+        pass
+    assert profile.phases['storage'] == 1
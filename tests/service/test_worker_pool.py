@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import os
+from unittest.mock import MagicMock, patch
+
+import pytest
+from redis import StrictRedis
+from rq import Queue
+
+from se_leg_op.service import response_sender
+from se_leg_op.service.delivery_worker import DeliveryWorker
+from se_leg_op.service.job_worker import ConcurrentWorker
+from se_leg_op.service.worker_pool import WorkerPool, init_worker
+
+
+class FakeJob(object):
+    def __init__(self, origin, args=(), kwargs=None):
+        self.id = 'job'
+        self.origin = origin
+        self.args = args
+        self.kwargs = kwargs or {}
+
+
+def make_worker():
+    queue = MagicMock()
+    queue.name = 'authn_responses'
+    other_queue = MagicMock()
+    other_queue.name = 'mobile_verify_service_queue'
+    return DeliveryWorker(queue, MagicMock(), MagicMock(), MagicMock(), queues=[other_queue, queue],
+                          queue_concurrency={'mobile_verify_service_queue': 2}, max_workers=4, max_per_key=3)
+
+
+class TestDeliveryWorkerQueues(object):
+    def test_queues_in_priority_order(self):
+        worker = make_worker()
+        assert [queue.name for queue in worker.queues] == ['mobile_verify_service_queue', 'authn_responses']
+
+    def test_concurrency_per_host_and_queue(self):
+        worker = make_worker()
+        delivery_key = worker.job_concurrency_key(FakeJob('authn_responses', ['https://rp.example.com/cb']))
+        assert delivery_key == 'rp.example.com'
+        assert worker.key_limit(delivery_key) == 3
+        other_key = worker.job_concurrency_key(FakeJob('mobile_verify_service_queue'))
+        assert worker.key_limit(other_key) == 2
+        assert worker.key_limit(worker.job_concurrency_key(FakeJob('unknown_queue'))) is None
+
+    def test_other_jobs_are_not_retried_as_deliveries(self):
+        worker = make_worker()
+        assert worker.retry_delivery(FakeJob('mobile_verify_service_queue'), ValueError, ValueError(), None)
+        assert worker.record_failure(FakeJob('mobile_verify_service_queue'), ValueError, ValueError(), None)
+        assert not worker.scheduler.handle_exception.called
+        assert not worker.breaker.record_failure.called
+
+
+    def test_deliveries_use_worker_sessions_and_timeout(self):
+        worker = make_worker()
+        worker.sessions = MagicMock()
+        worker.timeout = 3
+        worker.sessions.get.return_value.get.return_value.status_code = 200
+        worker.execute_job(FakeJob('authn_responses', ['https://rp.example.com/cb'], {'headers': {'a': 'b'}}))
+        worker.sessions.get.return_value.get.assert_called_once_with('https://rp.example.com/cb', timeout=3,
+                                                                     headers={'a': 'b'})
+
+    @pytest.mark.parametrize('probe', [True, False])
+    def test_failed_delivery_releases_only_own_probe(self, probe):
+        worker = make_worker()
+        worker.breaker.allow.return_value = (True, probe)
+        with patch.object(ConcurrentWorker, 'perform_job', return_value=False):
+            assert not worker.perform_job(FakeJob('authn_responses', ['https://rp.example.com/cb']))
+        assert worker.breaker.release_probe.called == probe
+        assert not worker.breaker.record_success.called
+
+
+def test_init_worker_default_queues():
+    worker = init_worker({'REDIS_URI': 'redis://localhost:6379/0'})
+    assert [queue.name for queue in worker.queues] == ['authn_responses', 'mobile_verify_service_queue']
+
+
+def test_init_worker_delivery_settings():
+    worker = init_worker({'REDIS_URI': 'redis://localhost:6379/0', 'DELIVERY_MAX_PER_HOST': 6,
+                          'DELIVERY_TIMEOUT': 5})
+    assert worker.sessions is not response_sender.sessions
+    assert worker.sessions.pool_maxsize == 6
+    assert worker.timeout == 5
+    assert response_sender.DEFAULT_TIMEOUT == 10
+
+
+class TestWorkerPool(object):
+    def test_runs_processes(self, tmpdir):
+        def target():
+            tmpdir.join(str(os.getpid())).write('')
+            return 0
+
+        pool = WorkerPool(target, 3)
+        pool.run()
+        assert len(tmpdir.listdir()) == 3
+        assert not pool.children
+
+    def test_replaces_failed_processes(self, tmpdir):
+        def target():
+            tmpdir.join(str(os.getpid())).write('')
+            # Fail until there have been three processes
+            return 0 if len(tmpdir.listdir()) >= 3 else 1
+
+        delays = []
+        WorkerPool(target, 1, restart_delay=1, sleep=delays.append).run()
+        assert len(tmpdir.listdir()) == 3
+        # Processes failing right away are replaced with a growing delay
+        assert delays == [1, 2]
+
+    def test_restart_delay(self):
+        pool = WorkerPool(None, 1, restart_delay=1, max_restart_delay=5, min_uptime=10)
+        assert [pool.next_restart_delay(0) for i in range(5)] == [1, 2, 4, 5, 5]
+        # A process that ran for a while resets the delay
+        assert pool.next_restart_delay(60) == 1
+        assert pool.next_restart_delay(0) == 1
+
+    def test_idle_process_keeps_running(self, tmpdir):
+        def target():
+            connection = StrictRedis()
+            # The queue stays empty, every blocking pop times out
+            connection.blpop = MagicMock(return_value=None)
+            connection.lpop = MagicMock(return_value=None)
+            worker = ConcurrentWorker([Queue('test', connection=connection)], connection, max_workers=1)
+            worker.before_dequeue = lambda: worker.stop() if connection.blpop.call_count >= 2 else None
+            tmpdir.join(str(os.getpid())).write('')
+            worker.work(burst=False, poll_timeout=1)
+            return 0
+
+        WorkerPool(target, 1, sleep=lambda delay: None).run()
+        assert len(tmpdir.listdir()) == 1
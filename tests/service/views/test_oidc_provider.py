@@ -115,6 +115,24 @@ class TestAuthenticationEndpoint(object):
         post_auth_authn_request_args['user_id'] = self.app.authn_requests[nonce]['user_id']
         assert self.app.authn_requests[nonce] == post_auth_authn_request_args
 
+    def test_authentication_endpoint_rate_limited(self, authn_request_args):
+        rate_limits = {'oidc_provider.authentication_endpoint': {'rate': 1, 'burst': 1}}
+        with patch.dict(self.app.config, {'RATE_LIMITS': rate_limits}), \
+                patch.object(self.app, 'rate_limiter') as rate_limiter:
+            rate_limiter.consume.return_value = (False, 1)
+            resp = self.app.test_client().post('/authentication', data=authn_request_args)
+            assert resp.status_code == 429
+            # The limit is checked for the validated client
+            assert rate_limiter.consume.call_args[0][0] == 'oidc_provider.authentication_endpoint:client1'
+            assert authn_request_args['nonce'] not in self.app.authn_requests
+
+            # Requests with an unknown client are limited by remote address
+            authn_request_args['client_id'] = 'unknown'
+            resp = self.app.test_client().post('/authentication', data=authn_request_args,
+                                               environ_base={'REMOTE_ADDR': '192.0.2.1'})
+            assert resp.status_code == 429
+            assert rate_limiter.consume.call_args[0][0] == 'oidc_provider.authentication_endpoint:192.0.2.1'
+
     @responses.activate
     def test_error_response(self, authn_request_args):
         exception = InvalidAuthenticationRequest('test', AuthorizationRequest(**authn_request_args), 'invalid_request')
@@ -375,6 +393,17 @@ class TestProviderConfigurationEndpoint(object):
         resp = self.app.test_client().get('/.well-known/openid-configuration')
         assert resp.status_code == 200
         assert json.loads(resp.data.decode('utf-8')) == self.app.provider.provider_configuration.to_dict()
+        assert resp.headers['ETag']
+        assert 'max-age' in resp.headers['Cache-Control']
+
+    def test_configuration_endpoint_not_modified(self):
+        resp = self.app.test_client().get('/.well-known/openid-configuration')
+        etag = resp.headers['ETag']
+
+        resp = self.app.test_client().get('/.well-known/openid-configuration', headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+        assert resp.headers['ETag'] == etag
+        assert resp.data == b''
 
 
 @pytest.mark.usefixtures('inject_app')
@@ -391,3 +420,10 @@ class TestJWKSEndpoint(object):
             expected_key = RSAKey(key=import_rsa_key(f.read()), kid=jwks_key.kid, alg='RS256')
 
         assert jwks_key == expected_key
+
+    def test_jwks_endpoint_not_modified(self):
+        resp = self.app.test_client().get('/jwks')
+        etag = resp.headers['ETag']
+
+        resp = self.app.test_client().get('/jwks', headers={'If-None-Match': etag})
+        assert resp.status_code == 304
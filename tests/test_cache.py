@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import Mock, patch
+
+import pytest
+
+from se_leg_op.cache import CachedStorage, RedisCacheInvalidator, TTLCache
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def timer():
+    return FakeTimer()
+
+
+class TestTTLCache(object):
+    def test_get_and_set(self, timer):
+        cache = TTLCache(10, 60, timer=timer)
+        cache['key'] = 'value'
+        assert cache['key'] == 'value'
+        with pytest.raises(KeyError):
+            cache['unknown']
+
+    def test_expiry(self, timer):
+        cache = TTLCache(10, 60, timer=timer)
+        cache['key'] = 'value'
+        timer.now = 59
+        assert cache['key'] == 'value'
+        timer.now = 60
+        with pytest.raises(KeyError):
+            cache['key']
+        assert len(cache) == 0
+
+    def test_least_recently_used_is_evicted(self, timer):
+        cache = TTLCache(2, 60, timer=timer)
+        cache['key1'] = 1
+        cache['key2'] = 2
+        cache['key1']
+        cache['key3'] = 3
+        assert cache['key1'] == 1
+        assert cache['key3'] == 3
+        with pytest.raises(KeyError):
+            cache['key2']
+
+    def test_invalidate(self, timer):
+        cache = TTLCache(10, 60, timer=timer)
+        cache['key1'] = 1
+        cache['key2'] = 2
+        cache.invalidate('key1')
+        assert 'key1' not in cache._entries
+        assert cache['key2'] == 2
+        cache.invalidate()
+        assert len(cache) == 0
+
+
+class TestCachedStorage(object):
+    @pytest.fixture
+    def storage(self):
+        return {'client1': {'client_secret': 'secret'}}
+
+    @pytest.fixture
+    def invalidator(self):
+        return Mock(spec=RedisCacheInvalidator)
+
+    def test_read_through(self, storage, invalidator, timer):
+        cached_storage = CachedStorage(storage, TTLCache(10, 60, timer=timer), invalidator)
+        assert cached_storage['client1'] == {'client_secret': 'secret'}
+        # The cached value is used until it expires
+        storage['client1'] = {'client_secret': 'new_secret'}
+        assert cached_storage['client1'] == {'client_secret': 'secret'}
+        timer.now = 60
+        assert cached_storage['client1'] == {'client_secret': 'new_secret'}
+
+    def test_cached_value_can_not_be_modified(self, storage, timer):
+        cached_storage = CachedStorage(storage, TTLCache(10, 60, timer=timer))
+        cached_storage['client1']['client_secret'] = 'modified'
+        assert cached_storage['client1'] == {'client_secret': 'secret'}
+
+    def test_write_invalidates(self, storage, invalidator, timer):
+        cached_storage = CachedStorage(storage, TTLCache(10, 60, timer=timer), invalidator)
+        cached_storage['client1']
+        cached_storage['client1'] = {'client_secret': 'new_secret'}
+        assert cached_storage['client1'] == {'client_secret': 'new_secret'}
+        invalidator.publish.assert_called_once_with('client1')
+
+        del cached_storage['client1']
+        assert 'client1' not in cached_storage
+        with pytest.raises(KeyError):
+            cached_storage['client1']
+
+    def test_invalidation_message(self, timer):
+        cache = TTLCache(10, 60, timer=timer)
+        cache['client1'] = 1
+        cache['client2'] = 2
+        invalidator = RedisCacheInvalidator(Mock(), 'channel', cache)
+        invalidator._handle(b'{"key": "client1"}')
+        assert 'client1' not in cache._entries
+        assert cache['client2'] == 2
+        invalidator._handle(b'{}')
+        assert len(cache) == 0
+
+    @patch('se_leg_op.cache.os.getpid')
+    @patch('se_leg_op.cache.threading.Thread')
+    def test_started_once_per_process(self, thread, getpid):
+        getpid.return_value = 100
+        invalidator = RedisCacheInvalidator(Mock(), 'channel', TTLCache(10, 60))
+        invalidator.start()
+        invalidator.start()
+        assert thread.return_value.start.call_count == 1
+        # In a forked process
+        getpid.return_value = 101
+        invalidator.start()
+        assert thread.return_value.start.call_count == 2
+
+    def test_invalidator_started_on_first_use(self, storage, invalidator, timer):
+        cached_storage = CachedStorage(storage, TTLCache(10, 60, timer=timer), invalidator)
+        assert not invalidator.start.called
+        assert 'client1' in cached_storage
+        assert invalidator.start.called
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+
+from flask import Flask
+
+from se_leg_op.log_utils import LogPayload, PayloadSettings, SamplingFilter, init_logging, payload
+
+
+class NotFormattable(object):
+    def __str__(self):
+        raise AssertionError('formatted')
+
+    __repr__ = __str__
+
+
+class TestPayload(object):
+    def test_short_string(self):
+        assert str(payload('data')) == 'data'
+
+    def test_truncated_string(self):
+        assert str(payload('a' * 20, max_length=5)) == 'aaaaa... (15 characters truncated)'
+
+    def test_bytes(self):
+        assert str(payload(b'\x00' * 2048)) == '<2048 bytes>'
+
+    def test_redacted_keys(self):
+        value = {'encodedData': 'secret image', 'mibi': {'password': 'secret'}, 'barcode': 'b' * 20,
+                 'items': [b'data']}
+        logged = json.loads(str(payload(value, max_length=200)))
+        assert logged == {'encodedData': '<redacted>', 'mibi': {'password': '<redacted>'},
+                          'barcode': 'b' * 20, 'items': ['<4 bytes>']}
+
+    def test_long_values_truncated(self):
+        logged = str(payload({'barcode': 'b' * 5000}, max_length=50))
+        assert len(logged) < 120
+        assert 'characters truncated' in logged
+
+    def test_not_formatted_unless_emitted(self):
+        logger = logging.getLogger('test_log_utils.lazy')
+        logger.setLevel(logging.INFO)
+        logger.debug('data: %s', payload(NotFormattable()))
+
+
+class TestSamplingFilter(object):
+    def make_record(self, level):
+        return logging.LogRecord('test', level, __file__, 1, 'message', None, None)
+
+    def test_samples_debug_and_info(self):
+        log_filter = SamplingFilter(0.1, random=lambda: 0.5)
+        assert not log_filter.filter(self.make_record(logging.DEBUG))
+        assert not log_filter.filter(self.make_record(logging.INFO))
+        assert log_filter.filter(self.make_record(logging.WARNING))
+
+        log_filter = SamplingFilter(0.1, random=lambda: 0.05)
+        assert log_filter.filter(self.make_record(logging.DEBUG))
+
+
+class TestInitLogging(object):
+    def test_init_logging(self):
+        config = {'LOG_PAYLOAD_MAX_LENGTH': 3, 'LOG_REDACTED_KEYS': ['token'],
+                  'LOG_SAMPLING': {'test_log_utils.sampled': 0.5}}
+        init_logging(config)
+        settings = init_logging(config)
+        assert settings.max_length == 3
+        assert settings.redacted_keys == frozenset(['token'])
+        # The module defaults are not changed
+        assert str(payload('a' * 4)) == 'a' * 4
+        filters = logging.getLogger('test_log_utils.sampled').filters
+        assert len(filters) == 1
+        assert filters[0].rate == 0.5
+
+    def test_app_payload_settings(self):
+        app = Flask('se_leg_op')
+        app.log_payload_settings = PayloadSettings(max_length=3, redacted_keys=['token'])
+        with app.app_context():
+            assert str(payload('abcdef')) == 'abc... (3 characters truncated)'
+            redacted = json.loads(str(payload({'token': 'x', 'password': 'y'}, max_length=100)))
+            assert redacted == {'token': '<redacted>', 'password': 'y'}
+        assert str(payload('abcdef')) == 'abcdef'
+
+    def test_defaults(self, monkeypatch):
+        monkeypatch.setattr(LogPayload, 'defaults', PayloadSettings(max_length=3))
+        assert str(payload('abcdef')) == 'abc... (3 characters truncated)'
+        with Flask('se_leg_op').app_context():
+            assert str(payload('abcdef')) == 'abc... (3 characters truncated)'
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+from se_leg_op.redis_connections import (HealthCheckConnectionPool, HealthCheckSentinelConnectionPool,
+                                         RedisConnectionRegistry)
+
+
+class FakeConnection(object):
+    def __init__(self, **kwargs):
+        self.pid = os.getpid()
+        self._sock = object()
+        self.commands = []
+        self.response = b'PONG'
+
+    def send_command(self, *args):
+        self.commands.append(args)
+
+    def read_response(self):
+        return self.response
+
+    def disconnect(self):
+        self._sock = None
+
+
+class TestRedisConnectionRegistry(object):
+    def test_connection_is_shared(self):
+        registry = RedisConnectionRegistry()
+        connection = registry.get_connection({'REDIS_URI': 'redis://localhost:6379/0'})
+        assert registry.get_connection({'REDIS_URI': 'redis://localhost:6379/0'}) is connection
+        assert registry.get_connection({'REDIS_URI': 'redis://localhost:6379/1'}) is not connection
+
+    def test_pool_options(self):
+        registry = RedisConnectionRegistry()
+        connection = registry.get_connection({'REDIS_URI': 'redis://localhost:6379/0', 'REDIS_MAX_CONNECTIONS': 20,
+                                              'REDIS_SOCKET_TIMEOUT': 2, 'REDIS_HEALTH_CHECK_INTERVAL': 10})
+        pool = connection.connection_pool
+        assert isinstance(pool, HealthCheckConnectionPool)
+        assert pool.max_connections == 20
+        assert pool.connection_kwargs['socket_timeout'] == 2
+        assert pool.health_check_interval == 10
+
+    def test_sentinel(self):
+        registry = RedisConnectionRegistry()
+        connection = registry.get_connection({'REDIS_SENTINEL_HOSTS': ['sentinel1', 'sentinel2'], 'REDIS_PORT': 26379,
+                                              'REDIS_SENTINEL_SERVICE_NAME': 'redis-cluster'})
+        pool = connection.connection_pool
+        assert isinstance(pool, HealthCheckSentinelConnectionPool)
+        assert pool.service_name == 'redis-cluster'
+        assert [s.connection_pool.connection_kwargs['host'] for s in pool.sentinel_manager.sentinels] == \
+            ['sentinel1', 'sentinel2']
+
+    def test_stats(self):
+        registry = RedisConnectionRegistry()
+        registry.get_connection({'REDIS_URI': 'redis://localhost:6379/0'})
+        stats = list(registry.stats().values())
+        assert stats == [{'max_connections': 2 ** 31, 'created_connections': 0, 'available_connections': 0,
+                          'in_use_connections': 0, 'health_check_failures': 0}]
+
+
+class TestHealthCheck(object):
+    def test_idle_connection_is_checked(self):
+        pool = HealthCheckConnectionPool(connection_class=FakeConnection, health_check_interval=10)
+        connection = pool.get_connection('GET')
+        pool.release(connection)
+        assert pool.get_connection('GET').commands == []
+        pool.release(connection)
+
+        connection.released_at = time.monotonic() - 11
+        assert pool.get_connection('GET').commands == [('PING',)]
+        assert connection._sock is not None
+
+    def test_broken_connection_is_disconnected(self):
+        pool = HealthCheckConnectionPool(connection_class=FakeConnection, health_check_interval=10)
+        connection = pool.get_connection('GET')
+        pool.release(connection)
+        connection.released_at = time.monotonic() - 11
+        connection.response = b'LOADING'
+        assert pool.get_connection('GET') is connection
+        assert connection._sock is None
+        assert pool.stats()['health_check_failures'] == 1
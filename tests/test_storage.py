@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import datetime
+from unittest import mock
+
+import pytest
+import redis
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+from se_leg_op.storage import (BlobStorage, DocumentDoesNotExist, OpStorageWrapper, RedisStorageWrapper,
+                               VersionConflict, init_storage, mongo_clients)
+
+
+@pytest.fixture
+def db(mongodb_instance):
+    db = OpStorageWrapper(mongodb_instance.get_uri(), 'test_collection')
+    db._coll.drop()
+    return db
+
+
+@pytest.fixture
+def redis_db(redis_instance):
+    connection = redis.StrictRedis.from_url(redis_instance.get_uri())
+    connection.flushdb()
+    return RedisStorageWrapper(connection, 'test_collection', scan_count=2)
+
+
+class TestOpStorageWrapper(object):
+    def test_get_many(self, db):
+        db['key1'] = {'value': 1}
+        db['key2'] = {'value': 2}
+        db['key3'] = {'value': 3}
+
+        result = db.get_many(['key1', 'key3', 'unknown_key'])
+        assert result == {'key1': {'value': 1}, 'key3': {'value': 3}}
+
+    def test_get_many_no_keys(self, db):
+        assert db.get_many([]) == {}
+
+    def test_ensure_indexes(self, db):
+        db['key1'] = {'value': 1}
+        assert db.index_report()['missing'] == ['lookup_key_1']
+
+        db.ensure_indexes()
+        # ensuring the indexes again is a no-op
+        db.ensure_indexes()
+        assert db._coll.index_information()['lookup_key_1']['unique']
+        assert db.index_report()['missing'] == []
+
+    def test_collection_indexes(self, mongodb_instance):
+        db = OpStorageWrapper(mongodb_instance.get_uri(), 'test_collection',
+                              indexes=[{'keys': 'data.client_id'}])
+        db._coll.drop()
+        db._coll.create_index('data.other')
+        db['key1'] = {'client_id': 'client1'}
+
+        report = db.index_report()
+        assert report['missing'] == ['lookup_key_1', 'data.client_id_1']
+        assert report['unknown'] == ['data.other_1']
+
+    def test_index_report_without_index_stats(self, db):
+        db.ensure_indexes()
+        with mock.patch.object(db._coll, 'aggregate', side_effect=OperationFailure('unrecognized pipeline stage')):
+            report = db.index_report()
+        assert report == {'missing': [], 'unknown': [], 'unused': None}
+
+    def test_ttl(self, mongodb_instance):
+        db = OpStorageWrapper(mongodb_instance.get_uri(), 'test_collection', ttl=60)
+        db._coll.drop()
+        db.ensure_indexes()
+        db['key1'] = {'value': 1}
+
+        doc = db._coll.find_one({'lookup_key': 'key1'})
+        now = datetime.datetime.now(datetime.timezone.utc)
+        assert now < doc['expires_at'] <= now + datetime.timedelta(seconds=60)
+        assert db._coll.index_information()['expires_at_1']['expireAfterSeconds'] == 0
+
+    def test_init_storage_ttl(self, mongodb_instance):
+        config = {
+            'DB_URI': mongodb_instance.get_uri(),
+            'DB_COLLECTION_TTL': {'authz_codes': 10, 'yubico_states': 20}
+        }
+        assert init_storage(config, 'authz_codes')._ttl == 10
+        assert init_storage(config, 'yubico_states')._ttl == 20
+        assert init_storage(config, 'authn_requests')._ttl == 60 * 60 * 24
+        assert init_storage(config, 'userinfo')._ttl is None
+
+    def test_get_documents_by_attr(self, db):
+        db['key1'] = {'client_id': 'client1', 'value': 1}
+        db['key2'] = {'client_id': 'client1', 'value': 2}
+        db['key3'] = {'client_id': 'client2', 'value': 3}
+
+        result = dict(db.get_documents_by_attr('data.client_id', 'client1'))
+        assert result == {'key1': {'client_id': 'client1', 'value': 1}, 'key2': {'client_id': 'client1', 'value': 2}}
+
+    def test_get_documents_by_attr_missing(self, db):
+        with pytest.raises(DocumentDoesNotExist):
+            list(db.get_documents_by_attr('data.client_id', 'client1'))
+        assert list(db.get_documents_by_attr('data.client_id', 'client1', raise_on_missing=False)) == []
+
+    def test_get_documents_by_filter_projection(self, db):
+        db['key1'] = {'client_id': 'client1', 'value': 1}
+
+        result = list(db.get_documents_by_filter({}, fields={'data.value': True}))
+        assert result == [('key1', {'value': 1})]
+
+    def test_get_documents_by_filter_paging(self, db):
+        for i in range(5):
+            db['key{}'.format(i)] = {'value': i}
+
+        result = db.get_documents_by_filter({}, sort=[('lookup_key', 1)], skip=1, limit=3, batch_size=2)
+        assert [key for key, data in result] == ['key1', 'key2', 'key3']
+
+    def test_pop(self, db):
+        db['key1'] = {'value': 1}
+        assert db.pop('key1') == {'value': 1}
+        assert 'key1' not in db
+        assert db.pop('key1') is None
+        assert db.pop('key1', 'default') == 'default'
+
+    def test_take(self, db):
+        db['key1'] = {'value': 1}
+        assert db.take('key1') == {'value': 1}
+        with pytest.raises(KeyError):
+            db.take('key1')
+
+    def test_update_fields(self, db):
+        db['key1'] = {'value': 1, 'other': 'foo'}
+        db.update_fields('key1', {'value': 2, 'new': 'bar'})
+        assert db['key1'] == {'value': 2, 'other': 'foo', 'new': 'bar'}
+        with pytest.raises(KeyError):
+            db.update_fields('unknown_key', {'value': 2})
+
+    def test_update_fields_unset(self, db):
+        db['key1'] = {'value': 1, 'other': 'foo'}
+        db.update_fields('key1', unset=['other', 'missing'])
+        assert db['key1'] == {'value': 1}
+
+    @pytest.mark.parametrize('field', ['', 'a.b', '$set'])
+    def test_update_fields_invalid_field(self, db, field):
+        db['key1'] = {'value': 1}
+        with pytest.raises(ValueError):
+            db.update_fields('key1', {field: 1})
+        with pytest.raises(ValueError):
+            db.update_fields('key1', unset=[field])
+
+    def test_update_fields_version(self, db):
+        db['key1'] = {'value': 1}
+        data, version = db.get_versioned('key1')
+        db.update_fields('key1', {'value': 2}, version=version)
+        with pytest.raises(VersionConflict):
+            db.update_fields('key1', {'value': 3}, version=version)
+        assert db['key1'] == {'value': 2}
+
+        # Writing the whole document counts as a new version
+        data, version = db.get_versioned('key1')
+        db['key1'] = {'value': 4}
+        with pytest.raises(VersionConflict):
+            db.update_fields('key1', {'value': 5}, version=version)
+        with pytest.raises(KeyError):
+            db.update_fields('unknown_key', {'value': 2}, version=version)
+
+    def test_update_fields_unversioned_document(self, db):
+        db._coll.insert_one({'lookup_key': 'key1', 'data': {'value': 1}})
+        assert db.get_versioned('key1') == ({'value': 1}, 0)
+        db.update_fields('key1', {'value': 2}, version=0)
+        assert db.get_versioned('key1') == ({'value': 2}, 1)
+
+    def test_bulk_update_fields(self, db):
+        db['key1'] = {'value': 1}
+        db['key2'] = {'value': 2}
+        errors = db.bulk_update_fields([('key1', {'new': 1}), ('key2', {'a.b': 2}), ('key2', {'new': 2}),
+                                        ('unknown_key', {'new': 3})])
+        assert list(errors) == [1]
+        assert db['key1'] == {'value': 1, 'new': 1}
+        assert db['key2'] == {'value': 2, 'new': 2}
+        assert 'unknown_key' not in db
+        assert db.bulk_update_fields([]) == {}
+
+    def test_existing_keys(self, db):
+        db['key1'] = {'value': 1}
+        db['key2'] = {'value': 2}
+        assert db.existing_keys(['key1', 'unknown_key']) == {'key1'}
+        assert db.existing_keys([]) == set()
+
+    def test_shared_client(self, mongodb_instance, db):
+        other_db = OpStorageWrapper(mongodb_instance.get_uri(), 'other_collection')
+        assert other_db._db is db._db
+
+        db['key1'] = {'value': 1}
+        stats = mongo_clients.stats()
+        assert len(stats) == 1
+        stats = list(stats.values())[0]
+        assert stats['in_flight'] == 0
+        assert stats['succeeded'] > 0
+
+
+class TestRedisStorageWrapper(object):
+    def test_mapping(self, redis_db):
+        redis_db['key1'] = {'value': 1}
+        assert redis_db['key1'] == {'value': 1}
+        assert 'key1' in redis_db
+        assert 'key2' not in redis_db
+        with pytest.raises(KeyError):
+            redis_db['key2']
+
+        del redis_db['key1']
+        assert 'key1' not in redis_db
+
+    def test_pop(self, redis_db):
+        redis_db['key1'] = {'value': 1}
+        assert redis_db.pop('key1') == {'value': 1}
+        assert redis_db.pop('key1') is None
+        assert redis_db.pop('key1', 'default') == 'default'
+
+    def test_take(self, redis_db):
+        redis_db['key1'] = {'value': 1}
+        assert redis_db.take('key1') == {'value': 1}
+        with pytest.raises(KeyError):
+            redis_db.take('key1')
+
+    def test_update_fields(self, redis_instance):
+        connection = redis.StrictRedis.from_url(redis_instance.get_uri())
+        redis_db = RedisStorageWrapper(connection, 'test_collection', ttl=60)
+        redis_db['key1'] = {'value': 1, 'other': 'foo'}
+        redis_db.update_fields('key1', {'value': 2})
+        assert redis_db['key1'] == {'value': 2, 'other': 'foo'}
+        assert 0 < connection.ttl(redis_db._key('key1')) <= 60
+        with pytest.raises(KeyError):
+            redis_db.update_fields('unknown_key', {'value': 2})
+
+    def test_update_fields_unset_and_version(self, redis_db):
+        redis_db['key1'] = {'value': 1, 'other': 'foo'}
+        data, version = redis_db.get_versioned('key1')
+        redis_db.update_fields('key1', {'value': 2}, unset=['other'], version=version)
+        assert redis_db['key1'] == {'value': 2}
+        with pytest.raises(VersionConflict):
+            redis_db.update_fields('key1', {'value': 3}, version=version)
+        with pytest.raises(ValueError):
+            redis_db.update_fields('key1', {'a.b': 3})
+
+    def test_bulk_update_fields(self, redis_db):
+        redis_db['key1'] = {'value': 1}
+        errors = redis_db.bulk_update_fields([('key1', {'new': 1}), ('key1', {'a.b': 2}), ('unknown_key', {'new': 3})])
+        assert sorted(errors) == [1, 2]
+        assert redis_db['key1'] == {'value': 1, 'new': 1}
+        assert redis_db.existing_keys(['key1', 'unknown_key']) == {'key1'}
+
+    def test_items(self, redis_db):
+        for i in range(5):
+            redis_db['key{}'.format(i)] = {'value': i}
+        assert dict(redis_db.items()) == dict(('key{}'.format(i), {'value': i}) for i in range(5))
+
+    def test_ttl(self, redis_instance):
+        connection = redis.StrictRedis.from_url(redis_instance.get_uri())
+        redis_db = RedisStorageWrapper(connection, 'test_collection', ttl=60)
+        redis_db['key1'] = {'value': 1}
+        assert 0 < connection.ttl(redis_db._key('key1')) <= 60
+
+    def test_get_many(self, redis_db):
+        redis_db['key1'] = {'value': 1}
+        redis_db['key2'] = {'value': 2}
+        assert redis_db.get_many(['key1', 'unknown_key']) == {'key1': {'value': 1}}
+        assert redis_db.get_many([]) == {}
+
+    def test_get_documents_by_attr(self, redis_db):
+        redis_db['key1'] = {'client_id': 'client1', 'value': 1}
+        redis_db['key2'] = {'client_id': 'client1', 'value': 2}
+        redis_db['key3'] = {'client_id': 'client2', 'value': 3}
+
+        result = dict(redis_db.get_documents_by_attr('data.client_id', 'client1'))
+        assert result == {'key1': {'client_id': 'client1', 'value': 1}, 'key2': {'client_id': 'client1', 'value': 2}}
+        assert len(list(redis_db.get_documents_by_attr('data.client_id', 'client1', limit=1))) == 1
+        with pytest.raises(DocumentDoesNotExist):
+            list(redis_db.get_documents_by_attr('data.client_id', 'client3'))
+
+    def test_init_storage_backend(self, mongodb_instance, redis_instance):
+        config = {
+            'DB_URI': mongodb_instance.get_uri(),
+            'REDIS_URI': redis_instance.get_uri(),
+            'DB_COLLECTION_BACKEND': {'authz_codes': 'redis'}
+        }
+        authz_codes = init_storage(config, 'authz_codes')
+        assert isinstance(authz_codes, RedisStorageWrapper)
+        assert authz_codes._ttl == 60 * 60
+        assert isinstance(init_storage(config, 'userinfo'), OpStorageWrapper)
+
+        config['DB_COLLECTION_BACKEND'] = {'userinfo': 'memcached'}
+        with pytest.raises(ValueError):
+            init_storage(config, 'userinfo')
+
+    @pytest.mark.parametrize('collection', ['userinfo', 'yubico_states', 'clients', 'subject_identifiers'])
+    def test_init_storage_redis_not_supported(self, collection):
+        config = {'REDIS_URI': 'redis://localhost:6379/0', 'DB_COLLECTION_BACKEND': {collection: 'redis'}}
+        with pytest.raises(ValueError):
+            init_storage(config, collection)
+
+
+class TestBlobStorage(object):
+    @pytest.fixture
+    def blobs(self, mongodb_instance):
+        blobs = BlobStorage(mongodb_instance.get_uri(), 'test_blobs', decode_chunk_size=8)
+        db = mongo_clients.get_db(mongodb_instance.get_uri()).get_database()
+        db.drop_collection('test_blobs.files')
+        db.drop_collection('test_blobs.chunks')
+        return blobs
+
+    def test_put_and_get(self, blobs):
+        blob_id = blobs.put(b'image data')
+        assert blob_id in blobs
+        assert blobs[blob_id] == b'image data'
+        del blobs[blob_id]
+        assert blob_id not in blobs
+        with pytest.raises(KeyError):
+            blobs[blob_id]
+
+    def test_unknown_blob_id(self, blobs):
+        assert 'not an id' not in blobs
+        with pytest.raises(KeyError):
+            blobs['not an id']
+
+    def test_put_base64(self, blobs):
+        data = bytes(range(256))
+        encoded = base64.b64encode(data).decode('ascii')
+        assert blobs[blobs.put_base64(encoded)] == data
+        # Whitespace moves the chunk boundaries
+        encoded_lines = '\n'.join(encoded[i:i + 7] for i in range(0, len(encoded), 7))
+        assert blobs[blobs.put_base64(encoded_lines)] == data
+
+    @pytest.mark.parametrize('line_separator', ['\n', '\r\n'])
+    def test_put_line_wrapped_base64(self, line_separator):
+        data = bytes(range(256)) * 4
+        encoded = base64.encodebytes(data).decode('ascii').replace('\n', line_separator)
+        with mock.patch('se_leg_op.storage.mongo_clients'), mock.patch('se_leg_op.storage.gridfs.GridFS') as fs:
+            blobs = BlobStorage('mongodb://localhost', 'test_blobs', decode_chunk_size=64)
+            blobs.put_base64(encoded)
+        grid_in = fs.return_value.new_file.return_value
+        assert b''.join(call[0][0] for call in grid_in.write.call_args_list) == data
+        assert grid_in.close.called
+
+    def test_purge_expired(self, mongodb_instance, blobs):
+        blobs = BlobStorage(mongodb_instance.get_uri(), 'test_blobs', ttl=60)
+        old_id = blobs.put(b'old image')
+        new_id = blobs.put(b'new image')
+        blobs._files.update_one({'_id': ObjectId(old_id)},
+                                {'$set': {'uploadDate': datetime.datetime.utcnow() - datetime.timedelta(seconds=61)}})
+        assert blobs.purge_expired() == 1
+        assert old_id not in blobs
+        assert new_id in blobs
+
+    def test_purge_without_ttl(self, blobs):
+        blob_id = blobs.put(b'image data')
+        blobs._files.update_one({'_id': ObjectId(blob_id)}, {'$set': {'uploadDate': datetime.datetime(2000, 1, 1)}})
+        assert blobs.purge_expired() == 0
+        assert blob_id in blobs
+
+    def test_put_invalid_base64(self, blobs):
+        for encoded in ['aW1hZ2U*ZGF0YQ==', 'aW1hZ2UgZGF0YQ=']:
+            with pytest.raises(ValueError):
+                blobs.put_base64(encoded)
+        assert blobs._fs.find().count() == 0